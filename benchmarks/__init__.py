@@ -0,0 +1,2 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
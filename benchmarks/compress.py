@@ -0,0 +1,62 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Compare the wire size and estimated delivery latency of uncompressed and
+gzip-compressed ``adbs`` listings over links of various speeds.  Latency is
+estimated as the server's compression time plus the transfer time plus the
+client's decompression time.
+
+Usage: python -m benchmarks.compress [songs ...]
+"""
+
+import sys
+import time
+import zlib
+
+from benchmarks.encode import buildListing
+from marconi.net.daap import gzip
+
+"""Link speeds (in bytes/sec) used to estimate transfer times."""
+LINKS = (
+    ('slow wi-fi',      256 * 1024),
+    ('wi-fi',           2 * 1024 * 1024),
+    ('ethernet',        12 * 1024 * 1024),
+)
+
+def measure(func, arg, repeat=3):
+    """Return the result and best wall-clock time of ``repeat`` calls."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = func(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+def decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def run(counts):
+    for count in counts:
+        body = buildListing(count).serialize()
+        compressed, compressTime = measure(gzip, body)
+        result, decompressTime = measure(decompress, compressed)
+        if result != body:
+            raise AssertionError('Round trip failed for %d songs' % count)
+
+        sys.stdout.write('%7d songs  identity %10d bytes  gzip %9d bytes '
+                         '(%4.1f%%)  compress %6.3fs  decompress %6.3fs\n' %
+                         (count, len(body), len(compressed),
+                          100.0 * len(compressed) / len(body),
+                          compressTime, decompressTime))
+        for name, speed in LINKS:
+            identity = float(len(body)) / speed
+            encoded = (compressTime + float(len(compressed)) / speed +
+                       decompressTime)
+            sys.stdout.write('        %-12s identity %8.3fs  gzip %8.3fs\n' %
+                             (name, identity, encoded))
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000])
@@ -0,0 +1,223 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Benchmark listing latency while the library is being written to.  A
+file-based synthetic library is created, and then pages of songs are listed
+from it, back to back, first while the library is idle and then while a bulk
+import adds songs through the library's writer.  The catalog is disabled so
+that every listing is a database query.
+
+In WAL mode, readers never wait for the writer, so listing latency should
+stay flat during the import, apart from the CPU time (and interpreter lock)
+that the import's own work takes from the listings.  Passing ``--journal
+delete`` runs the same benchmark with SQLite's default rollback journal for
+comparison.
+
+Results are written as JSON (to standard output by default) so that runs
+can be compared with one another.
+
+Usage: python -m benchmarks.contention [-o FILE] [-s SONGS] [-i SONGS]
+                                       [-d SECONDS] [-j MODE]
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from benchmarks import synthetic
+from marconi import db
+
+"""Percentiles reported for each set of latencies."""
+PERCENTILES = (50, 95, 99)
+
+def summarize(latencies, errors=0):
+    """Summarize a list of latencies (in seconds)."""
+    latencies = sorted(latencies)
+    result = {'count': len(latencies), 'errors': errors}
+    if latencies:
+        for p in PERCENTILES:
+            index = int(round(p / 100.0 * (len(latencies) - 1)))
+            result['p%d' % p] = latencies[index]
+        result['max'] = latencies[-1]
+        result['mean'] = sum(latencies) / len(latencies)
+    return result
+
+def measureListings(library, songs, done, pageSize=100):
+    """
+    Return a Deferred that fires with a summary of the latencies of listing
+    pages of ``pageSize`` songs from random offsets until ``done()``.
+    """
+    from twisted.internet.defer import inlineCallbacks, returnValue
+
+    @inlineCallbacks
+    def _measure():
+        latencies = []
+        errors = 0
+        while not done():
+            after = random.randint(0, max(songs - pageSize, 0))
+            start = time.time()
+            try:
+                yield library.getSongs(after, pageSize)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.time() - start)
+        returnValue(summarize(latencies, errors))
+
+    return _measure()
+
+def bulkImport(library, first, count, batchSize=500, window=8):
+    """
+    Return a Deferred that fires with the time taken to import ``count``
+    synthetic songs (numbered from ``first``) through the library's writer,
+    ``batchSize`` songs per write with up to ``window`` writes queued.
+    """
+    from twisted.internet.defer import Deferred
+    from marconi.scanner import Scanner
+
+    scanner = Scanner(library)
+
+    def _import(session, start, end):
+        # The songs are generated in the writer thread, as a scanner's would
+        # have been extracted outside of the reactor thread.
+        rows = [synthetic.song(i) for i in xrange(start, end)]
+        return scanner.apply(session, rows)
+
+    batches = [(i, min(i + batchSize, first + count))
+               for i in xrange(first, first + count, batchSize)]
+    finished = Deferred()
+    state = {'outstanding': 0, 'start': time.time()}
+
+    def _next(result=None):
+        state['outstanding'] -= 1
+        _fill()
+        return result
+
+    def _fill():
+        while batches and state['outstanding'] < window:
+            start, end = batches.pop(0)
+            state['outstanding'] += 1
+            d = library.write(_import, start, end)
+            d.addCallback(_next)
+            d.addErrback(finished.errback)
+        if not batches and not state['outstanding'] and not finished.called:
+            finished.callback(time.time() - state['start'])
+
+    _fill()
+    return finished
+
+def benchmark(songs, imported, duration):
+    """
+    Return a Deferred that fires with the results for a library of ``songs``
+    songs, importing ``imported`` more.  The reactor must be running.
+    """
+    from twisted.internet.defer import inlineCallbacks, returnValue
+    from marconi.base import Library
+
+    directory = tempfile.mkdtemp(prefix='marconi-')
+    path = os.path.join(directory, 'marconi.db')
+    engine = db.create(path)
+    populate = synthetic.populate(engine, songs)
+    library = Library(engine, 'Benchmark', catalog=False)
+    journal = engine.execute('PRAGMA journal_mode').scalar()
+
+    @inlineCallbacks
+    def _run():
+        try:
+            results = {'songs': songs, 'imported': imported,
+                       'journal_mode': journal, 'populate': populate}
+
+            deadline = time.time() + duration
+            results['idle'] = yield measureListings(
+                library, songs, lambda: time.time() >= deadline)
+
+            revision = library.revision
+            importing = bulkImport(library, songs, imported)
+            results['importing'] = yield measureListings(
+                library, songs, lambda: importing.called)
+            elapsed = yield importing
+            results['import'] = {
+                'elapsed': elapsed,
+                'songs_per_sec': imported / max(elapsed, 0.001),
+                'revisions': library.revision - revision,
+            }
+            returnValue(results)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return _run()
+
+def run(songs, imported, duration):
+    """Run the benchmark and return its results."""
+    from twisted.internet import reactor
+    from twisted.internet.defer import inlineCallbacks
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+    }
+
+    failures = []
+
+    @inlineCallbacks
+    def _run():
+        try:
+            result = yield benchmark(songs, imported, duration)
+            results.update(result)
+        except Exception:
+            from twisted.python.failure import Failure
+            failures.append(Failure())
+        reactor.stop()
+
+    reactor.callWhenRunning(_run)
+    reactor.run()
+
+    if failures:
+        failures[0].raiseException()
+    return results
+
+def main(args):
+    parser = OptionParser(usage='%prog [-o FILE] [-s SONGS] [-i SONGS] '
+                                '[-d SECONDS] [-j MODE]')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the JSON results to FILE')
+    parser.add_option('-s', '--songs', type='int', default=100000,
+                      help='songs in the library (default: 100000)')
+    parser.add_option('-i', '--import', dest='imported', type='int',
+                      default=200000, metavar='SONGS',
+                      help='songs to import (default: 200000)')
+    parser.add_option('-d', '--duration', type='float', default=5.0,
+                      help='seconds to measure the idle library '
+                           '(default: 5)')
+    parser.add_option('-j', '--journal', metavar='MODE',
+                      help='use this journal mode instead of WAL')
+    options, args = parser.parse_args(args)
+
+    if options.journal:
+        db.PRAGMAS = tuple([(name, name == 'journal_mode' and
+                                   options.journal or value)
+                            for name, value in db.PRAGMAS])
+
+    results = run(options.songs, options.imported, options.duration)
+
+    if options.output:
+        output = open(options.output, 'w')
+    else:
+        output = sys.stdout
+    try:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,74 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Compare the single-pass DMAP encoder against the original recursive
+serializer using large synthetic ``adbs``/``mlcl`` listings.
+
+Usage: python -m benchmarks.encode [songs ...]
+"""
+
+import struct
+import sys
+import time
+
+from marconi.net.daap import Block, Byte, Int, List, Long, String, encode
+
+def recursiveSerialize(block):
+    """The original recursive Block serializer, kept as a reference."""
+    (code,) = struct.unpack('>i', block.tag)
+    s = struct.pack('>ii', code, block.size)
+    s += block.value.serialize()
+    s += ''.join([recursiveSerialize(child) for child in block.children])
+    return s
+
+def buildListing(count):
+    """Build an ``adbs`` song listing containing ``count`` records."""
+    r = Block('adbs', List())
+    r.add(Block('mstt', Int(200)))
+    r.add(Block('muty', Byte(0)))
+    r.add(Block('mtco', Int(count)))
+    r.add(Block('mrco', Int(count)))
+
+    listing = Block('mlcl', List())
+    for i in xrange(count):
+        song = Block('mlit', List())
+        song.add(Block('mikd', Byte(2)))
+        song.add(Block('miid', Int(i)))
+        song.add(Block('minm', String('Song Title %d' % i)))
+        song.add(Block('mper', Long(i)))
+        song.add(Block('asal', String('Album %d' % (i // 12))))
+        song.add(Block('asar', String('Artist %d' % (i // 120))))
+        listing.add(song)
+    r.add(listing)
+
+    return r
+
+def measure(func, block, repeat=3):
+    """Return the best wall-clock time of ``repeat`` calls to func(block)."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func(block)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run(counts):
+    for count in counts:
+        block = buildListing(count)
+
+        expected = recursiveSerialize(block)
+        if str(encode(block)) != expected:
+            raise AssertionError('Encoder output differs for %d songs' % count)
+
+        recursive = measure(recursiveSerialize, block)
+        single = measure(encode, block)
+        sys.stdout.write('%7d songs %10d bytes  recursive %8.3fs  '
+                         'encode %8.3fs  speedup %5.1fx\n' %
+                         (count, len(expected), recursive, single,
+                          recursive / max(single, 1e-9)))
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000])
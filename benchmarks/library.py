@@ -0,0 +1,234 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Benchmark the DAAP server against synthetic libraries of various sizes.
+For each library size this measures:
+
+- building the ``adbs`` Block tree for every song in the library
+- serializing that tree
+- the peak memory used while doing both
+- the memory used by the library's song catalog
+- end-to-end request latency against an in-process twisted.web Site, both
+  with cold caches and with warm ones
+
+Peak memory is measured with tracemalloc where it is available.  Otherwise
+the process's peak resident set size is reported instead, which can only
+grow from one library size to the next.
+
+Results are written as JSON (to standard output by default) so that runs
+can be compared with one another.
+
+Usage: python -m benchmarks.library [-o FILE] [-r REPEAT] [songs ...]
+"""
+
+import json
+import platform
+import sys
+import time
+from optparse import OptionParser
+
+from benchmarks import synthetic
+from marconi import db
+from marconi.net import daap
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+"""Request paths measured end-to-end."""
+PATHS = (
+    '/server-info',
+    '/databases',
+    '/databases/1/items',
+    '/databases/1/items?meta=dmap.itemid,dmap.itemname,daap.songartist,'
+        'daap.songalbum,daap.songgenre,daap.songtime,daap.songtracknumber',
+)
+
+def _peak():
+    """Return the peak memory figure (in bytes) and how it was measured."""
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[1], 'tracemalloc'
+    import resource
+    # ru_maxrss is measured in kilobytes on Linux (but bytes on OS X).
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss, 'maxrss'
+
+def _best(func, repeat):
+    """Return the result and best wall-clock time of ``repeat`` calls."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+def buildListing(songs, tags=daap.DEFAULT_META):
+    """Build the ``adbs`` response block the server sends for the songs."""
+    r = daap.Block('adbs', daap.List())
+    r.add(daap.Block('mstt', daap.Int(200)))
+    r.add(daap.Block('muty', daap.Byte(0)))
+    r.add(daap.Block('mtco', daap.Int(len(songs))))
+    r.add(daap.Block('mrco', daap.Int(len(songs))))
+    listing = daap.Block('mlcl', daap.List())
+    for song in songs:
+        listing.add(daap.songRecord(song, tags))
+    r.add(listing)
+    return r
+
+def measureEncoding(library, repeat):
+    """Measure Block construction, serialization and peak memory."""
+    songs = library.songs.order_by(daap.Song.id).all()
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+    block, construction = _best(lambda: buildListing(songs), repeat)
+    body, serialization = _best(block.serialize, repeat)
+    peak, method = _peak()
+    if tracemalloc is not None:
+        tracemalloc.stop()
+
+    return {
+        'construction': construction,
+        'serialize': serialization,
+        'bytes': len(body),
+        'peak_memory': peak,
+        'peak_memory_method': method,
+    }
+
+def measureRequests(url, repeat):
+    """
+    Return a Deferred that fires with the cold and warm latencies (the best
+    of ``repeat`` requests) and response size of each path in PATHS.
+    """
+    from twisted.internet.defer import inlineCallbacks, returnValue
+    from twisted.web.client import getPage
+
+    @inlineCallbacks
+    def _measure():
+        # Listings are only served to clients with a session.
+        session = daap.Resource.sessions.create()
+
+        results = {}
+        for path in PATHS:
+            query = '%ssession-id=%d' % ('?' in path and '&' or '?',
+                                         session.id)
+            result = {}
+            for name, clear in (('cold', True), ('warm', False)):
+                best = None
+                for i in xrange(repeat):
+                    if clear:
+                        daap.Resource.records.clear()
+                        daap.Resource.responses.clear()
+                    start = time.time()
+                    body = yield getPage(url + path + query)
+                    elapsed = time.time() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+                result[name] = best
+            result['bytes'] = len(body)
+            results[path] = result
+        returnValue(results)
+
+    return _measure()
+
+def benchmark(count, repeat):
+    """
+    Return a Deferred that fires with the results for a synthetic library of
+    ``count`` songs.  The reactor must be running.
+    """
+    from twisted.internet import reactor
+    from marconi.base import Library
+
+    engine = db.create(':memory:')
+    elapsed = synthetic.populate(engine, count)
+    library = Library(engine, 'Benchmark')
+
+    results = {'songs': count, 'populate': elapsed}
+    results['encoding'] = measureEncoding(library, repeat)
+
+    daap.getService(library, port=0)
+    port = reactor.listenTCP(0, daap.Site(daap.RootResource()),
+                             interface='127.0.0.1')
+    url = 'http://127.0.0.1:%d' % port.getHost().port
+
+    def _done(requests):
+        results['requests'] = requests
+        arrays, strings = library.catalog.footprint()
+        results['catalog'] = {
+            'arrays': arrays,
+            'strings': strings,
+            'bytes_per_song': float(arrays + strings) / max(count, 1),
+        }
+        port.stopListening()
+        return results
+
+    # Requests are measured once the song catalog has been loaded.
+    d = library.catalog.wait(library.revision)
+    d.addCallback(lambda revision: measureRequests(url, repeat))
+    d.addCallback(_done)
+    return d
+
+def run(counts, repeat=3):
+    """Run the benchmarks and return their results."""
+    from twisted.internet import reactor
+    from twisted.internet.defer import inlineCallbacks
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'repeat': repeat,
+        'libraries': [],
+    }
+
+    failures = []
+
+    @inlineCallbacks
+    def _run():
+        try:
+            for count in counts:
+                result = yield benchmark(count, repeat)
+                results['libraries'].append(result)
+                sys.stderr.write('%7d songs done\n' % count)
+        except Exception:
+            from twisted.python.failure import Failure
+            failures.append(Failure())
+        reactor.stop()
+
+    reactor.callWhenRunning(_run)
+    reactor.run()
+
+    if failures:
+        failures[0].raiseException()
+    return results
+
+def main(args):
+    parser = OptionParser(usage='%prog [-o FILE] [-r REPEAT] [songs ...]')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the JSON results to FILE')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='repetitions of each measurement (default: 3)')
+    options, args = parser.parse_args(args)
+
+    counts = [int(arg) for arg in args] or [1000, 10000, 100000, 500000]
+    results = run(counts, options.repeat)
+
+    if options.output:
+        output = open(options.output, 'w')
+    else:
+        output = sys.stdout
+    try:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,579 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Simulate many concurrent DAAP clients against a running server, for
+capacity testing.  Each simulated client repeatedly connects to the shared
+library the way iTunes does, requesting:
+
+    server-info, content-codes, login, update, databases,
+    items (with meta), containers, logout
+
+and occasionally streaming the start of one of the listed songs.  Clients
+pause for a random "think time" between sessions.  Every response is
+decoded with marconi's own DMAP parser and checked (its tag, status and
+record counts), so responses that are malformed under load are counted as
+errors along with failed requests.
+
+All of the clients run in this one process, and each request is made on a
+new connection.  The epoll reactor is used where it is available, and the
+process's file descriptor limit is raised as far as it will go.  Checking
+every record of a large library's listings takes time that the clients
+then don't spend making requests, so by default only a tenth of the
+listings (``--verify``) have every record checked.  Song listings that
+aren't checked only have their counts checked, unless a song is to be
+streamed from them.
+
+Requests made during the ``--ramp`` period, while the clients are starting,
+aren't measured.  The report gives the overall throughput and error rate
+and, for each endpoint, its latency percentiles, throughput and errors by
+kind.  Results are written as JSON (to standard output by default) so that
+runs can be compared with one another.  Note that the songs of synthetic
+libraries can't be streamed, since their files don't exist.
+
+Usage: python -m benchmarks.load [-o FILE] [-c CLIENTS] [-d SECONDS]
+                                 [-r SECONDS] [-t SECONDS] [-s RATE] [URL]
+"""
+
+import json
+import platform
+import random
+import sys
+import time
+import zlib
+from optparse import OptionParser
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.protocol import Protocol
+
+from benchmarks.contention import summarize
+
+"""Endpoints in the order that clients request them."""
+ENDPOINTS = ('server-info', 'content-codes', 'login', 'update', 'databases',
+             'items', 'containers', 'stream', 'logout')
+
+"""The song metadata requested by each items listing."""
+ITEMS_META = ','.join((
+    'dmap.itemkind', 'dmap.itemid', 'dmap.itemname', 'dmap.persistentid',
+    'daap.songalbum', 'daap.songartist', 'daap.songgenre', 'daap.songtime',
+    'daap.songtracknumber', 'daap.songformat',
+))
+
+"""The playlist metadata requested by each containers listing."""
+CONTAINERS_META = ','.join((
+    'dmap.itemid', 'dmap.itemname', 'dmap.persistentid', 'dmap.itemcount',
+    'dmap.parentcontainerid', 'com.apple.itunes.smart-playlist',
+))
+
+"""Headers sent with every request."""
+HEADERS = {
+    'Accept-Encoding':      ['gzip'],
+    'Client-DAAP-Version':  ['3.0'],
+    'User-Agent':           ['marconi-load'],
+}
+
+# The number of bytes requested from the start of a song when streaming it.
+STREAM_BYTES = 256 * 1024
+
+class ResponseError(Exception):
+    """A response with an unexpected status code."""
+
+def errorKind(failure):
+    """Return a short description of the kind of error a failure is."""
+    if failure.check(ResponseError):
+        return str(failure.value)
+    if failure.check(ValueError):
+        return 'invalid'
+    # Failed requests and responses wrap the failures that caused them.
+    reasons = getattr(failure.value, 'reasons', None)
+    if reasons:
+        return reasons[0].type.__name__
+    return failure.type.__name__
+
+#
+# Requests
+#
+
+class BodyReader(Protocol):
+    """Collects a response's body and fires a Deferred with it."""
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        from twisted.web.client import ResponseDone
+        from twisted.web.http import PotentialDataLoss
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(''.join(self.data))
+        else:
+            self.finished.errback(reason)
+
+def fetch(agent, url, headers=None, timeout=60.0):
+    """
+    Request a URL.  Returns a Deferred that fires with the response's status
+    code, its size (as sent) and its decoded body, or fails if there's no
+    complete response within ``timeout`` seconds.
+    """
+    from twisted.internet import reactor
+    from twisted.internet.error import TimeoutError
+    from twisted.web.http_headers import Headers
+
+    result = Deferred()
+
+    def _expire():
+        if not result.called:
+            result.errback(TimeoutError('No response after %gs' % timeout))
+
+    def _response(response):
+        # Twisted 10.2 never finishes delivering an empty body (as sent with
+        # 204 responses, for instance), so those aren't waited for.
+        if response.length == 0:
+            return _received('', response)
+        body = Deferred()
+        response.deliverBody(BodyReader(body))
+        body.addCallback(_received, response)
+        return body
+
+    def _received(body, response):
+        size = len(body)
+        encoding = response.headers.getRawHeaders('Content-Encoding')
+        if encoding and encoding[0] == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return response.code, size, body
+
+    def _finish(value):
+        if timer.active():
+            timer.cancel()
+        if not result.called:
+            if isinstance(value, tuple):
+                result.callback(value)
+            else:
+                result.errback(value)
+
+    requestHeaders = dict(HEADERS)
+    requestHeaders.update(headers or {})
+    timer = reactor.callLater(timeout, _expire)
+    d = agent.request('GET', url, Headers(requestHeaders))
+    d.addCallback(_response)
+    d.addBoth(_finish)
+    return result
+
+#
+# Verification
+#
+# Each of these decodes a response body, checks it and returns whatever the
+# client needs from it.  Invalid responses raise ValueError.
+
+def _decode(body, tag):
+    """Decode a response and check its tag and status."""
+    from marconi.net import daap
+    view = daap.decode(body)
+    if view.tag != tag:
+        raise ValueError("Expected a '%s' response, not '%s'" %
+                         (tag, view.tag))
+    if _value(view, 'mstt') != 200:
+        raise ValueError("'%s' response with status %d" %
+                         (tag, _value(view, 'mstt')))
+    return view
+
+def _value(view, tag):
+    """Return the value of a block's required child."""
+    child = view.find(tag)
+    if child is None:
+        raise ValueError("'%s' block without '%s'" % (view.tag, tag))
+    return child.value
+
+def _counts(view):
+    """Check a listing response's counts and return its returned count."""
+    returned = _value(view, 'mrco')
+    if returned > _value(view, 'mtco'):
+        raise ValueError("'%s' returned more records than it matched" %
+                         view.tag)
+    return returned
+
+def _records(view, verify=True):
+    """
+    Return the records (``mlit`` views) of a listing response, checking
+    that they were all returned.  Unless ``verify`` is false, the contents
+    of every record are checked as well.
+    """
+    returned = _counts(view)
+    listing = view.find('mlcl')
+    records = listing is not None and list(listing) or []
+    if len(records) != returned:
+        raise ValueError("'%s' listed %d records, not %d" %
+                         (view.tag, len(records), returned))
+    if verify:
+        for record in records:
+            if record.tag != 'mlit' or record.find('miid') is None:
+                raise ValueError("Invalid '%s' record" % view.tag)
+    return records
+
+def verifyServerInfo(body, verify=True):
+    view = _decode(body, 'msrv')
+    if _value(view, 'msdc') < 1:
+        raise ValueError('The server has no databases')
+
+def verifyContentCodes(body, verify=True):
+    view = _decode(body, 'mccr')
+    codes = [code for code in view if code.tag == 'mdcl']
+    if not codes:
+        raise ValueError('No content codes')
+    if verify:
+        for code in codes:
+            for tag in ('mcnm', 'mcna', 'mcty'):
+                _value(code, tag)
+
+def verifyLogin(body, verify=True):
+    """Return the new session's id."""
+    return _value(_decode(body, 'mlog'), 'mlid')
+
+def verifyUpdate(body, verify=True):
+    """Return the server's revision."""
+    return _value(_decode(body, 'mupd'), 'musr')
+
+def verifyDatabases(body, verify=True):
+    """Return the id of the first database."""
+    records = _records(_decode(body, 'avdb'), verify)
+    if not records:
+        raise ValueError('No databases')
+    return _value(records[0], 'miid')
+
+def verifyItems(body, verify=True, pick=True):
+    """
+    Return the id and format of a random song, or None if there are none.
+    Songs are only listed if they are to be verified or ``pick`` is true;
+    otherwise only the response's counts are checked, and None is returned.
+    """
+    view = _decode(body, 'adbs')
+    if not verify and not pick:
+        _counts(view)
+        return None
+    records = _records(view, verify)
+    if not records:
+        return None
+    record = random.choice(records)
+    format = record.find('asfm')
+    return _value(record, 'miid'), format and format.value or 'mp3'
+
+def verifyContainers(body, verify=True):
+    _records(_decode(body, 'aply'), verify)
+
+#
+# Clients
+#
+
+class Stats(object):
+    """
+    The latencies, errors and response sizes of every endpoint's requests,
+    and the number of client sessions that completed or failed.  Requests
+    that begin before ``start`` (a time) aren't measured.
+    """
+
+    def __init__(self, start=0):
+        self.start = start
+        self.latencies = dict([(name, []) for name in ENDPOINTS])
+        self.errors = dict([(name, {}) for name in ENDPOINTS])
+        self.bytes = dict.fromkeys(ENDPOINTS, 0)
+        self.sessions = {'completed': 0, 'failed': 0}
+
+    def succeeded(self, endpoint, began, elapsed, size):
+        if began >= self.start:
+            self.latencies[endpoint].append(elapsed)
+            self.bytes[endpoint] += size
+
+    def failed(self, endpoint, began, kind):
+        if began >= self.start:
+            errors = self.errors[endpoint]
+            errors[kind] = errors.get(kind, 0) + 1
+
+    def session(self, began, completed):
+        if began >= self.start:
+            self.sessions[completed and 'completed' or 'failed'] += 1
+
+    def report(self, elapsed):
+        """Summarize the measurements taken over ``elapsed`` seconds."""
+        elapsed = max(elapsed, 0.001)
+        endpoints = {}
+        requests = errors = 0
+        for name in ENDPOINTS:
+            latencies = self.latencies[name]
+            failed = sum(self.errors[name].itervalues())
+            total = len(latencies) + failed
+            if not total:
+                continue
+            result = summarize(latencies, failed)
+            result['error_kinds'] = self.errors[name]
+            result['error_rate'] = float(failed) / total
+            result['requests_per_sec'] = total / elapsed
+            result['bytes'] = self.bytes[name]
+            endpoints[name] = result
+            requests += total
+            errors += failed
+        return {
+            'elapsed': elapsed,
+            'requests': requests,
+            'errors': errors,
+            'requests_per_sec': requests / elapsed,
+            'error_rate': float(errors) / max(requests, 1),
+            'sessions': self.sessions,
+            'endpoints': endpoints,
+        }
+
+class Client(object):
+    """
+    A simulated client of the server at ``url``.  Between sessions, the
+    client thinks for an exponentially-distributed time averaging ``think``
+    seconds.  ``streams`` is the probability that a session streams a song,
+    and ``verify`` the probability that its listings are checked in full.
+    """
+
+    def __init__(self, agent, url, stats, think=5.0, streams=0.1,
+                 verify=0.1, timeout=60.0):
+        self.agent = agent
+        self.url = url.rstrip('/')
+        self.stats = stats
+        self.think = think
+        self.streams = streams
+        self.verify = verify
+        self.timeout = timeout
+
+    def get(self, endpoint, path, check=None, headers=None, codes=(200,)):
+        """
+        Request a path and record the result for the endpoint.  Returns a
+        Deferred that fires with what ``check`` (a verify function) returns
+        for the response body.
+        """
+        began = time.time()
+
+        def _received((code, size, body)):
+            elapsed = time.time() - began
+            if code not in codes:
+                raise ResponseError('http %d' % code)
+            result = None
+            if check is not None:
+                result = check(body, random.random() < self.verify)
+            self.stats.succeeded(endpoint, began, elapsed, size)
+            return result
+
+        def _failed(failure):
+            self.stats.failed(endpoint, began, errorKind(failure))
+            return failure
+
+        d = fetch(self.agent, self.url + path, headers, self.timeout)
+        d.addCallback(_received)
+        d.addErrback(_failed)
+        return d
+
+    @inlineCallbacks
+    def session(self):
+        """Connect to the library and fetch its listings, then log out."""
+        yield self.get('server-info', '/server-info', verifyServerInfo)
+        yield self.get('content-codes', '/content-codes', verifyContentCodes)
+        id = yield self.get('login', '/login', verifyLogin)
+        query = 'session-id=%d' % id
+        try:
+            revision = yield self.get('update', '/update?' + query,
+                                      verifyUpdate)
+            query += '&revision-number=%d' % revision
+            database = yield self.get('databases', '/databases?' + query,
+                                      verifyDatabases)
+            # Large listings are only walked if a song is to be picked
+            # from them.
+            stream = random.random() < self.streams
+            song = yield self.get('items',
+                '/databases/%d/items?type=music&meta=%s&delta=0&%s' %
+                (database, ITEMS_META, query),
+                lambda body, verify: verifyItems(body, verify, stream))
+            yield self.get('containers',
+                '/databases/%d/containers?meta=%s&delta=0&%s' %
+                (database, CONTAINERS_META, query), verifyContainers)
+            if stream and song is not None:
+                path = '/databases/%d/items/%d.%s?session-id=%d' % (
+                    database, song[0], song[1], id)
+                headers = {'Range': ['bytes=0-%d' % (STREAM_BYTES - 1)]}
+                yield self.get('stream', path, headers=headers,
+                               codes=(200, 206))
+        finally:
+            # Sessions are logged out even if they fail, as long as the
+            # server is still answering.
+            d = self.get('logout', '/logout?session-id=%d' % id, codes=(204,))
+            d.addErrback(lambda failure: None)
+            yield d
+
+    @inlineCallbacks
+    def run(self, deadline):
+        """Run sessions until the deadline (a time) has passed."""
+        from twisted.internet import reactor
+        from twisted.internet.task import deferLater
+
+        while time.time() < deadline:
+            began = time.time()
+            try:
+                yield self.session()
+            except Exception:
+                self.stats.session(began, False)
+            else:
+                self.stats.session(began, True)
+            if self.think > 0:
+                delay = random.expovariate(1.0 / self.think)
+                delay = min(delay, max(deadline - time.time(), 0))
+                yield deferLater(reactor, delay, lambda: None)
+
+def benchmark(url, clients, duration, ramp=10.0, think=5.0, streams=0.1,
+              verify=0.1, timeout=60.0):
+    """
+    Return a Deferred that fires with the results of running ``clients``
+    clients against the server at ``url``.  Clients are started evenly over
+    ``ramp`` seconds, after which they are measured for ``duration``
+    seconds.  The reactor must be running.
+    """
+    from twisted.internet import reactor
+    from twisted.internet.defer import DeferredList
+    from twisted.internet.task import deferLater
+    from twisted.web.client import Agent
+
+    agent = Agent(reactor)
+    start = time.time() + ramp
+    deadline = start + duration
+    stats = Stats(start)
+
+    def _start(client):
+        d = client.run(deadline)
+        d.addErrback(lambda failure: None)
+        return d
+
+    running = []
+    for i in xrange(clients):
+        client = Client(agent, url, stats, think, streams, verify, timeout)
+        running.append(deferLater(reactor, ramp * i / clients, _start,
+                                  client))
+
+    @inlineCallbacks
+    def _run():
+        yield DeferredList(running)
+        # Sessions still in progress at the deadline are left to finish,
+        # and they count towards the elapsed time.
+        results = {
+            'url': url,
+            'clients': clients,
+            'duration': duration,
+            'ramp': ramp,
+            'think': think,
+            'streams': streams,
+            'verify': verify,
+        }
+        results.update(stats.report(time.time() - start))
+        returnValue(results)
+
+    return _run()
+
+def run(url, clients, duration, **kwargs):
+    """Run the load generator and return its results."""
+    from twisted.internet import reactor
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'reactor': reactor.__class__.__name__,
+        'time': time.time(),
+    }
+
+    failures = []
+
+    @inlineCallbacks
+    def _run():
+        try:
+            result = yield benchmark(url, clients, duration, **kwargs)
+            results.update(result)
+        except Exception:
+            from twisted.python.failure import Failure
+            failures.append(Failure())
+        reactor.stop()
+
+    reactor.callWhenRunning(_run)
+    reactor.run()
+
+    if failures:
+        failures[0].raiseException()
+    return results
+
+def _installReactor():
+    """Install the epoll reactor, if it's available."""
+    try:
+        from twisted.internet import epollreactor
+    except ImportError:
+        return
+    epollreactor.install()
+
+def _raiseFileLimit():
+    """Raise the file descriptor limit as far as it will go."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = max(soft, 65536)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, resource.error):
+            pass
+
+def main(args):
+    parser = OptionParser(usage='%prog [-o FILE] [-c CLIENTS] [-d SECONDS] '
+                                '[-r SECONDS] [-t SECONDS] [-s RATE] [URL]')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the JSON results to FILE')
+    parser.add_option('-c', '--clients', type='int', default=1000,
+                      help='concurrent clients (default: 1000)')
+    parser.add_option('-d', '--duration', type='float', default=60.0,
+                      help='seconds to measure the clients (default: 60)')
+    parser.add_option('-r', '--ramp', type='float', default=10.0,
+                      help='seconds over which to start the clients '
+                           '(default: 10)')
+    parser.add_option('-t', '--think', type='float', default=5.0,
+                      help="clients' mean pause between sessions "
+                           "(default: 5)")
+    parser.add_option('-s', '--streams', type='float', default=0.1,
+                      metavar='RATE',
+                      help='fraction of sessions that stream a song '
+                           '(default: 0.1)')
+    parser.add_option('-v', '--verify', type='float', default=0.1,
+                      metavar='RATE',
+                      help='fraction of listings to check in full '
+                           '(default: 0.1)')
+    parser.add_option('--timeout', type='float', default=60.0,
+                      help='seconds to wait for each response (default: 60)')
+    options, args = parser.parse_args(args)
+
+    if len(args) > 1:
+        parser.error('Only one server URL may be given')
+    url = args and args[0] or 'http://127.0.0.1:3689'
+    if options.clients < 1:
+        parser.error('There must be at least one client')
+
+    _installReactor()
+    _raiseFileLimit()
+    results = run(url, options.clients, options.duration,
+                  ramp=options.ramp, think=options.think,
+                  streams=options.streams, verify=options.verify,
+                  timeout=options.timeout)
+
+    if options.output:
+        output = open(options.output, 'w')
+    else:
+        output = sys.stdout
+    try:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,72 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Synthetic libraries for benchmarking.  Songs are spread across artists,
+albums, genres and composers in roughly the proportions of a real music
+collection, and are written using the same batched statements as the
+scanner so that even very large libraries are created quickly.
+"""
+
+import time
+
+from marconi import db
+
+"""Genre names assigned to synthetic songs (in rotation)."""
+GENRES = (u'Alternative', u'Blues', u'Classical', u'Country', u'Electronic',
+          u'Folk', u'Hip-Hop', u'Jazz', u'Metal', u'Pop', u'Punk', u'R&B',
+          u'Reggae', u'Rock', u'Soundtrack', u'World')
+
+def song(i):
+    """Return the Song column values for the i-th synthetic song."""
+    album = i // 12
+    artist = album // 10
+    return {
+        'path': u'/music/Artist %d/Album %d/%02d Song %d.mp3' %
+                (artist, album, i % 12 + 1, i),
+        'title': u'Song Title %d' % i,
+        'album': u'Album %d' % album,
+        'artist': u'Artist %d' % artist,
+        'bitrate': 256,
+        'composer': u'Composer %d' % (i // 37),
+        'dateadded': 1230768000 + i,
+        'datemodified': 1230768000 + i,
+        'disccount': 1,
+        'discnumber': 1,
+        'format': u'mp3',
+        'genre': GENRES[artist % len(GENRES)],
+        'samplerate': 44100,
+        'size': 4000000 + (i * 7919) % 6000000,
+        'time': 120000 + (i * 104729) % 300000,
+        'trackcount': 12,
+        'tracknumber': i % 12 + 1,
+        'year': 1960 + artist % 50,
+        'mtime': 1230768000.0 + i,
+        'inode': 100000 + i,
+    }
+
+def populate(engine, count, batchSize=10000):
+    """
+    Add ``count`` synthetic songs and a single playlist to the database.
+    Returns the time taken, in seconds.
+    """
+    start = time.time()
+    insert = db.Song.__table__.insert()
+    connection = engine.connect()
+    try:
+        transaction = connection.begin()
+        connection.execute(db.Playlist.__table__.insert(),
+                           [{'name': u'Library'}])
+        for first in xrange(0, count, batchSize):
+            last = min(first + batchSize, count)
+            connection.execute(insert, [song(i) for i in xrange(first, last)])
+        transaction.commit()
+    finally:
+        connection.close()
+    return time.time() - start
+
+def create(count):
+    """Return a new memory-based database engine holding ``count`` songs."""
+    engine = db.create(':memory:')
+    populate(engine, count)
+    return engine
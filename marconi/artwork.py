@@ -0,0 +1,334 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Album artwork.  Cover images are extracted from the tags of the audio files
+themselves, which means reading (and parsing) part of an audio file, so each
+image is only ever extracted once: per album, or per file for songs without
+an album.
+
+Extracted images are stored in a content-addressed cache on disk, named by
+the SHA-1 digest of their contents, so an image shared by several albums is
+only stored once.  Which image belongs to which album is recorded in the
+``artwork`` table along with the modification time of the file it was
+extracted from, as tracked by the scanner.  An entry is discarded as soon as
+that file's song changes (or, across restarts, if its recorded modification
+time no longer matches).  Recently served images are also kept in a
+size-bounded, least-recently-used cache in memory.
+"""
+
+import errno
+import hashlib
+import os
+import sys
+from collections import OrderedDict
+from sqlalchemy import select
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+from marconi.db import Artwork, Song
+
+"""Image content types mapped to the file extensions used on disk."""
+EXTENSIONS = {
+    'image/jpeg':   '.jpg',
+    'image/png':    '.png',
+    'image/gif':    '.gif',
+}
+
+def imageType(data):
+    """Return the content type of the given image data, or None."""
+    if data.startswith('\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith('\x89PNG'):
+        return 'image/png'
+    if data.startswith('GIF8'):
+        return 'image/gif'
+    return None
+
+def _pictures(audio):
+    """Yield (picture type, data) for each image embedded in a file."""
+    # FLAC picture blocks.
+    for picture in getattr(audio, 'pictures', None) or ():
+        yield picture.type, picture.data
+
+    tags = audio.tags
+    if tags is None:
+        return
+
+    if hasattr(tags, 'getall'):
+        # ID3 attached pictures.
+        for frame in tags.getall('APIC'):
+            yield frame.type, frame.data
+    elif hasattr(tags, 'get'):
+        # MP4 cover atoms.
+        for cover in tags.get('covr') or ():
+            yield 3, str(cover)
+        # Vorbis comment pictures.
+        from base64 import b64decode
+        from mutagen.flac import Picture
+        for value in tags.get('metadata_block_picture') or ():
+            try:
+                picture = Picture(b64decode(value))
+            except Exception:
+                continue
+            yield picture.type, picture.data
+
+def extract(path):
+    """
+    Return (data, content type) for the cover image embedded in the audio
+    file at the given path, or None if it doesn't have one.  Front covers are
+    preferred over any other kind of picture.
+    """
+    import mutagen
+
+    try:
+        audio = mutagen.File(path)
+    except Exception:
+        return None
+    if audio is None:
+        return None
+
+    best = None
+    for kind, data in _pictures(audio):
+        type = imageType(data)
+        if type is None:
+            continue
+        # Picture type 3 is the front cover.
+        if kind == 3:
+            return data, type
+        if best is None:
+            best = data, type
+    return best
+
+def artworkKey(song):
+    """Return the key under which a song's artwork is cached."""
+    if song.album:
+        return u'album:%s:%s' % (song.artist or u'', song.album)
+    return u'song:%d' % (song.id,)
+
+class Image(object):
+    """
+    An image in the cache.  ``data`` holds the image if it is in memory;
+    otherwise it is read from the file at ``path``.
+    """
+
+    __slots__ = ('digest', 'type', 'data', 'path')
+
+    def __init__(self, digest, type, data=None, path=None):
+        self.digest = digest
+        self.type = type
+        self.data = data
+        self.path = path
+
+class ArtworkCache(object):
+    """
+    The artwork of a library's songs.  Images are stored beneath the given
+    ``directory`` (or only kept in memory if it is None), and up to
+    ``maxsize`` bytes of them are kept in memory.
+    """
+
+    def __init__(self, library, directory=None, maxsize=32 * 1024 * 1024):
+        self.library = library
+        self.directory = directory
+        self.maxsize = maxsize
+        self.entries = {}
+        self.sources = {}
+        self.images = OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+        library.observe(self._changed)
+
+    def load(self):
+        """
+        Load the cached entries, discarding those whose files have changed
+        since their images were extracted.  Returns a Deferred.
+        """
+        def _load(session):
+            table = Artwork.__table__
+            query = select([table.c.key, table.c.song_id, table.c.digest,
+                            table.c.type, table.c.mtime, Song.mtime],
+                           from_obj=[table.outerjoin(Song.__table__,
+                                     Song.id == table.c.song_id)])
+            entries = []
+            stale = []
+            for row in session.execute(query):
+                key, id, digest, type, mtime, current = row
+                if current is None or current != mtime:
+                    stale.append(key)
+                else:
+                    entries.append((key, id, digest, type))
+            if not self.library.readonly:
+                for i in xrange(0, len(stale), 500):
+                    session.execute(table.delete(table.c.key.in_(
+                        stale[i:i + 500])))
+            return entries
+
+        def _loaded(entries):
+            for key, id, digest, type in entries:
+                self._add(key, id, digest and str(digest), type and str(type))
+
+        # Stale entries are deleted as they are found, if we can.
+        if self.library.readonly:
+            d = self.library.run(_load)
+        else:
+            d = self.library.write(_load)
+        d.addCallback(_loaded)
+        return d
+
+    def get(self, song):
+        """
+        Return a Deferred that fires with the Image for the given song's
+        artwork, or with None if it doesn't have any.
+        """
+        key = artworkKey(song)
+        entry = self.entries.get(key)
+        if entry is not None:
+            id, digest, type = entry
+            if digest is None:
+                self.hits += 1
+                return succeed(None)
+            data = self.images.pop(digest, None)
+            if data is not None:
+                self.hits += 1
+                self.images[digest] = data
+                return succeed(Image(digest, type, data))
+            if self.directory is not None:
+                self.hits += 1
+                return succeed(Image(digest, type, path=self._path(digest,
+                                                                   type)))
+
+        # Concurrent requests for the same artwork share a single extraction.
+        self.misses += 1
+        waiters = self.pending.get(key)
+        if waiters is None:
+            waiters = self.pending[key] = []
+            self._extract(key, song)
+        d = Deferred()
+        waiters.append(d)
+        return d
+
+    def forget(self, song):
+        """
+        Forget the given song's artwork, such as when its image has gone
+        missing from the disk cache, so that it is extracted again.
+        """
+        entry = self.entries.pop(artworkKey(song), None)
+        if entry is not None:
+            self.sources.get(entry[0], set()).discard(artworkKey(song))
+
+    def promote(self, image):
+        """
+        Read an image that was served from the disk cache into memory (in a
+        thread), since it is likely to be requested again.
+        """
+        def _read():
+            with open(image.path, 'rb') as f:
+                return f.read()
+
+        d = deferToThread(_read)
+        d.addCallback(lambda data: self._remember(image.digest, data))
+        d.addErrback(lambda failure: None)
+
+    def _path(self, digest, type):
+        return os.path.join(self.directory, digest[:2],
+                            digest + EXTENSIONS.get(type, ''))
+
+    def _add(self, key, id, digest, type):
+        self.entries[key] = (id, digest, type)
+        self.sources.setdefault(id, set()).add(key)
+
+    def _remember(self, digest, data):
+        if digest in self.images or len(data) > self.maxsize // 4:
+            return
+        self.images[digest] = data
+        self.size += len(data)
+        while self.size > self.maxsize:
+            digest, data = self.images.popitem(last=False)
+            self.size -= len(data)
+
+    def _extract(self, key, song):
+        path = song.path.encode(sys.getfilesystemencoding() or 'utf-8')
+        id, mtime = song.id, song.mtime
+
+        def _store(result):
+            # This runs in a thread: the image is written to the disk cache
+            # (unless an identical image is already there).
+            if result is None:
+                return None
+            data, type = result
+            digest = hashlib.sha1(data).hexdigest()
+            if self.directory is not None:
+                target = self._path(digest, type)
+                if not os.path.exists(target):
+                    try:
+                        os.makedirs(os.path.dirname(target))
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                    temp = '%s.%d.tmp' % (target, os.getpid())
+                    with open(temp, 'wb') as f:
+                        f.write(data)
+                    os.rename(temp, target)
+            return digest, type, data
+
+        def _record(session, digest, type):
+            table = Artwork.__table__
+            session.execute(table.delete(table.c.key == key))
+            session.execute(table.insert(), {
+                'key': key, 'song_id': id, 'mtime': mtime,
+                'digest': digest and unicode(digest),
+                'type': type and unicode(type)})
+
+        def _extracted(result):
+            image = None
+            digest = type = None
+            if result is not None:
+                digest, type, data = result
+                self._remember(digest, data)
+                image = Image(digest, type, data)
+            self._add(key, id, digest, type)
+            # Read-only libraries share the disk cache, but only the
+            # library's writer records its entries.
+            if not self.library.readonly:
+                d = self.library.write(_record, digest, type)
+                d.addErrback(log.err,
+                             'Failed to record artwork for %r' % (key,))
+            return image
+
+        def _failed(failure):
+            log.err(failure, 'Failed to extract artwork from %r' % (path,))
+            return None
+
+        def _done(image):
+            for d in self.pending.pop(key, ()):
+                d.callback(image)
+
+        d = deferToThread(lambda: _store(extract(path)))
+        d.addCallbacks(_extracted, _failed)
+        d.addCallback(_done)
+
+    def _changed(self, changes):
+        # The scanner only rewrites a song when its file has changed, which
+        # invalidates any artwork that was extracted from it.
+        keys = []
+        for cls, id in changes:
+            if cls is Song and id in self.sources:
+                keys.extend(self.sources.pop(id))
+        if not keys:
+            return
+        for key in keys:
+            self.entries.pop(key, None)
+        if self.library.readonly:
+            return
+
+        def _delete(session):
+            table = Artwork.__table__
+            for i in xrange(0, len(keys), 500):
+                session.execute(table.delete(table.c.key.in_(
+                    keys[i:i + 500])))
+        d = self.library.write(_delete)
+        d.addErrback(log.err, 'Failed to discard changed artwork')
@@ -1,25 +1,555 @@
 # Marconi Media Server
 # Copyright 2009 Jon Parise <jon@indelible.org>
 
-from marconi.db import Playlist, Session, Song
+import time
+from array import array
+from collections import OrderedDict
+from operator import attrgetter
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log, threadable
+from twisted.python.threadpool import ThreadPool
+from marconi.db import Playlist, PlaylistSong, Song, changes, \
+                       listingReader, reader
+from marconi.listing import SongListing
+from marconi.writer import Writer
+
+# The most memory (in bytes) that memoized query results may occupy.
+MEMO_SIZE = 16 * 1024 * 1024
+
+def _footprint(result):
+    """Return the size (in bytes) of a memoized array, or tuple of them."""
+    if isinstance(result, tuple):
+        return sum([_footprint(value) for value in result])
+    return len(result) * result.itemsize
 
 class Library(object):
+    """
+    A library of songs and playlists.
+
+    Database queries are run on a bounded pool of worker threads so that a
+    slow query never blocks the reactor.  Each worker thread has its own
+    session (and therefore its own pooled connection), which is reused from
+    one unit of work to the next.  Those connections are read-only: all of
+    the library's modifications are made by a single Writer thread, which
+    batches them into shared transactions.  The asynchronous methods below
+    return Deferreds that fire in the reactor thread.
+
+    Every revision of the library is recorded in its ChangeLog, so that
+    clients can be sent just the changes made since an earlier revision.
+
+    A ``readonly`` library never writes to its database; some other process
+    makes (and logs) the changes and passes them to advance().
+
+    A ``snapshot`` that was saved of the database as it is now is kept as
+    ``snapshot``, and the catalog is restored from it.
+
+    Unless ``catalog`` is false, the library also keeps an in-memory Catalog
+    of its songs.  Song listings are read from the catalog whenever it is up
+    to date, in which case they are returned as catalog Rows rather than
+    Song objects.
+    """
+
+    def __init__(self, db, name, threads=4, catalog=True, readonly=False,
+                 snapshot=None):
+        from twisted.internet import reactor
 
-    def __init__(self, db, name):
         self.db = db
         self.name = name
+        self.readonly = readonly
+        self.waiters = []
+        self.observers = []
+        self.metrics = None
+        self.memo = OrderedDict()
+        self.memoSize = 0
+
+        self.reactor = reactor
+        # Objects loaded by the database threads are handed back to the
+        # reactor thread, so their attributes mustn't expire on commit.
+        readers = readonly and db or reader(db)
+        self.sessions = scoped_session(sessionmaker(
+            bind=readers, extension=changes, expire_on_commit=False))
+        # Listings hold their transactions open on connections of their own.
+        self.listings = listingReader(db)
+
+        # Memory-based databases share a single connection, so only allow a
+        # single thread to use it at a time, and that thread makes the
+        # library's modifications as well.  Read-only libraries don't make
+        # any.
+        self.writer = None
+        if db.url.database in (None, '', ':memory:'):
+            threads = 1
+        elif not readonly:
+            self.writer = Writer(reactor, scoped_session(sessionmaker(
+                bind=db, extension=changes, expire_on_commit=False)))
+        self.threadpool = ThreadPool(1, threads, 'marconi-db')
+        self.running = False
+        self.startID = reactor.callWhenRunning(self._start)
+
+        changes.subscribe(self._notify)
+
+        # Revisions continue from the last one recorded in the change log.
+        from marconi.changelog import ChangeLog
+        self.changelog = ChangeLog(self)
+        self.revision = self.changelog.revision
+
+        # A snapshot saved by an earlier server of the database as it is now
+        # spares us from loading the catalog (and the server's caches) from
+        # scratch.
+        if snapshot is not None and not snapshot.matches(db):
+            log.msg('Ignoring stale snapshot %s' % (snapshot.path,))
+            snapshot = None
+        self.snapshot = snapshot
+
+        self.catalog = None
+        if catalog:
+            from marconi.catalog import Catalog
+            self.catalog = Catalog(self)
+            if snapshot is not None:
+                snapshot.restore('catalog', self.catalog)
+            self.catalog.load()
 
     def __repr__(self):
         return "<Library('%s', %s)>" % (self.name, self.db)
 
+    def _start(self):
+        self.startID = None
+        if not self.running:
+            self.threadpool.start()
+            if self.writer is not None:
+                self.writer.start()
+            self.shutdownID = self.reactor.addSystemEventTrigger(
+                'during', 'shutdown', self._stop)
+            self.running = True
+
+    def _stop(self):
+        self.shutdownID = None
+        self.threadpool.stop()
+        if self.writer is not None:
+            self.writer.stop()
+        self.running = False
+
     @property
     def songs(self):
         """Return a Query object for the library's songs."""
-        session = Session(bind=self.db)
-        return session.query(Song)
+        return self.sessions().query(Song)
 
     @property
     def playlists(self):
         """Return a Query object for the library's playlists."""
-        session = Session(bind=self.db)
-        return session.query(Playlist)
+        return self.sessions().query(Playlist)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call ``func(session, *args, **kwargs)`` in a database thread using
+        that thread's session.  The session is committed if the function
+        returns normally and rolled back if it raises an exception.  Returns
+        a Deferred that fires with the function's result.
+        """
+        d = deferToThreadPool(self.reactor, self.threadpool,
+                              self._run, func, args, kwargs)
+        d.addCallback(self._finished)
+        return d
+
+    def write(self, func, *args, **kwargs):
+        """
+        Like run(), but for functions that modify the database.  They are
+        called by the library's writer thread, possibly in a transaction
+        shared with other writes, and the Deferred fires once that has been
+        committed.  Writes beyond those that the writer has room for wait
+        their turn without blocking the reactor.
+        """
+        if self.writer is None:
+            return self.run(func, *args, **kwargs)
+        d = self.writer.write(func, args, kwargs)
+        d.addCallback(self._finished)
+        return d
+
+    def read(self, func, *args, **kwargs):
+        """
+        Like run(), but every query that ``func`` makes reads from the same
+        consistent snapshot of the database, even while the writer commits
+        other changes.
+        """
+        return self.run(self._read, func, args, kwargs)
+
+    def _read(self, session, func, args, kwargs):
+        # pysqlite only begins transactions before modifications, so one is
+        # begun explicitly.  It holds its snapshot (of the write-ahead log)
+        # until it is committed.
+        session.execute('BEGIN')
+        return func(session, *args, **kwargs)
+
+    def _run(self, func, args, kwargs):
+        session = self.sessions()
+        start = time.time()
+        try:
+            result = func(session, *args, **kwargs)
+            session.commit()
+            return result, time.time() - start
+        except:
+            session.rollback()
+            raise
+        finally:
+            # Detach the results so they can be used from the reactor
+            # thread.  Their loaded attributes remain available.
+            session.expunge_all()
+            session.close()
+
+    def _finished(self, result):
+        # Query times are measured in the database thread but recorded here,
+        # in the reactor thread, so that the metrics never need locking.
+        result, elapsed = result
+        if self.metrics is not None:
+            self.metrics.query(elapsed)
+        return result
+
+    def _current(self):
+        return self.catalog is not None and self.catalog.current
+
+    def _memoize(self, key, func, *args):
+        """
+        Return a Deferred that fires with the result of ``self.run(func,
+        *args)``, which must be an array (or a tuple of them).  Results are
+        cached under the given key (unless it is None) until the library's
+        revision changes.  The least recently used results are discarded
+        once they occupy more than MEMO_SIZE bytes.
+        """
+        if key is not None and key in self.memo:
+            result, size = self.memo.pop(key)
+            self.memo[key] = (result, size)
+            return succeed(result)
+
+        revision = self.revision
+
+        def _store(result):
+            if key is not None and self.revision == revision:
+                self._remember(key, result)
+            return result
+
+        d = self.run(func, *args)
+        d.addCallback(_store)
+        return d
+
+    def _remember(self, key, result):
+        if key in self.memo:
+            self.memoSize -= self.memo.pop(key)[1]
+        size = _footprint(result)
+        if size > MEMO_SIZE:
+            return
+        self.memo[key] = (result, size)
+        self.memoSize += size
+        while self.memoSize > MEMO_SIZE:
+            key, (result, size) = self.memo.popitem(last=False)
+            self.memoSize -= size
+
+    def _forget(self):
+        self.memo.clear()
+        self.memoSize = 0
+
+    def getSongIds(self, clause=None, key=None):
+        """
+        Return a Deferred that fires with the ordered array of the ids of the
+        songs (matching the given SQL clause, if any).  The array must not
+        be modified.  The ids are cached until the library changes; filtered
+        ids are only cached if a ``key`` identifying the clause is given.
+        """
+        if clause is None:
+            if self._current():
+                return succeed(self.catalog.ids)
+            key = ''
+
+        def _query(session):
+            query = select([Song.id], clause).order_by(Song.id)
+            return array('i', [id for (id,) in session.execute(query)])
+        return self._memoize(key is not None and ('ids', key) or None,
+                             _query)
+
+    def getPlaylistIds(self):
+        """
+        Return a Deferred that fires with the ordered array of the ids of the
+        playlists.  The array must not be modified.  It is cached until the
+        library changes.
+        """
+        def _query(session):
+            query = select([Playlist.id]).order_by(Playlist.id)
+            return array('i', [id for (id,) in session.execute(query)])
+        return self._memoize(('playlist-ids',), _query)
+
+    def getSong(self, id):
+        """Return a Deferred that fires with the given song (or None)."""
+        return self.run(lambda session: session.query(Song).get(id))
+
+    def getSongs(self, after=0, limit=1000, clause=None):
+        """
+        Return a Deferred that fires with up to ``limit`` songs whose ids
+        follow ``after``, ordered by id.  Only songs matching the given SQL
+        clause are returned, if one is given.
+        """
+        if self._current():
+            if clause is None:
+                return succeed(self.catalog.songs(after, limit))
+            # Only the matching ids are read from the database.
+            def _ids(session):
+                query = select([Song.id], and_(Song.id > after, clause))
+                query = query.order_by(Song.id).limit(limit)
+                return [id for (id,) in session.execute(query)]
+            d = self.run(_ids)
+            d.addCallback(self.catalog.lookup)
+            return d
+
+        def _query(session):
+            query = session.query(Song).filter(Song.id > after)
+            if clause is not None:
+                query = query.filter(clause)
+            return query.order_by(Song.id).limit(limit).all()
+        return self.run(_query)
+
+    def _playlistCounts(self, session):
+        table = PlaylistSong.__table__
+        query = select([table.c.playlist_id, func.count(table.c.id)],
+                       table.c.song_id == Song.id,
+                       group_by=[table.c.playlist_id])
+        return dict(session.execute(query).fetchall())
+
+    def getPlaylistEntries(self, id):
+        """
+        Return a Deferred that fires with the given playlist's songs, in
+        order, as parallel sequences of entry (PlaylistSong) ids and song
+        ids.  Entries whose songs no longer exist are skipped.  The playlist
+        is read with a single query, in position index order, and cached
+        until the library changes.  The sequences must not be modified.
+        """
+        def _query(session):
+            table = PlaylistSong.__table__
+            query = select([table.c.id, table.c.song_id],
+                           and_(table.c.playlist_id == id,
+                                table.c.song_id == Song.id),
+                           order_by=[table.c.position, table.c.id])
+            entries = array('i')
+            songs = array('i')
+            for entry, song in session.execute(query):
+                entries.append(entry)
+                songs.append(song)
+            return entries, songs
+        return self._memoize(('playlist', id), _query)
+
+    def readSongs(self, encode, ids=None, clause=None):
+        """
+        Return a Deferred that fires with the list of ``encode(song)`` for
+        each song, in id order.  Only the songs with the given (ordered) ids
+        that still exist, or those matching the given SQL clause, are read if
+        either is given.  The songs are all read from a single revision of
+        the library: from the catalog if it is up to date (in which case
+        ``encode`` is called immediately), and otherwise in a single read
+        transaction (in which case it is called in a database thread).
+        """
+        if clause is None and self._current():
+            if ids is None:
+                rows = self.catalog.songs(0, len(self.catalog))
+            else:
+                rows = self.catalog.lookup(ids)
+            return succeed([encode(row) for row in rows])
+
+        def _query(session):
+            records = []
+            if ids is not None:
+                # Stay well below SQLite's limit on bound parameters.
+                for i in xrange(0, len(ids), 500):
+                    chunk = list(ids[i:i + 500])
+                    query = session.query(Song).filter(Song.id.in_(chunk))
+                    records.extend(map(encode, query.order_by(Song.id)))
+                    session.expunge_all()
+                return records
+
+            # The songs are read (and then discarded) in batches.
+            after = 0
+            while True:
+                query = session.query(Song).filter(Song.id > after)
+                if clause is not None:
+                    query = query.filter(clause)
+                songs = query.order_by(Song.id).limit(1000).all()
+                if not songs:
+                    return records
+                records.extend(map(encode, songs))
+                after = songs[-1].id
+                session.expunge_all()
+        return self.read(_query)
+
+    def listSongs(self, encode, size, clause=None, ids=None, entries=None):
+        """
+        Return a Deferred that fires with an open SongListing of the songs
+        with the given ids, or of those matching the given SQL clause (or
+        every song).  Its records are read as they are needed, all from a
+        single revision of the library, and it must be closed once they
+        have been sent.
+        """
+        listing = SongListing(self, encode, size, clause, ids, entries)
+        return listing.open()
+
+    def readPlaylists(self, encode, ids=None, counts=False):
+        """
+        Return a Deferred that fires with the list of ``encode(playlist)``
+        for each playlist (with the given ordered ids that still exist, if
+        any are given), in id order.  If ``counts`` is true, each playlist's
+        number of songs is passed to ``encode`` as well.  The playlists are
+        all read in a single read transaction, and ``encode`` is called in a
+        database thread.
+        """
+        def _query(session):
+            sizes = counts and self._playlistCounts(session) or {}
+            playlists = []
+            if ids is None:
+                playlists = session.query(Playlist).all()
+            else:
+                # Stay well below SQLite's limit on bound parameters.
+                for i in xrange(0, len(ids), 500):
+                    chunk = list(ids[i:i + 500])
+                    playlists.extend(session.query(Playlist).filter(
+                        Playlist.id.in_(chunk)))
+            playlists.sort(key=attrgetter('id'))
+
+            if counts:
+                return [encode(playlist, sizes.get(playlist.id, 0))
+                        for playlist in playlists]
+            return map(encode, playlists)
+        return self.read(_query)
+
+    def appendSongs(self, playlist, ids):
+        """
+        Append the songs with the given ids to the end of a playlist.  Only
+        the new entries are written.  Returns a Deferred.
+        """
+        def _append(session):
+            table = PlaylistSong.__table__
+            step = PlaylistSong.POSITION_STEP
+            last = session.execute(select([func.max(table.c.position)],
+                table.c.playlist_id == playlist)).scalar() or 0
+            rows = [{'playlist_id': playlist, 'song_id': id,
+                     'position': last + step * (i + 1)}
+                    for i, id in enumerate(ids)]
+            if rows:
+                session.execute(table.insert(), rows)
+                changes.record(session, [(Playlist, playlist)])
+        return self.write(_append)
+
+    def moveEntry(self, playlist, entry, before=None):
+        """
+        Move a playlist entry so that it precedes the entry ``before``, or
+        to the end of the playlist if that is None.  Only the moved entry is
+        written unless the positions on either side of its destination are
+        adjacent, in which case the playlist is renumbered first.  Returns a
+        Deferred.
+        """
+        def _position(session):
+            table = PlaylistSong.__table__
+            c = table.c
+            if before is None:
+                last = session.execute(select([func.max(c.position)],
+                    c.playlist_id == playlist)).scalar() or 0
+                return last + PlaylistSong.POSITION_STEP
+            high = session.execute(select([c.position],
+                and_(c.playlist_id == playlist, c.id == before))).scalar()
+            if high is None:
+                raise ValueError('No such playlist entry: %r' % (before,))
+            low = session.execute(select([func.max(c.position)],
+                and_(c.playlist_id == playlist, c.position < high,
+                     c.id != entry))).scalar() or 0
+            if high - low < 2:
+                return None
+            return (low + high) // 2
+
+        def _move(session):
+            table = PlaylistSong.__table__
+            position = _position(session)
+            if position is None:
+                self._renumber(session, playlist)
+                position = _position(session)
+            session.execute(table.update(and_(table.c.id == entry,
+                                              table.c.playlist_id == playlist),
+                                         {'position': position}))
+            changes.record(session, [(Playlist, playlist)])
+        return self.write(_move)
+
+    def removeEntries(self, playlist, entries):
+        """Remove the given entries from a playlist.  Returns a Deferred."""
+        def _remove(session):
+            table = PlaylistSong.__table__
+            # Stay well below SQLite's limit on bound parameters.
+            for i in xrange(0, len(entries), 500):
+                chunk = list(entries[i:i + 500])
+                session.execute(table.delete(and_(
+                    table.c.playlist_id == playlist, table.c.id.in_(chunk))))
+            changes.record(session, [(Playlist, playlist)])
+        return self.write(_remove)
+
+    def _renumber(self, session, playlist):
+        # Spread the playlist's positions out evenly again.
+        from sqlalchemy import bindparam
+
+        table = PlaylistSong.__table__
+        query = select([table.c.id], table.c.playlist_id == playlist,
+                       order_by=[table.c.position, table.c.id])
+        step = PlaylistSong.POSITION_STEP
+        rows = [{'_id': id, 'position': step * (i + 1)}
+                for i, (id,) in enumerate(session.execute(query))]
+        if rows:
+            session.execute(table.update(table.c.id == bindparam('_id')),
+                            rows)
+
+    def observe(self, observer):
+        """
+        Call ``observer(changes)`` in the reactor thread after each committed
+        transaction, once the library's revision has been updated.
+        """
+        self.observers.append(observer)
+
+    def waitForRevision(self, revision):
+        """
+        Return a Deferred that fires with the library's revision number once
+        it has moved past the given revision.  The Deferred fires immediately
+        if that has already happened.  Cancelling the Deferred stops waiting.
+        """
+        d = Deferred(self.waiters.remove)
+        if self.revision > revision:
+            d.callback(self.revision)
+        else:
+            self.waiters.append(d)
+        return d
+
+    def _notify(self, changes, revision):
+        # Transactions may be committed by the database threads, but the
+        # library's state is only ever modified in the reactor thread.
+        if self.reactor.running and not threadable.isInIOThread():
+            self.reactor.callFromThread(self._changed, changes, revision)
+        else:
+            self._changed(changes, revision)
+
+    def _changed(self, changes, revision):
+        # Only transactions that changed songs or playlists were logged, and
+        # each of those made a new revision.
+        if revision is not None:
+            self._advance(revision, changes)
+
+    def advance(self, revision, changes):
+        """
+        Apply the (class, id) changes committed by another process, which
+        brought the library to the given revision.  Read-only libraries
+        learn about changes this way, from the process that made them.
+        """
+        if revision > self.revision:
+            self._advance(revision, changes)
+
+    def _advance(self, revision, changes):
+        # Move to the new revision and wake up everyone who was waiting for
+        # the library to change.
+        self.revision = revision
+        self._forget()
+        self.changelog.record(revision, changes)
+        for observer in list(self.observers):
+            observer(changes)
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.callback(self.revision)
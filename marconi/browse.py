@@ -0,0 +1,197 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+In-memory browse indexes.  A BrowseIndex keeps a sorted list of the distinct
+artists, albums, genres and composers in a library, along with the number of
+songs that have each value, so that browse requests never have to run a
+DISTINCT query over the entire ``songs`` table.
+
+The index is a Mirror of the library's songs: whenever songs change, the
+changed songs' old values are swapped for their new ones.  A single copy of
+each distinct string is shared by every song that has it, and is released
+along with the last of them.
+"""
+
+from array import array
+from bisect import bisect_left
+from zope.interface import implements
+
+from marconi.mirror import IMirror, Mirror
+
+"""The Song columns that can be browsed."""
+FIELDS = ('artist', 'album', 'genre', 'composer')
+
+class Values(object):
+    """
+    The distinct values of a single field, kept in case-insensitive order,
+    and the number of songs that have each of them.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.values = []
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def add(self, value):
+        count = self.counts.get(value, 0)
+        self.counts[value] = count + 1
+        if count == 0:
+            key = value.lower()
+            i = bisect_left(self.keys, key)
+            self.keys.insert(i, key)
+            self.values.insert(i, value)
+
+    def remove(self, value):
+        count = self.counts[value] - 1
+        if count:
+            self.counts[value] = count
+            return
+        del self.counts[value]
+        i = bisect_left(self.keys, value.lower())
+        while self.values[i] != value:
+            i += 1
+        del self.keys[i]
+        del self.values[i]
+
+    def clear(self):
+        del self.keys[:]
+        del self.values[:]
+        self.counts.clear()
+
+class BrowseIndex(Mirror):
+    """
+    Sorted, counted indexes of the browsable fields of a library's songs.
+    """
+
+    implements(IMirror)
+
+    def __init__(self, library, fields=FIELDS):
+        Mirror.__init__(self, library)
+        self.columns = fields
+        self.indexes = dict([(field, Values()) for field in fields])
+        self.rows = {}
+        self.strings = {}
+        self.maxId = 0
+        self.encoded = {}
+
+    def __getitem__(self, field):
+        return self.indexes[field]
+
+    def encode(self, field, encode):
+        """
+        Return the result of ``encode(values)`` for the given field's sorted
+        values.  The result is cached until the index next changes.
+        """
+        result = self.encoded.get(field)
+        if result is None:
+            result = self.encoded[field] = encode(self.indexes[field])
+        return result
+
+    def lastId(self):
+        return self.maxId
+
+    def state(self):
+        # Each row is stored as the positions of its values in the fields'
+        # sorted values, which restores far quicker than the rows themselves.
+        ids = array('i', sorted(self.rows))
+        fields = []
+        columns = []
+        for i, field in enumerate(self.columns):
+            index = self.indexes[field]
+            positions = dict([(value, n)
+                              for n, value in enumerate(index.values)])
+            fields.append((index.values, [index.counts[value]
+                                          for value in index.values]))
+            columns.append(array('i', [positions.get(self.rows[id][i], -1)
+                                       for id in ids]).tostring())
+        return self.columns, fields, ids.tostring(), columns
+
+    def undump(self, state):
+        names, fields, ids, columns = state
+        if tuple(names) != tuple(self.columns):
+            raise ValueError('Mismatched browse fields: %r' % (names,))
+        self.rows.clear()
+        self.strings.clear()
+        self.encoded.clear()
+
+        rows = []
+        for field, (values, counts), column in zip(self.columns, fields,
+                                                   columns):
+            index = self.indexes[field]
+            index.values[:] = values
+            index.keys[:] = [value.lower() for value in values]
+            index.counts.clear()
+            index.counts.update(zip(values, counts))
+            self.strings.update(zip(values, values))
+            # A position of -1 is a missing value.
+            values = values + [None]
+            positions = array('i')
+            positions.fromstring(column)
+            rows.append([values[n] for n in positions])
+        ids, data = array('i'), ids
+        ids.fromstring(data)
+        self.rows.update(zip(ids, zip(*rows)))
+        self.maxId = ids and ids[-1] or 0
+
+    def replace(self, rows):
+        for index in self.indexes.itervalues():
+            index.clear()
+        self.rows.clear()
+        self.strings.clear()
+        self.maxId = 0
+        self.update((), rows)
+
+    def update(self, ids, rows):
+        indexes = [self.indexes[field] for field in self.columns]
+        strings = self.strings
+
+        def remove(values):
+            for index, value in zip(indexes, values):
+                if value:
+                    index.remove(value)
+                    if value not in index.counts:
+                        release(value)
+
+        def release(value):
+            # The indexes' counts are the strings' reference counts.  A
+            # string may be shared by several fields, so its copy is only
+            # dropped once no field has a song with it.
+            for index in indexes:
+                if value in index.counts:
+                    return
+            del strings[value]
+
+        # Every changed song's old values are removed.  Those that still
+        # exist are re-added with their new values below.
+        for id in ids:
+            values = self.rows.pop(id, None)
+            if values is not None:
+                remove(values)
+
+        for row in rows:
+            id = row[0]
+            old = self.rows.get(id)
+            if old is not None:
+                remove(old)
+            # Share a single copy of each distinct string.
+            values = tuple([value and strings.setdefault(value, value)
+                            for value in row[1:]])
+            for index, value in zip(indexes, values):
+                if value:
+                    index.add(value)
+            self.rows[id] = values
+            if id > self.maxId:
+                self.maxId = id
+
+        # SQLite reuses the highest id once its row has been deleted.
+        if self.maxId and self.maxId not in self.rows:
+            self.maxId = self.rows and max(self.rows) or 0
+
+        self.encoded.clear()
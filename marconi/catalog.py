@@ -0,0 +1,258 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+The song catalog: a compact, column-oriented, in-memory copy of the fields
+of every song that listings return.  Reading songs from the catalog avoids
+both a database query and the cost of hydrating an ORM object per row.
+
+Each field is stored in its own typed array, with one entry per song in id
+order.  Numeric fields use the smallest array type that holds their values,
+and NULL values are stored as -1 (none of the fields are ever negative).
+String fields are stored as indexes into a pool of interned, UTF-8 encoded
+strings, so each distinct artist, album or genre is only stored once.
+
+A song costs 71 bytes of array storage on 64-bit platforms (a 4-byte id,
+seven 4-byte string indexes and 39 bytes of numeric fields), plus its share
+of the unique strings.  Titles are usually unique, so they account for
+most of the pool.  Strings are only removed from the pool when the catalog
+is reloaded.
+
+The catalog is a Mirror of the library's songs, so it is loaded once and then
+updated incrementally as songs change.
+"""
+
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from zope.interface import implements
+
+from marconi.mirror import IMirror, Mirror
+
+NULL = -1
+
+"""String Song columns, stored as indexes into the string pool."""
+STRINGS = ('title', 'album', 'artist', 'comment', 'composer', 'format',
+           'genre')
+
+"""Numeric Song columns and the array typecodes used to store them."""
+NUMBERS = (
+    ('bitrate',         'h'),
+    ('bpm',             'h'),
+    ('compilation',     'b'),
+    ('dateadded',       'i'),
+    ('datemodified',    'i'),
+    ('disccount',       'h'),
+    ('discnumber',      'h'),
+    ('samplerate',      'i'),
+    ('size',            'l'),
+    ('time',            'i'),
+    ('trackcount',      'h'),
+    ('tracknumber',     'h'),
+    ('year',            'h'),
+)
+
+"""The typecode of each catalog column (including the id column)."""
+TYPECODES = dict([('id', 'i')] + [(name, 'i') for name in STRINGS] +
+                 list(NUMBERS))
+
+class StringPool(object):
+    """
+    A pool of interned UTF-8 encoded strings, each identified by its index.
+    Index 0 is reserved for NULL.
+    """
+
+    def __init__(self):
+        self.strings = [None]
+        self.indexes = {}
+
+    def __len__(self):
+        return len(self.strings) - 1
+
+    def __getitem__(self, index):
+        return self.strings[index]
+
+    def intern(self, value):
+        """Return the index of the given (unicode) string."""
+        if value is None:
+            return 0
+        value = value.encode('utf-8')
+        index = self.indexes.get(value)
+        if index is None:
+            index = self.indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def footprint(self):
+        """Return the approximate number of bytes used by the pool."""
+        size = sys.getsizeof(self.strings) + sys.getsizeof(self.indexes)
+        for value in self.strings[1:]:
+            size += sys.getsizeof(value)
+        return size
+
+def _getter(name):
+    if name in STRINGS:
+        def get(self):
+            return self.catalog.pool[self.catalog.data[name][self.index]]
+    else:
+        def get(self):
+            value = self.catalog.data[name][self.index]
+            if value != NULL:
+                return value
+            return None
+    return property(get)
+
+class Row(object):
+    """
+    A song in the catalog, with the same field attributes as Song.  String
+    fields are returned as UTF-8 encoded strings.  A row is only valid until
+    the catalog next changes.
+    """
+
+    __slots__ = ('catalog', 'index')
+
+    def __init__(self, catalog, index):
+        self.catalog = catalog
+        self.index = index
+
+    def __repr__(self):
+        return '<Row(%d)>' % (self.id,)
+
+    @property
+    def id(self):
+        return self.catalog.ids[self.index]
+
+for _name in TYPECODES:
+    if _name != 'id':
+        setattr(Row, _name, _getter(_name))
+del _name
+
+class Catalog(Mirror):
+    """An in-memory, column-oriented catalog of a library's songs."""
+
+    implements(IMirror)
+
+    columns = STRINGS + tuple([name for name, typecode in NUMBERS])
+
+    def __init__(self, library):
+        Mirror.__init__(self, library)
+        self.ids, self.data, self.pool = self._empty()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return '<Catalog(%d songs)>' % (len(self.ids),)
+
+    def _empty(self):
+        ids = array('i')
+        data = dict([(name, array(TYPECODES[name])) for name in self.columns])
+        data['id'] = ids
+        return ids, data, StringPool()
+
+    def get(self, id):
+        """Return the Row for the song with the given id, or None."""
+        index = bisect_left(self.ids, id)
+        if index < len(self.ids) and self.ids[index] == id:
+            return Row(self, index)
+        return None
+
+    def songs(self, after=0, limit=1000):
+        """Return up to ``limit`` Rows whose ids follow ``after``, by id."""
+        start = bisect_right(self.ids, after)
+        end = min(start + limit, len(self.ids))
+        return [Row(self, index) for index in xrange(start, end)]
+
+    def lookup(self, ids):
+        """Return the Rows for the given song ids that are in the catalog."""
+        rows = []
+        for id in ids:
+            row = self.get(id)
+            if row is not None:
+                rows.append(row)
+        return rows
+
+    def footprint(self):
+        """
+        Return the approximate number of bytes used by the catalog's arrays
+        and by its string pool.
+        """
+        arrays = sum([len(column) * column.itemsize
+                      for column in self.data.itervalues()])
+        return arrays, self.pool.footprint()
+
+    def lastId(self):
+        return self.ids and self.ids[-1] or 0
+
+    def state(self):
+        columns = dict([(name, column.tostring())
+                        for name, column in self.data.iteritems()])
+        return columns, self.pool.strings[1:]
+
+    def undump(self, state):
+        columns, strings = state
+        ids, data, pool = self._empty()
+        for name, column in data.iteritems():
+            column.fromstring(columns[name])
+        pool.strings.extend(strings)
+        pool.indexes = dict(zip(strings, xrange(1, len(strings) + 1)))
+        self.replace((ids, data, pool))
+
+    def _values(self, pool, row):
+        """Convert a database row into its column values."""
+        values = [row[0]]
+        for value in row[1:len(STRINGS) + 1]:
+            values.append(pool.intern(value))
+        for value in row[len(STRINGS) + 1:]:
+            if value is None:
+                value = NULL
+            values.append(value)
+        return values
+
+    def build(self, rows):
+        ids, data, pool = self._empty()
+        columns = [ids] + [data[name] for name in self.columns]
+        for row in rows:
+            for column, value in zip(columns, self._values(pool, row)):
+                column.append(value)
+        return ids, data, pool
+
+    def replace(self, state):
+        self.ids, self.data, self.pool = state
+
+    def update(self, ids, rows):
+        columns = [self.ids] + [self.data[name] for name in self.columns]
+
+        # Remove the songs that no longer exist.
+        found = set([row[0] for row in rows])
+        removed = []
+        for id in ids:
+            if id is not None and id not in found:
+                index = bisect_left(self.ids, id)
+                if index < len(self.ids) and self.ids[index] == id:
+                    removed.append(index)
+        if len(removed) > 64:
+            # Rebuild the columns rather than shifting them for each song.
+            removed = set(removed)
+            for column in columns:
+                column[:] = array(column.typecode,
+                                  [value for index, value in enumerate(column)
+                                   if index not in removed])
+        else:
+            for index in sorted(removed, reverse=True):
+                for column in columns:
+                    del column[index]
+
+        # Update existing songs in place and insert new ones in id order.
+        for row in rows:
+            values = self._values(self.pool, row)
+            index = bisect_left(self.ids, values[0])
+            if index == len(self.ids):
+                for column, value in zip(columns, values):
+                    column.append(value)
+            elif self.ids[index] == values[0]:
+                for column, value in zip(columns, values):
+                    column[index] = value
+            else:
+                for column, value in zip(columns, values):
+                    column.insert(index, value)
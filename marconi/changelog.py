@@ -0,0 +1,136 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+The library's change log.  Every library revision records the ids of the
+songs and playlists that changed in it, so that clients which already have
+a listing from an earlier revision can be sent just the differences: the
+items that were added or changed since then, and the ids of those that were
+deleted.
+
+The log is persisted in the ``changes`` table, which also lets the library
+resume its revision numbering when the server is restarted.  Each
+transaction writes its own entries to the table as it commits (see
+marconi.db.ChangeNotifier), so the log always matches the data.  Entries are
+compacted away once no live session can still ask for a delta from their
+revision, so the log only ever covers recent history.
+"""
+
+from sqlalchemy import func, select
+from twisted.internet.defer import Deferred, succeed
+from twisted.python import log
+
+from marconi.db import Change
+
+class ChangeLog(object):
+    """
+    The change log of a library.  ``revision`` is the latest revision that
+    has been written to the log, and ``floor`` is the oldest revision from
+    which a delta can still be computed: the log holds every change made
+    after it.
+    """
+
+    def __init__(self, library):
+        self.library = library
+        self.waiters = []
+
+        # The log is only read synchronously once, when the library is
+        # created, to find the revision at which to resume.
+        table = Change.__table__
+        query = select([func.min(table.c.revision),
+                        func.max(table.c.revision)])
+        oldest, latest = library.db.execute(query).fetchone()
+        if latest is None:
+            self.floor = self.revision = 1
+        else:
+            self.floor, self.revision = oldest - 1, latest
+
+    def __repr__(self):
+        return '<ChangeLog(%d-%d)>' % (self.floor, self.revision)
+
+    def record(self, revision, changes):
+        """
+        Note that the (class, id) changes made at the given revision have
+        been committed, and with them their entries in the log.
+        """
+        self._caughtUp(revision)
+
+    def wait(self, revision):
+        """
+        Return a Deferred that fires once the log has been written up to
+        the given revision.
+        """
+        if self.revision >= revision:
+            return succeed(self.revision)
+        d = Deferred(lambda d: self.waiters.remove((revision, d)))
+        self.waiters.append((revision, d))
+        return d
+
+    def changes(self, revision):
+        """
+        Return a Deferred that fires with the changes made after the given
+        revision, as a dictionary mapping each kind (Change.SONG and
+        Change.PLAYLIST) to the ordered list of the ids of the changed
+        items.  It fires with None if the log can't answer that: the
+        revision is older than the log or newer than the library, or some of
+        the changes since weren't identified.
+        """
+        current = self.library.revision
+        if revision < self.floor or revision > current:
+            return succeed(None)
+        if revision == current:
+            return succeed({Change.SONG: [], Change.PLAYLIST: []})
+
+        def _query(session):
+            table = Change.__table__
+            query = select([table.c.kind, table.c.item],
+                           table.c.revision > revision, distinct=True)
+            return session.execute(query).fetchall()
+
+        def _collect(rows):
+            # Entries may have been compacted away while they were read.
+            if revision < self.floor:
+                return None
+            changed = {Change.SONG: set(), Change.PLAYLIST: set()}
+            for kind, item in rows:
+                if item is None:
+                    return None
+                changed[kind].add(item)
+            return dict([(kind, sorted(ids))
+                         for kind, ids in changed.iteritems()])
+
+        d = self.wait(current)
+        d.addCallback(lambda _: self.library.run(_query))
+        d.addCallback(_collect)
+        return d
+
+    def compact(self, revision):
+        """
+        Refuse deltas from revisions older than the given one from now on,
+        and discard the entries that were only needed for deltas refused by
+        the previous compaction.  Deleting entries one compaction late gives
+        other processes that read the log time to learn about the new
+        floor.  The latest revision's entries are always kept so that the
+        revision survives a restart.  Returns a Deferred.
+        """
+        revision = min(revision, self.revision - 1)
+        floor, self.floor = self.floor, max(self.floor, revision)
+        if self.library.readonly:
+            return succeed(0)
+
+        def _delete(session):
+            table = Change.__table__
+            query = table.delete(table.c.revision <= floor)
+            return session.execute(query).rowcount
+
+        d = self.library.write(_delete)
+        d.addErrback(log.err, 'Failed to compact the change log')
+        return d
+
+    def _caughtUp(self, revision):
+        self.revision = revision
+        waiters = [(r, d) for r, d in self.waiters if r <= revision]
+        if waiters:
+            self.waiters = [(r, d) for r, d in self.waiters if r > revision]
+            for r, d in waiters:
+                d.callback(revision)
@@ -1,13 +1,120 @@
 # Marconi Media Server
 # Copyright 2009 Jon Parise <jon@indelible.org>
 
-from sqlalchemy import Column, Integer, SmallInteger, Unicode
+from itertools import chain
+from sqlalchemy import DDL, Column, Float, ForeignKey, Index, Integer, \
+                       SmallInteger, Unicode, func, select
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.interfaces import PoolListener
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.interfaces import SessionExtension
 from twisted.python import log
 
+class ChangeNotifier(SessionExtension):
+    """
+    Notifies observers of the rows that were inserted, updated or deleted by
+    each committed transaction.  Changes are identified by (class, id) pairs
+    and are collected as each flush completes, but observers are only called
+    once the transaction has been committed.  Rolled back changes are
+    discarded.
+
+    Each transaction that changes songs or playlists also records them in
+    the change log, under the next library revision, before it commits: the
+    log can't miss changes that were committed, or hold ones that weren't.
+    Observers are called with the changes and that revision (or None if the
+    transaction didn't change any songs or playlists).
+
+    Bulk operations that bypass the ORM call log() and notify() themselves
+    (or, within a session's transaction, record()).  An id of ``None``
+    indicates rows that weren't individually identified, such as those added
+    by a bulk insert.
+
+    Objects with a ``changeKey`` attribute are reported using that (class,
+    id) pair rather than their own, so that changes to a playlist's
+    membership are reported as changes to the playlist.
+    """
+
+    def __init__(self):
+        self.observers = []
+        self.pending = {}
+        self.revisions = {}
+
+    def subscribe(self, observer):
+        """
+        Call ``observer(changes, revision)`` after each committed
+        transaction.
+        """
+        self.observers.append(observer)
+
+    def unsubscribe(self, observer):
+        self.observers.remove(observer)
+
+    def notify(self, changes, revision=None):
+        """
+        Notify every observer of the given set of (class, id) changes, which
+        were logged at the given revision.
+        """
+        for observer in list(self.observers):
+            observer(changes, revision)
+
+    def record(self, session, changes):
+        """
+        Record changes made by bulk statements executed in the session's
+        transaction.  Observers are notified once it has been committed.
+        """
+        self.pending.setdefault(session, set()).update(changes)
+
+    def log(self, connection, changes):
+        """
+        Record the changes in the change log within the connection's current
+        transaction, so that they're committed along with it.  Returns the
+        revision they were logged at, which follows the latest one in the
+        log, or None if none of them are songs or playlists.
+        """
+        rows = []
+        for cls, id in changes:
+            kind = KINDS.get(cls)
+            if kind is not None:
+                rows.append({'kind': kind, 'item': id})
+        if not rows:
+            return None
+
+        # An empty log starts out at the first revision.
+        latest = connection.execute(
+            select([func.max(Change.revision)])).scalar()
+        revision = (latest or 1) + 1
+        for row in rows:
+            row['revision'] = revision
+        connection.execute(Change.__table__.insert(), rows)
+        return revision
+
+    def before_commit(self, session):
+        # Flush now, rather than as part of the commit, so that the changes
+        # are complete when they're logged.
+        session.flush()
+        changes = self.pending.get(session)
+        if changes:
+            self.revisions[session] = self.log(session.connection(), changes)
+
+    def after_flush(self, session, flush_context):
+        changes = self.pending.setdefault(session, set())
+        for obj in chain(session.new, session.dirty, session.deleted):
+            changes.add(getattr(obj, 'changeKey', None) or
+                        (obj.__class__, obj.id))
+
+    def after_commit(self, session):
+        changes = self.pending.pop(session, None)
+        revision = self.revisions.pop(session, None)
+        if changes:
+            self.notify(changes, revision)
+
+    def after_rollback(self, session):
+        self.pending.pop(session, None)
+        self.revisions.pop(session, None)
+
 Base = declarative_base()
-Session = sessionmaker()
+changes = ChangeNotifier()
+Session = sessionmaker(extension=changes)
 
 class Song(Base):
     __tablename__ = 'songs'
@@ -15,36 +122,42 @@ class Song(Base):
     id = Column(Integer, primary_key=True)
     path = Column(Unicode(1024), unique=True)
     title = Column(Unicode)
+    # The columns that are commonly used to filter listings are indexed
+    # (the string columns by NOCASE_INDEXES, below).
     album = Column(Unicode)
     artist = Column(Unicode)
     bitrate = Column(SmallInteger)
     bpm = Column(SmallInteger)
-    # comment
-    # compilation
-    # composer
-    # date-added
-    # date-modified
-    # disc-count
-    # disc-number
+    comment = Column(Unicode)
+    compilation = Column(SmallInteger)
+    composer = Column(Unicode)
+    dateadded = Column(Integer)
+    datemodified = Column(Integer)
+    disccount = Column(SmallInteger)
+    discnumber = Column(SmallInteger)
     # disabled
     # eq-preset
-    # format
-    # genre
+    format = Column(Unicode(8))
+    genre = Column(Unicode)
     # description
     # relative-volume
-    # sample-rate
-    # size
+    samplerate = Column(Integer)
+    size = Column(Integer)
     # start-time
     # stop-time
-    # time (duration?)
-    # track-count
-    # track-number
+    time = Column(Integer)                          # milliseconds
+    trackcount = Column(SmallInteger)
+    tracknumber = Column(SmallInteger)
     # user-rating
-    # year
+    year = Column(SmallInteger, index=True)
     # data-kind
     # data-url
     # norm-volume
 
+    # File system state recorded by the scanner to detect changed files.
+    mtime = Column(Float)
+    inode = Column(Integer)
+
     def __init__(self, path, title):
         self.path = path
         self.title = title
@@ -52,6 +165,24 @@ class Song(Base):
     def __repr__(self):
         return "<Song('%s', '%s')>" % (self.path, self.title)
 
+"""
+Song columns that queries compare without regard to (ASCII) case, mapped to
+the names of their indexes.  The indexes use the NOCASE collation, like the
+comparisons, so that SQLite can use them.  SQLAlchemy can't declare them, so
+they are created by DDL, and they replace the (case-sensitive) indexes that
+these columns used to have.
+"""
+NOCASE_INDEXES = dict([(name, 'ix_songs_%s_nocase' % name)
+                       for name in ('album', 'artist', 'composer', 'genre')])
+
+def _nocaseIndex(name):
+    return 'CREATE INDEX %s ON songs (%s COLLATE NOCASE)' % \
+           (NOCASE_INDEXES[name], name)
+
+for _name in NOCASE_INDEXES:
+    DDL(_nocaseIndex(_name)).execute_at('after-create', Song.__table__)
+del _name
+
 class Playlist(Base):
     __tablename__ = 'playlists'
 
@@ -64,26 +195,245 @@ class Playlist(Base):
     def __repr__(self):
         return "<Playlist('%s')>" % (self.name,)
 
-def create(path, debug=False):
+class PlaylistSong(Base):
+    """
+    A song's membership in a playlist.  A playlist's songs are ordered by
+    their positions, which are spaced POSITION_STEP apart so that songs can
+    be inserted or moved between two others by only updating their own
+    rows.  The same song may appear in a playlist more than once.
+    """
+
+    __tablename__ = 'playlist_songs'
+
+    POSITION_STEP = 1024
+
+    id = Column(Integer, primary_key=True)
+    playlist_id = Column(Integer, ForeignKey('playlists.id'), nullable=False)
+    song_id = Column(Integer, ForeignKey('songs.id'), nullable=False,
+                     index=True)
+    position = Column(Integer, nullable=False)
+
+    def __init__(self, playlist_id, song_id, position):
+        self.playlist_id = playlist_id
+        self.song_id = song_id
+        self.position = position
+
+    def __repr__(self):
+        return "<PlaylistSong(%d, %d)>" % (self.playlist_id, self.song_id)
+
+    @property
+    def changeKey(self):
+        return (Playlist, self.playlist_id)
+
+# Playlists are always read in position order.
+Index('ix_playlist_songs_position', PlaylistSong.playlist_id,
+      PlaylistSong.position)
+
+class Artwork(Base):
+    """
+    An image extracted from an audio file into the artwork cache, keyed by
+    the album (or song) it belongs to.  ``song_id`` and ``mtime`` identify
+    the file the image was extracted from and its modification time at the
+    time.  The ``digest`` (which names the image in the cache) is NULL if
+    the file had no artwork.
+    """
+
+    __tablename__ = 'artwork'
+
+    key = Column(Unicode, primary_key=True)
+    song_id = Column(Integer, nullable=False, index=True)
+    mtime = Column(Float)
+    digest = Column(Unicode(40))
+    type = Column(Unicode(32))
+
+    def __repr__(self):
+        return "<Artwork('%s', %r)>" % (self.key, self.digest)
+
+class Change(Base):
+    """
+    An entry in the library's change log: the song or playlist with the
+    given id was added, changed or deleted at the given library revision.
+    An ``item`` of NULL records changes that weren't individually
+    identified.
+    """
+
+    __tablename__ = 'changes'
+
+    SONG = 1
+    PLAYLIST = 2
+
+    id = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False, index=True)
+    kind = Column(SmallInteger, nullable=False)
+    item = Column(Integer)
+
+    def __repr__(self):
+        return "<Change(%d, %d, %r)>" % (self.revision, self.kind, self.item)
+
+"""The classes recorded in the change log, mapped to their kinds."""
+KINDS = {
+    Song:       Change.SONG,
+    Playlist:   Change.PLAYLIST,
+}
+
+def missingColumns(engine):
+    """Return the declared (table, column) pairs that don't exist yet."""
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if not table.exists(bind=engine):
+            continue
+        query = 'PRAGMA table_info(%s)' % (table.name,)
+        existing = set([row[1] for row in engine.execute(query)])
+        missing.extend([(table, column) for column in table.columns
+                        if column.name not in existing])
+    return missing
+
+def createColumns(engine):
+    """
+    Add any of the tables' declared columns that don't exist yet.  Only
+    nullable columns can be added to an existing table, so ValueError is
+    raised if any others are missing.
+    """
+    for table, column in missingColumns(engine):
+        if not column.nullable:
+            raise ValueError('Database column %s.%s cannot be added' %
+                             (table.name, column.name))
+        log.msg('Adding column: %s.%s' % (table.name, column.name))
+        spec = column.type.dialect_impl(engine.dialect).get_col_spec()
+        engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                       (table.name, column.name, spec))
+
+def createIndexes(engine):
+    """
+    Create any of the tables' declared indexes (and NOCASE_INDEXES) that
+    don't exist yet, replacing the indexes that they supersede.
+    """
+    query = "SELECT name FROM sqlite_master WHERE type = 'index'"
+    existing = set([name for (name,) in engine.execute(query)])
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                log.msg('Creating index: %s' % (index.name,))
+                index.create(bind=engine)
+    for name, index in sorted(NOCASE_INDEXES.iteritems()):
+        if index not in existing:
+            log.msg('Creating index: %s' % (index,))
+            engine.execute(_nocaseIndex(name))
+        if 'ix_songs_%s' % name in existing:
+            log.msg('Dropping index: ix_songs_%s' % (name,))
+            engine.execute('DROP INDEX ix_songs_%s' % (name,))
+
+"""
+Pragmas set on every connection to a database file.  Write-ahead logging
+lets readers keep reading while a transaction is being written, and only
+needs the log synced at checkpoints.  Connections also get a 16 MB page
+cache (a negative size is in kilobytes) and map up to 256 MB of the file
+into memory.
+"""
+PRAGMAS = (
+    ('journal_mode',    'WAL'),
+    ('synchronous',     'NORMAL'),
+    ('cache_size',      -16384),
+    ('mmap_size',       256 * 1024 * 1024),
+)
+
+class Pragmas(PoolListener):
+    """Sets PRAGMAS on each new connection."""
+
+    def connect(self, connection, record):
+        for name, value in PRAGMAS:
+            connection.execute('PRAGMA %s = %s' % (name, value))
+
+class ReadOnly(PoolListener):
+    """Refuses to modify the database using each new connection."""
+
+    def connect(self, connection, record):
+        connection.execute('PRAGMA query_only = ON')
+
+def create(path, debug=False, readonly=False):
     """
     Create a new SQLite database engine using the given path.  If the database
     doesn't already exist, it will be created.  The path ``:memory:`` will
     create a memory-based database.
+
+    A ``readonly`` engine refuses to modify the database, which must already
+    exist (and have every column).  Read-only engines are used by processes
+    that share a database with a single writer.
     """
     import os.path
     from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
 
     exists = os.path.exists(path)
-    engine = create_engine('sqlite:///' + path, echo=debug)
+    if readonly and (path == ':memory:' or not exists):
+        raise ValueError('Read-only databases must already exist: %s' % path)
+
+    if path == ':memory:':
+        # Every thread must share the same connection, or they would each
+        # see their own, separate, memory-based database.
+        engine = create_engine('sqlite://', echo=debug, poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+    elif readonly:
+        engine = create_engine('sqlite:///' + path, echo=debug,
+                               listeners=[Pragmas(), ReadOnly()])
+    else:
+        engine = create_engine('sqlite:///' + path, echo=debug,
+                               listeners=[Pragmas()])
 
     # If the database doesn't already exist, create it now.  Memory-based
-    # database are always recreated from scratch.
+    # database are always recreated from scratch.  Existing databases gain
+    # any tables, columns and indexes that have been added since they were
+    # created; read-only engines can't add them, so they refuse databases
+    # that are missing any columns.
     if path == ':memory:' or not exists:
         log.msg('Creating database: %s' % (path,))
         Base.metadata.create_all(engine)
+    elif not readonly:
+        Base.metadata.create_all(engine)
+        createColumns(engine)
+        createIndexes(engine)
+    else:
+        missing = missingColumns(engine)
+        if missing:
+            raise ValueError('Database must be upgraded before it can be '
+                             'opened read-only (missing %s): %s' %
+                             (', '.join(['%s.%s' % (table.name, column.name)
+                                         for table, column in missing]),
+                              path))
 
     # Bind the table base's metadata to the new engine.  All of our tables
     # inherit from this base and will therefore be bound, as well.
     Base.metadata.bind = engine
 
     return engine
+
+def reader(engine):
+    """
+    Return an engine with read-only connections to the given engine's
+    database, for threads that only ever read from it.  Memory-based
+    databases only have a single connection, so their engine is returned
+    unchanged.
+    """
+    from sqlalchemy import create_engine
+
+    if engine.url.database in (None, '', ':memory:'):
+        return engine
+    return create_engine(engine.url, echo=engine.echo,
+                         listeners=[Pragmas(), ReadOnly()])
+
+def listingReader(engine):
+    """
+    Return an engine whose (read-only) connections can hold a transaction
+    open while a listing is sent, or None for memory-based databases, which
+    only have a single connection.  Each connection is only used by one
+    thread at a time, but not always by the same one, and is closed when it
+    is released.
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import NullPool
+
+    if engine.url.database in (None, '', ':memory:'):
+        return None
+    return create_engine(engine.url, echo=engine.echo, poolclass=NullPool,
+                         connect_args={'check_same_thread': False},
+                         listeners=[Pragmas(), ReadOnly()])
@@ -0,0 +1,232 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Song listings that are sent in batches rather than read in one go.
+
+A listing's response begins with the number of its records and their total
+size, so both are read up front, with a single aggregate query, and the
+records themselves are then read (and encoded) a batch at a time as the
+response is sent.  The listing holds a read transaction open on a
+connection of its own until it has been sent, so every batch is read from
+the same revision of the library as its header, however long that takes.
+While the catalog still reflects that revision, batches are read from it
+instead of the database.
+
+Memory-based databases only have a single connection, which can't be kept
+in a transaction, so their listings are read in one go when they are
+opened.
+"""
+
+from sqlalchemy import and_, func, select
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThreadPool
+
+from marconi.db import Change, Song
+
+# The number of songs read (and encoded) at a time.
+BATCH_SIZE = 1000
+
+class SongListing(object):
+    """
+    A listing of the library's songs: those with the given ``ids`` (a
+    sequence, in the order they are listed, which may repeat songs), or
+    else every song matching the SQL ``clause`` (if one is given) in id
+    order.  Songs that don't exist are left out.
+
+    Each song is listed as ``encode(song, revision)``, or as ``encode(song,
+    entry, revision)`` if ``entries`` (a sequence parallel to ``ids``) is
+    given, where ``revision`` is the listing's.  ``size`` is a SQL
+    expression for the length of a song's encoded record.  ``count`` and
+    ``size`` are the listing's number of records and their total length
+    once it has been opened, at library ``revision``.
+    """
+
+    def __init__(self, library, encode, size, clause=None, ids=None,
+                 entries=None, batchSize=BATCH_SIZE):
+        self.library = library
+        self.encode = encode
+        self.sizeColumn = size
+        self.clause = clause
+        self.ids = ids
+        self.entries = entries
+        self.batchSize = batchSize
+        self.revision = None
+        self.count = 0
+        self.size = 0
+        self.position = 0
+        self.connection = None
+        self.buffer = None
+        self.reading = None
+        self.closed = False
+
+    def __repr__(self):
+        return '<SongListing(%d songs, %d bytes)>' % (self.count, self.size)
+
+    def open(self):
+        """Return a Deferred that fires with the listing once it's open."""
+        d = self._defer(self._open)
+        d.addCallback(lambda _: self)
+        return d
+
+    def read(self):
+        """
+        Return a Deferred that fires with the encoded records of the next
+        batch of songs, as a string, or with '' once they have all been
+        read.  Only one batch is read at a time.
+        """
+        if self.closed:
+            return succeed('')
+        if self.buffer is not None:
+            rows = self.buffer[:self.batchSize]
+            del self.buffer[:self.batchSize]
+            return succeed(''.join(self._encode(rows)))
+
+        rows = self._catalogRows()
+        if rows is not None:
+            return succeed(''.join(self._encode(rows)))
+
+        def _read(result):
+            self.reading = None
+            return ''.join(self._encode(result))
+
+        self.reading = self._defer(self._rows, self.connection)
+        self.reading.addCallback(_read)
+        return self.reading
+
+    def close(self):
+        """Release the listing's connection (once any read has finished)."""
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer = None
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        if self.reading is not None:
+            self.reading.addBoth(lambda result: self._defer(connection.close))
+        else:
+            self._defer(connection.close)
+
+    def _defer(self, func, *args):
+        return deferToThreadPool(self.library.reactor,
+                                 self.library.threadpool, func, *args)
+
+    def _open(self):
+        engine = self.library.listings
+        # Runs in a database thread.  Songs are only encoded in the reactor
+        # thread, as they are read.
+        if engine is None:
+            connection = self.library.db.connect()
+        else:
+            connection = engine.connect()
+            # pysqlite only begins transactions before modifications, so
+            # one is begun explicitly.  It holds its snapshot (of the
+            # write-ahead log) until the connection is closed.
+            connection.execute('BEGIN')
+
+        try:
+            self.revision = connection.execute(
+                select([func.max(Change.revision)])).scalar() or 1
+            if self.ids is None:
+                query = select([func.count(Song.id),
+                                func.sum(self.sizeColumn)], self.clause)
+                self.count, self.size = connection.execute(query).fetchone()
+                self.size = self.size or 0
+            else:
+                self._measure(connection)
+
+            if engine is None:
+                self.buffer = []
+                rows = self._rows(connection)
+                while rows:
+                    self.buffer.extend(rows)
+                    rows = self._rows(connection)
+        except:
+            connection.close()
+            raise
+
+        if engine is None:
+            connection.close()
+        else:
+            self.connection = connection
+
+    def _measure(self, connection):
+        # Each song's size is counted as many times as it is listed.
+        for i in xrange(0, len(self.ids), 500):
+            chunk = self.ids[i:i + 500]
+            query = select([Song.id, self.sizeColumn],
+                           Song.id.in_(list(set(chunk))))
+            sizes = dict([tuple(row) for row in connection.execute(query)])
+            for id in chunk:
+                size = sizes.get(id)
+                if size is not None:
+                    self.count += 1
+                    self.size += size
+
+    def _rows(self, connection):
+        """
+        Return the next batch of (song, index) pairs, where ``index`` is the
+        song's position in ``ids`` (or None).
+        """
+        table = Song.__table__
+        if self.ids is None:
+            clause = table.c.id > self.position
+            if self.clause is not None:
+                clause = and_(clause, self.clause)
+            query = select([table], clause, order_by=[table.c.id],
+                           limit=self.batchSize)
+            rows = [(row, None) for row in connection.execute(query)]
+            if rows:
+                self.position = rows[-1][0].id
+            return rows
+
+        rows = []
+        while not rows and self.position < len(self.ids):
+            start = self.position
+            chunk = self.ids[start:start + self.batchSize]
+            self.position += len(chunk)
+            found = {}
+            for i in xrange(0, len(chunk), 500):
+                ids = list(set(chunk[i:i + 500]))
+                query = select([table], table.c.id.in_(ids))
+                for row in connection.execute(query):
+                    found[row.id] = row
+            rows = [(found[id], start + i) for i, id in enumerate(chunk)
+                    if id in found]
+        return rows
+
+    def _catalogRows(self):
+        """
+        Return the next batch of (row, index) pairs from the catalog, or
+        None if the catalog doesn't reflect the listing's revision.
+        """
+        catalog = self.library.catalog
+        if self.clause is not None or catalog is None or \
+           not catalog.current or catalog.revision != self.revision:
+            return None
+
+        if self.ids is None:
+            rows = [(row, None)
+                    for row in catalog.songs(self.position, self.batchSize)]
+            if rows:
+                self.position = rows[-1][0].id
+            return rows
+
+        rows = []
+        while not rows and self.position < len(self.ids):
+            start = self.position
+            chunk = self.ids[start:start + self.batchSize]
+            self.position += len(chunk)
+            for i, id in enumerate(chunk):
+                row = catalog.get(id)
+                if row is not None:
+                    rows.append((row, start + i))
+        return rows
+
+    def _encode(self, rows):
+        if self.entries is None:
+            return [self.encode(song, self.revision) for song, index in rows]
+        entries = self.entries
+        return [self.encode(song, entries[index], self.revision)
+                for song, index in rows]
@@ -0,0 +1,183 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Lightweight server metrics, exposed in the Prometheus text format.
+
+Every metric is a fixed-size set of counters that is allocated up front, so
+recording a sample is a handful of integer additions (plus a bisect for
+histograms) and never allocates.  Samples are only ever recorded in the
+reactor thread, which means the counters need no locks.
+"""
+
+from bisect import bisect_left
+
+"""Upper bounds (in seconds) of the request latency histogram's buckets."""
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+"""Upper bounds (in seconds) of the database query histogram's buckets."""
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+def _escape(value, quote=True):
+    """Escape a label value (or, without ``quote``, a help string)."""
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    if quote:
+        value = value.replace('"', '\\"')
+    return value
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, _escape(_utf8(value)))
+                              for name, value in labels])
+
+def _help(name, help):
+    return '# HELP %s %s' % (name, _escape(help, quote=False))
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Histogram(object):
+    """
+    A histogram of observed values with fixed bucket boundaries.  Bucket
+    counts are stored individually and only made cumulative when rendered.
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels=()):
+        """Yield this histogram's lines in the Prometheus text format."""
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            le = isinstance(bound, str) and bound or _number(bound)
+            yield '%s_bucket%s %d' % (name, _labels(labels + (('le', le),)),
+                                      total)
+        yield '%s_sum%s %s' % (name, _labels(labels), _number(self.sum))
+        yield '%s_count%s %d' % (name, _labels(labels), self.count)
+
+class Endpoint(object):
+    """The counters recorded for each of the server's request endpoints."""
+
+    __slots__ = ('requests', 'errors', 'aborted', 'bytes', 'latency')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.aborted = 0
+        self.bytes = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+
+class Metrics(object):
+    """
+    The server's metrics.  Request counters are kept for each endpoint name
+    passed to request(); the set of names is fixed by the server's resource
+    classes.  Additional gauges (such as cache statistics) are sampled from
+    callables when the metrics are rendered, so they cost nothing until
+    then.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.gauges = []
+
+    def endpoint(self, name):
+        endpoint = self.endpoints.get(name)
+        if endpoint is None:
+            endpoint = self.endpoints[name] = Endpoint()
+        return endpoint
+
+    def request(self, name, elapsed, bytes, code):
+        """Record a completed request."""
+        endpoint = self.endpoints.get(name) or self.endpoint(name)
+        endpoint.requests += 1
+        endpoint.bytes += bytes
+        if code >= 400:
+            endpoint.errors += 1
+        # Histogram.observe(), inlined because this runs for every request.
+        latency = endpoint.latency
+        latency.counts[bisect_left(latency.bounds, elapsed)] += 1
+        latency.sum += elapsed
+        latency.count += 1
+
+    def abort(self, name):
+        """Record a request whose connection was lost before it finished."""
+        endpoint = self.endpoints.get(name) or self.endpoint(name)
+        endpoint.aborted += 1
+
+    def query(self, elapsed):
+        """Record the time taken by a database query."""
+        self.queries.observe(elapsed)
+
+    def gauge(self, name, help, func, type='gauge', labels=()):
+        """
+        Register a metric whose current value is returned by ``func()``.
+        Metrics that share a name must be registered consecutively.
+        """
+        self.gauges.append((name, help, type, labels, func))
+
+    def render(self):
+        """Return the current metrics in the Prometheus text format."""
+        lines = []
+        endpoints = sorted(self.endpoints.iteritems())
+
+        def counter(name, help, attr):
+            lines.append(_help(name, help))
+            lines.append('# TYPE %s counter' % name)
+            for label, endpoint in endpoints:
+                lines.append('%s%s %d' % (name,
+                             _labels((('endpoint', label),)),
+                             getattr(endpoint, attr)))
+
+        counter('marconi_requests_total', 'Requests completed.', 'requests')
+        counter('marconi_request_errors_total',
+                'Requests completed with an error status.', 'errors')
+        counter('marconi_requests_aborted_total',
+                'Requests whose connection was lost.', 'aborted')
+        counter('marconi_response_bytes_total',
+                'Response body bytes sent.', 'bytes')
+
+        name = 'marconi_request_duration_seconds'
+        lines.append(_help(name, 'Request latency.'))
+        lines.append('# TYPE %s histogram' % name)
+        for label, endpoint in endpoints:
+            lines.extend(endpoint.latency.lines(name, (('endpoint', label),)))
+
+        name = 'marconi_db_query_duration_seconds'
+        lines.append(_help(name, 'Database query time.'))
+        lines.append('# TYPE %s histogram' % name)
+        lines.extend(self.queries.lines(name))
+
+        previous = None
+        for name, help, type, labels, func in self.gauges:
+            if name != previous:
+                lines.append(_help(name, help))
+                lines.append('# TYPE %s %s' % (name, type))
+                previous = name
+            lines.append('%s%s %s' % (name, _labels(labels), _number(func())))
+
+        lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,221 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Mirrors are in-memory structures derived from the columns of a library's
+songs, such as the song catalog and the browse indexes.  A mirror is loaded
+once and then maintained incrementally: whenever songs change, only the
+changed rows are re-read from the database and handed to the mirror.
+
+If the rows can't be read, the mirror is reloaded from scratch after a
+delay, which doubles with each consecutive failure.  Until it succeeds, the
+mirror is unavailable: anything waiting for it fails rather than waiting.
+"""
+
+from sqlalchemy import select
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.python import log
+from zope.interface import Interface
+
+from marconi.db import Song
+
+# The delay (in seconds) before a mirror whose update failed is reloaded,
+# and the most that the delay grows to with repeated failures.
+RETRY_DELAY = 1.0
+RETRY_MAXIMUM = 60.0
+
+class IMirror(Interface):
+    """
+    The contents of a mirror, which Mirror subclasses provide.  Rows are
+    (id, column values...) tuples of the Song columns that the mirror
+    names.
+    """
+
+    def lastId():
+        """Return the highest song id in the mirror (or 0 if it's empty)."""
+
+    def build(rows):
+        """
+        Prepare a full load's rows for replace().  This is called in a
+        database thread, so expensive preparation doesn't block the reactor.
+        """
+
+    def replace(data):
+        """Replace the mirror's contents with the result of build()."""
+
+    def update(ids, rows):
+        """
+        Apply changes to the mirror.  ``ids`` is the set of changed song ids
+        (which may include None for unidentified new rows), and ``rows``
+        holds the current rows of the changed songs that still exist.
+        """
+
+    def state():
+        """
+        Return the mirror's contents as a value that marshal can store in a
+        snapshot.
+        """
+
+    def undump(state):
+        """Replace the mirror's contents with the result of state()."""
+
+class Mirror(object):
+    """
+    Base class for mirrors of a library's songs.  Subclasses name the Song
+    ``columns`` they need and provide IMirror; they inherit a build() that
+    passes the rows through unchanged.
+
+    The mirror follows the library's revisions: ``revision`` is the library
+    revision it currently reflects, and wait() returns a Deferred that fires
+    once it has caught up with a given revision.  ``failure`` holds the
+    reason for its most recent failed update until it has been reloaded.
+    """
+
+    columns = ()
+
+    def __init__(self, library):
+        self.library = library
+        self.revision = None
+        self.waiters = []
+        self.updating = False
+        self.pending = set()
+        self.reload = False
+        self.failure = None
+        self.retry = None
+        self.delay = RETRY_DELAY
+
+        library.observe(self._changed)
+
+    @property
+    def current(self):
+        """True if the mirror reflects the library's current revision."""
+        return self.revision == self.library.revision
+
+    def load(self):
+        """
+        Begin loading the mirror from scratch, unless it already reflects the
+        current revision (having been restored from a snapshot).  wait()
+        tells when it has been loaded.
+        """
+        if not self.current:
+            self.reload = True
+            self._update()
+
+    def wait(self, revision):
+        """
+        Return a Deferred that fires once the mirror reflects the library at
+        the given revision (or later).  It fails if the mirror can't be
+        updated, and immediately if the mirror is waiting to be reloaded.
+        """
+        if self.revision is not None and self.revision >= revision:
+            return succeed(self.revision)
+        if self.failure is not None:
+            return fail(self.failure)
+        d = Deferred(lambda d: self.waiters.remove((revision, d)))
+        self.waiters.append((revision, d))
+        return d
+
+    def build(self, rows):
+        return rows
+
+    def dump(self):
+        """
+        Return the mirror's contents as a value that marshal can store in a
+        snapshot, or None if they can't be dumped right now.
+        """
+        if not self.current or self.updating:
+            return None
+        return self.state()
+
+    def restore(self, revision, state):
+        """
+        Replace the mirror's contents with a dump() taken when the library
+        was at the given revision, in place of loading them from scratch.
+        """
+        self.undump(state)
+        self._caughtUp(revision)
+
+    def _changed(self, changes):
+        for cls, id in changes:
+            if cls is Song:
+                self.pending.add(id)
+        self._update()
+
+    def _update(self):
+        # Only one update runs at a time.  Changes that arrive in the
+        # meantime are picked up (together) by the next one, or by the
+        # reload that follows a failure.
+        if self.updating or self.retry is not None:
+            return
+        if not self.pending and not self.reload:
+            self._caughtUp(self.library.revision)
+            return
+
+        reload, self.reload = self.reload, False
+        ids, self.pending = self.pending, set()
+        if reload:
+            d = self.library.run(self._load)
+        else:
+            d = self.library.run(self._select, ids, self.lastId())
+
+        def _apply(result):
+            self.updating = False
+            if reload:
+                self.replace(result)
+            else:
+                self.update(ids, result)
+            self.failure = None
+            self.delay = RETRY_DELAY
+            # The library may have moved on while the rows were being read.
+            self._update()
+
+        def _failed(failure):
+            self.updating = False
+            log.err(failure, 'Failed to update %r' % (self,))
+            self.failure = failure
+            self.reload = True
+            self.retry = self.library.reactor.callLater(self.delay,
+                                                        self._retry)
+            self.delay = min(self.delay * 2, RETRY_MAXIMUM)
+            waiters, self.waiters = self.waiters, []
+            for revision, d in waiters:
+                d.errback(failure)
+
+        self.updating = True
+        d.addCallbacks(_apply, _failed)
+
+    def _retry(self):
+        self.retry = None
+        self._update()
+
+    def _columns(self):
+        return [Song.id] + [getattr(Song, name) for name in self.columns]
+
+    def _load(self, session):
+        query = select(self._columns(), order_by=[Song.id])
+        return self.build(session.execute(query).fetchall())
+
+    def _select(self, session, ids, after):
+        columns = self._columns()
+        rows = {}
+        known = [id for id in ids if id is not None]
+        # Stay well below SQLite's limit on bound parameters.
+        for i in xrange(0, len(known), 500):
+            query = select(columns, Song.id.in_(known[i:i + 500]))
+            for row in session.execute(query):
+                rows[row[0]] = tuple(row)
+        # Bulk inserts can't identify their rows, but any new rows have ids
+        # beyond the highest one that the mirror already has.
+        if None in ids:
+            query = select(columns, Song.id > after)
+            for row in session.execute(query):
+                rows[row[0]] = tuple(row)
+        return [rows[id] for id in sorted(rows)]
+
+    def _caughtUp(self, revision):
+        self.revision = revision
+        waiters = [(r, d) for r, d in self.waiters if r <= revision]
+        if waiters:
+            self.waiters = [(r, d) for r, d in self.waiters if r > revision]
+            for r, d in waiters:
+                d.callback(revision)
@@ -1,13 +1,51 @@
 # Marconi Media Server
 # Copyright 2009 Jon Parise <jon@indelible.org>
 
+import os
 import struct
-from twisted.web import error, resource
+import sys
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from itertools import izip
+from collections import OrderedDict
+from operator import attrgetter
+from sqlalchemy import Binary, case, cast, func, literal
+from twisted.internet.defer import CancelledError, gatherResults, \
+                                    inlineCallbacks, returnValue, succeed
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from twisted.web import error, http, resource, server
+from twisted.web.server import NOT_DONE_YET
 from zope.interface import implements
 
+from marconi.artwork import ArtworkCache
+from marconi.browse import BrowseIndex
+from marconi.db import Change, Song
+from marconi.metrics import Metrics
+from marconi.net import query
+from marconi.net.session import SessionTable
+from marconi.net.stream import FileProducer, parseRange
+
 CONTENT_TYPE = 'application/x-dmap-tagged'
 ALLOWED_VERSIONS = ('1.0', '2.0')
 
+# The id of the library's (only) database.
+DATABASE_ID = 1
+
+# The number of records written at a time while streaming a listing response.
+STREAM_BATCH_SIZE = 1000
+
+# Responses smaller than COMPRESS_MINIMUM bytes are never compressed, and
+# those larger than COMPRESS_THREAD_MINIMUM bytes are compressed in a thread.
+COMPRESS_LEVEL = 6
+COMPRESS_MINIMUM = 1024
+COMPRESS_THREAD_MINIMUM = 256 * 1024
+
+# The interval (in seconds) at which the library's change log is compacted.
+COMPACT_INTERVAL = 300
+
 # Content Types
 #
 # The following section provides definitions for a number of type classes.
@@ -20,6 +58,7 @@ class Byte(int):
 
     id = 1
     size = 1
+    structFormat = '>B'
 
     def serialize(self):
         """Serialize the byte value into a 1-byte big-endian string."""
@@ -31,6 +70,7 @@ class Short(int):
 
     id = 3
     size = 2
+    structFormat = '>h'
 
     def serialize(self):
         """Serialize the short integer value into a 2-byte big-endian string."""
@@ -42,6 +82,7 @@ class Int(int):
 
     id = 5
     size = 4
+    structFormat = '>i'
 
     def serialize(self):
         """Serialize the integer value into 4-byte big-endian string."""
@@ -53,6 +94,7 @@ class Long(long):
 
     id = 7
     size = 8
+    structFormat = '>q'
 
     def serialize(self):
         """Serialize the long integer value into an 8-byte big-endian string."""
@@ -65,12 +107,14 @@ class String(str):
     size = property(len)
 
     def serialize(self):
-        return struct.pack('>s', self)
+        """Serialize the string's raw bytes."""
+        return str.__str__(self)
 
 class Date(int):
 
     id = 10
     size = 4
+    structFormat = '>i'
 
     def serialize(self):
         """Serialize the date into a 4-byte big-endian string."""
@@ -82,6 +126,7 @@ class Version(int):
 
     id = 11
     size = 4
+    structFormat = '>i'
 
     def serialize(self):
         """Serialize the version number into a 4-byte big-endian string."""
@@ -132,8 +177,8 @@ _codes = {
     'msau': ContentCode(Byte,       'dmap.authenticationmethod'),
     'mslr': ContentCode(Byte,       'dmap.loginrequired'),
     'mpro': ContentCode(Version,    'dmap.protocolversion'),
-    'apro': ContentCode(Version,    'protocolversion'),
-    'msal': ContentCode(Byte,       'dmap.supportsuatologout'),
+    'apro': ContentCode(Version,    'daap.protocolversion'),
+    'msal': ContentCode(Byte,       'dmap.supportsautologout'),
     'msup': ContentCode(Byte,       'dmap.supportsupdate'),
     'mspi': ContentCode(Byte,       'dmap.supportspersistentids'),
     'msex': ContentCode(Byte,       'dmap.supportsextensions'),
@@ -153,62 +198,132 @@ _codes = {
     'mlid': ContentCode(Int,        'dmap.sessionid'),
 
     'mupd': ContentCode(List,       'dmap.updateresponse'),
-    'msur': ContentCode(Int,        'dmap.serverrevision'),
+    'musr': ContentCode(Int,        'dmap.serverrevision'),
     'muty': ContentCode(Byte,       'dmap.updatetype'),
     'mudl': ContentCode(List,       'dmap.deletedidlisting'),
 
-    'avdb': ContentCode(List,       'serverdatabases'),
-    'abro': ContentCode(List,       'databasebrowse'),
-    'abal': ContentCode(List,       'browsealbumlistung'),
-    'abar': ContentCode(List,       'browseartistlisting'),
-    'abcp': ContentCode(List,       'browsecomposerlisting'),
-    'abgn': ContentCode(List,       'browsegenrelisting'),
-
-    'adbs': ContentCode(List,       'databasesongs'),
-    'asal': ContentCode(String,     'songalbum'),
-    'asar': ContentCode(String,     'songartist'),
-    'asbt': ContentCode(Short,      'songsbeatsperminute'),
-    'asbr': ContentCode(Short,      'songbitrate'),
-    'ascm': ContentCode(String,     'songcomment'),
-    'asco': ContentCode(Byte,       'songcompilation'),
-    'asda': ContentCode(Date,       'songdateadded'),
-    'asdm': ContentCode(Date,       'songdatemodified'),
-    'asdc': ContentCode(Short,      'songdisccount'),
-    'asdn': ContentCode(Short,      'songdiscnumber'),
-    'asdb': ContentCode(Byte,       'songdisabled'),
-    'aseq': ContentCode(String,     'songeqpreset'),
-    'asfm': ContentCode(String,     'songformat'),
-    'asgn': ContentCode(String,     'songgenre'),
-    'asdt': ContentCode(String,     'songdescription'),
-    'asrv': ContentCode(Byte,       'songrelativevolume'),
-    'assr': ContentCode(Int,        'songsamplerate'),
-    'assz': ContentCode(Int,        'songsize'),
-    'asst': ContentCode(Int,        'songstarttime'),
-    'assp': ContentCode(Int,        'songstoptime'),
-    'astm': ContentCode(Int,        'songtime'),
-    'astc': ContentCode(Short,      'songtrackcount'),
-    'astn': ContentCode(Short,      'songtracknumber'),
-    'asur': ContentCode(Byte,       'songuserrating'),
-    'asyr': ContentCode(Short,      'songyear'),
-    'asdk': ContentCode(Byte,       'songdatakind'),
-    'asul': ContentCode(String,     'songdataurl'),
-
-    'aply': ContentCode(List,       'databaseplaylists'),
-    'abpl': ContentCode(Byte,       'baseplaylist'),
-
-    'apso': ContentCode(List,       'playlistsongs'),
-
-    'prsv': ContentCode(List,       'resolve'),
-    'arif': ContentCode(List,       'resolveinfo'),
+    'avdb': ContentCode(List,       'daap.serverdatabases'),
+    'abro': ContentCode(List,       'daap.databasebrowse'),
+    'abal': ContentCode(List,       'daap.browsealbumlisting'),
+    'abar': ContentCode(List,       'daap.browseartistlisting'),
+    'abcp': ContentCode(List,       'daap.browsecomposerlisting'),
+    'abgn': ContentCode(List,       'daap.browsegenrelisting'),
+
+    'adbs': ContentCode(List,       'daap.databasesongs'),
+    'asal': ContentCode(String,     'daap.songalbum'),
+    'asar': ContentCode(String,     'daap.songartist'),
+    'asbt': ContentCode(Short,      'daap.songsbeatsperminute'),
+    'asbr': ContentCode(Short,      'daap.songbitrate'),
+    'ascm': ContentCode(String,     'daap.songcomment'),
+    'asco': ContentCode(Byte,       'daap.songcompilation'),
+    'ascp': ContentCode(String,     'daap.songcomposer'),
+    'asda': ContentCode(Date,       'daap.songdateadded'),
+    'asdm': ContentCode(Date,       'daap.songdatemodified'),
+    'asdc': ContentCode(Short,      'daap.songdisccount'),
+    'asdn': ContentCode(Short,      'daap.songdiscnumber'),
+    'asdb': ContentCode(Byte,       'daap.songdisabled'),
+    'aseq': ContentCode(String,     'daap.songeqpreset'),
+    'asfm': ContentCode(String,     'daap.songformat'),
+    'asgn': ContentCode(String,     'daap.songgenre'),
+    'asdt': ContentCode(String,     'daap.songdescription'),
+    'asrv': ContentCode(Byte,       'daap.songrelativevolume'),
+    'assr': ContentCode(Int,        'daap.songsamplerate'),
+    'assz': ContentCode(Int,        'daap.songsize'),
+    'asst': ContentCode(Int,        'daap.songstarttime'),
+    'assp': ContentCode(Int,        'daap.songstoptime'),
+    'astm': ContentCode(Int,        'daap.songtime'),
+    'astc': ContentCode(Short,      'daap.songtrackcount'),
+    'astn': ContentCode(Short,      'daap.songtracknumber'),
+    'asur': ContentCode(Byte,       'daap.songuserrating'),
+    'asyr': ContentCode(Short,      'daap.songyear'),
+    'asdk': ContentCode(Byte,       'daap.songdatakind'),
+    'asul': ContentCode(String,     'daap.songdataurl'),
+
+    'aply': ContentCode(List,       'daap.databaseplaylists'),
+    'abpl': ContentCode(Byte,       'daap.baseplaylist'),
+
+    'apso': ContentCode(List,       'daap.playlistsongs'),
+
+    'prsv': ContentCode(List,       'daap.resolve'),
+    'arif': ContentCode(List,       'daap.resolveinfo'),
 
     'aeNV': ContentCode(Int,        'com.apple.itunes.norm-volume'),
     'aeSP': ContentCode(Byte,       'com.apple.itunes.smart-playlist'),
 }
 
+#
+# DMAP Encoding
+#
+# Every block begins with an 8-byte header consisting of its four-character
+# tag and its big-endian payload size.  Fixed-size scalar types are packed
+# together with their header using a single precompiled Struct per tag, while
+# strings and containers only need the header.
+
+_header = struct.Struct('>4si')
+
+def _compilePackers(codes):
+    """
+    Precompile a packing function for each content code.  Scalar codes are
+    packed together with their header in one call; strings and containers
+    are mapped to ``None`` and only use the shared header Struct.
+    """
+    packers = {}
+    for tag, code in codes.iteritems():
+        format = getattr(code.type, 'structFormat', None)
+        if format is not None:
+            packer = struct.Struct('>4si' + format.lstrip('>'))
+            packers[tag] = (packer.pack_into, packer.size)
+        else:
+            packers[tag] = (None, 8)
+    return packers
+
+_packers = _compilePackers(_codes)
+
+def encode(block):
+    """
+    Encode a finished Block tree into a single preallocated bytearray.
+
+    The buffer is sized using the totals that Block.add() has already
+    accumulated, and the tree is then written front-to-back in a single
+    iterative pass.  Blocks must not be modified after they have been added
+    to a parent, or the parent's recorded size will be stale.
+    """
+    buffer = bytearray(8 + block.size)
+    packers = _packers
+    packHeader = _header.pack_into
+
+    offset = 0
+    stack = [block]
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+        b = pop()
+        pack, size = packers[b.tag]
+        if pack is not None:
+            pack(buffer, offset, b.tag, b.size, b.value)
+            offset += size
+            continue
+
+        packHeader(buffer, offset, b.tag, b.size)
+        offset += 8
+        if b.children:
+            children = b.children[:]
+            children.reverse()
+            extend(children)
+        elif isinstance(b.value, str):
+            end = offset + len(b.value)
+            buffer[offset:end] = b.value
+            offset = end
+
+    return buffer
+
 #
 # DAAP Data
 #
 
+"""Browse listings, whose ``mlit`` items are strings rather than lists."""
+_browseListings = frozenset(['abal', 'abar', 'abcp', 'abgn'])
+
 class Block(object):
     """
     A Block represents a DAAP tag and typed value.  The tag must be one of
@@ -222,8 +337,10 @@ class Block(object):
             code = _codes[tag]
         except KeyError:
             raise ValueError("'%s'is not a supported tag" % tag)
-        # Make sure that a compatible value type has been provided.
-        if not isinstance(value, code.type):
+        # Make sure that a compatible value type has been provided.  Listing
+        # items are also used as (browse) string values.
+        if not isinstance(value, code.type) and not (
+                tag == 'mlit' and isinstance(value, String)):
             raise TypeError('Expected value of type %s (%s given)' %
                             (code.type, type(value)))
 
@@ -244,11 +361,7 @@ class Block(object):
 
     def serialize(self):
         """Serialize this block into a dmap-tagged formatted string."""
-        (code,) = struct.unpack('>i', self.tag)
-        s = struct.pack('>ii', code, self.size)
-        s += self.value.serialize()
-        s += ''.join([child.serialize() for child in self.children])
-        return s
+        return str(encode(self))
 
     def __str__(self):
         """Return the DAAP-serialized representation of this block."""
@@ -263,13 +376,765 @@ class Block(object):
         return s
 
 
+#
+# DMAP Decoding
+#
+# Decoding is the inverse of encoding.  A View describes a single encoded
+# block within a shared memoryview, so walking a response never copies it:
+# only the values that are actually read are materialized.
+
+def _compileUnpackers(codes):
+    """Precompile a value unpacking function for each scalar content code."""
+    unpackers = {}
+    for tag, code in codes.iteritems():
+        format = getattr(code.type, 'structFormat', None)
+        if format is not None:
+            unpackers[tag] = struct.Struct(format).unpack_from
+    return unpackers
+
+_unpackers = _compileUnpackers(_codes)
+
+class View(object):
+    """
+    A lazy, read-only view of an encoded block.  A view knows its tag and
+    size, decodes its value on request and yields views of its children (if
+    it is a container) as it is iterated.
+    """
+
+    __slots__ = ('buffer', 'offset', 'tag', 'size', 'parent')
+
+    def __init__(self, buffer, offset=0, parent=None):
+        if offset + 8 > len(buffer):
+            raise ValueError('Truncated block header at offset %d' % offset)
+        self.buffer = buffer
+        self.offset = offset
+        self.parent = parent
+        self.tag, self.size = _header.unpack_from(buffer, offset)
+        if self.size < 0 or offset + 8 + self.size > len(buffer):
+            raise ValueError("Truncated '%s' block at offset %d" %
+                             (self.tag, offset))
+
+    def __repr__(self):
+        return "<View('%s(%d)' at %d)>" % (self.tag, self.size, self.offset)
+
+    def __len__(self):
+        """Return the encoded length of the block, including its header."""
+        return 8 + self.size
+
+    @property
+    def type(self):
+        """Return the block's content type, or None if its tag is unknown."""
+        if self.parent in _browseListings and self.tag == 'mlit':
+            return String
+        code = _codes.get(self.tag)
+        if code is not None:
+            return code.type
+        return None
+
+    @property
+    def isList(self):
+        return self.type is List
+
+    @property
+    def raw(self):
+        """Return a memoryview of the block's encoded value."""
+        start = self.offset + 8
+        return self.buffer[start:start + self.size]
+
+    @property
+    def value(self):
+        """
+        Decode and return the block's typed value.  Containers decode to an
+        empty List, and blocks with unknown tags to their raw bytes.
+        """
+        type = self.type
+        if type is List:
+            return List()
+        if type is String:
+            return String(self.raw.tobytes())
+        if type is None:
+            return self.raw.tobytes()
+        if self.size != type.size:
+            raise ValueError("'%s' value should be %d bytes (not %d)" %
+                             (self.tag, type.size, self.size))
+        (value,) = _unpackers[self.tag](self.buffer, self.offset + 8)
+        return type(value)
+
+    def __iter__(self):
+        """Yield a view of each of this container's children, in order."""
+        if not self.isList:
+            return
+        offset = self.offset + 8
+        end = offset + self.size
+        while offset < end:
+            child = View(self.buffer, offset, self.tag)
+            offset += 8 + child.size
+            if offset > end:
+                raise ValueError("'%s' overflows its '%s' container" %
+                                 (child.tag, self.tag))
+            yield child
+
+    def find(self, tag):
+        """Return a view of the first child with the given tag, or None."""
+        for child in self:
+            if child.tag == tag:
+                return child
+        return None
+
+    def toBlock(self):
+        """Rebuild the equivalent Block tree from this view."""
+        block = Block(self.tag, self.value)
+        for child in self:
+            block.add(child.toBlock())
+        return block
+
+def decode(data):
+    """
+    Return a View of the encoded block at the start of the given string,
+    bytearray or memoryview.  The data is not copied.
+    """
+    if not isinstance(data, memoryview):
+        data = memoryview(data)
+    return View(data, 0)
+
+def iterBlocks(data):
+    """Yield a View for each consecutive top-level block in the data."""
+    if not isinstance(data, memoryview):
+        data = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        view = View(data, offset)
+        offset += 8 + view.size
+        yield view
+
+#
+# Response Caching
+#
+
+def acceptsGzip(request):
+    """
+    Return True if the request's client accepts gzip-encoded responses: it
+    lists gzip (or the ``*`` wildcard, if gzip isn't listed) in its
+    Accept-Encoding header without a zero quality value.
+    """
+    header = request.getHeader('Accept-Encoding')
+    if not header:
+        return False
+    qualities = {}
+    for coding in header.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        if name == 'x-gzip':
+            name = 'gzip'
+        quality = 1.0
+        for param in params[1:]:
+            key, sep, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = max(quality, qualities.get(name, 0.0))
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+def gzip(body):
+    """Return the gzip-compressed form of the given response body."""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+class ResponseCache(object):
+    """
+    A cache of complete serialized responses.  Responses are keyed by their
+    request's path, query arguments (excluding the per-client session id),
+    client protocol version and the library revision at which they were
+    generated.  Each response may be cached in several content encodings
+    (such as 'identity' and 'gzip').  All of the cached responses are
+    discarded as soon as the library's revision moves on.
+    """
+
+    def __init__(self, maxsize=64 * 1024 * 1024, maxentry=16 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.maxentry = maxentry
+        self.revision = None
+        self.entries = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, request):
+        """Return the cache key for the given request."""
+        args = [(name, tuple(values))
+                for name, values in request.args.iteritems()
+                if name != 'session-id']
+        args.sort()
+        return (request.path, tuple(args),
+                request.getHeader('Client-DAAP-Version'))
+
+    def accepts(self, size):
+        """Return True if a response of the given size can be cached."""
+        return size <= self.maxentry
+
+    def get(self, request, revision, encoding='identity'):
+        """Return the cached body for the request at the given revision."""
+        key = (self.key(request), revision, encoding)
+        body = self.entries.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if type(body) is buffer:
+            # Restored bodies are read from the snapshot on first use.
+            body = self.entries[key] = str(body)
+        return body
+
+    def put(self, request, revision, body, encoding='identity'):
+        """Store a response body that was generated at the given revision."""
+        if revision != self.revision:
+            if self.revision is not None and revision < self.revision:
+                return
+            self.clear()
+            self.revision = revision
+        if not self.accepts(len(body)) or self.size + len(body) > self.maxsize:
+            return
+
+        key = (self.key(request), revision, encoding)
+        if key not in self.entries:
+            self.entries[key] = body
+            self.size += len(body)
+
+    def clear(self):
+        """Discard every cached response."""
+        self.entries.clear()
+        self.size = 0
+
+    def dump(self, revision):
+        """
+        Return a list of (key, encoding, body) for each of the responses
+        cached at the given revision.
+        """
+        if revision != self.revision:
+            return []
+        return [(key, encoding, body)
+                for (key, r, encoding), body in self.entries.iteritems()]
+
+    def restore(self, revision, responses):
+        """
+        Cache (key, encoding, body) responses that were generated at the
+        given revision.  Bodies may be buffers, such as those of a
+        memory-mapped snapshot.
+        """
+        self.clear()
+        self.revision = revision
+        for key, encoding, body in responses:
+            if self.size + len(body) <= self.maxsize:
+                self.entries[(key, revision, encoding)] = body
+                self.size += len(body)
+
+#
+# Streaming
+#
+
+class RecordList(object):
+    """
+    A listing of records that have already been encoded, which are read
+    ``batchSize`` at a time.  Like a SongListing, it has a ``count`` and a
+    ``size``, and read() returns a Deferred.
+    """
+
+    def __init__(self, records, batchSize=STREAM_BATCH_SIZE):
+        self.records = records
+        self.batchSize = batchSize
+        self.count = len(records)
+        self.size = sum(map(len, records))
+        self.position = 0
+
+    def read(self):
+        start = self.position
+        self.position += self.batchSize
+        return succeed(''.join(self.records[start:self.position]))
+
+    def close(self):
+        self.records = []
+
+@inlineCallbacks
+def readListing(listing):
+    """
+    Return a Deferred that fires with all of a listing's records, joined
+    together.  The listing is closed once they have been read.
+    """
+    records = []
+    try:
+        while True:
+            data = yield listing.read()
+            if not data:
+                break
+            records.append(data)
+    finally:
+        listing.close()
+    returnValue(''.join(records))
+
+class ListingProducer(object):
+    """
+    A push producer that streams a listing response to a request.  The
+    response's prefix (the container header, its status blocks and the
+    ``mlcl`` listing header) is written first, followed by the records of
+    the ``listing`` (a SongListing or RecordList), one batch at a time and
+    only for as long as the transport is accepting data, so other clients
+    continue to be served during a large listing, and it is never held in
+    memory as a whole.  A ``store`` callable, if given, is passed the
+    complete response body once it has been written; only then are the
+    batches kept.
+    """
+
+    implements(IPushProducer)
+
+    def __init__(self, request, prefix, listing, store=None):
+        self.request = request
+        self.prefix = prefix
+        self.listing = listing
+        self.store = store
+        self.body = store is not None and [prefix] or None
+        self.paused = False
+        self.producing = False
+        self.reading = False
+        self.finished = False
+
+    def start(self):
+        """Begin streaming the response to the request."""
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addErrback(self._connectionLost)
+        self.request.write(self.prefix)
+        self._produce()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._produce()
+
+    def stopProducing(self):
+        self.finished = True
+        self.body = None
+        self.listing.close()
+
+    def _produce(self):
+        # Batches are read one at a time.  Those that are read immediately
+        # are written by this loop, and the others call it again once they
+        # have been written.
+        if self.producing:
+            return
+        self.producing = True
+        try:
+            while not self.paused and not self.finished and \
+                  not self.reading:
+                self.reading = True
+                d = self.listing.read()
+                d.addCallbacks(self._write, self._failed)
+        finally:
+            self.producing = False
+
+    def _write(self, data):
+        self.reading = False
+        if self.finished:
+            return
+        if not data:
+            self._finish()
+            return
+        if self.body is not None:
+            self.body.append(data)
+        # Writing a batch may pause us (or lose the connection).
+        self.request.write(data)
+        self._produce()
+
+    def _failed(self, failure):
+        self.reading = False
+        log.err(failure, 'Failed to read %r' % (self.listing,))
+        if not self.finished:
+            # Part of the response has already been sent, so the client
+            # can only be told by dropping the connection.
+            self.stopProducing()
+            self.request.unregisterProducer()
+            self.request.transport.loseConnection()
+
+    def _finish(self):
+        # The body is stored before the request is finished, so that it can
+        # serve the requests that follow this one.
+        self.finished = True
+        if self.store is not None:
+            self.store(''.join(self.body))
+        self.body = None
+        self.request.unregisterProducer()
+        self.request.finish()
+        self.listing.close()
+
+    def _connectionLost(self, reason):
+        self.stopProducing()
+
+#
+# Records
+#
+
+def _string(value):
+    """Return a UTF-8 encoded String for the given (possibly empty) value."""
+    if value is None:
+        return String()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return String(value)
+
+def databaseRecord(name, songs, containers):
+    """
+    Return an ``mlit`` database record for the library's database, which
+    holds the given numbers of songs and containers (playlists).
+    """
+    db = Block('mlit', List())                      # database record
+    db.add(Block('miid', Int(DATABASE_ID)))         # database id
+    db.add(Block('mper', Long(DATABASE_ID)))        # database persistent id
+    db.add(Block('minm', _string(name)))            # database name
+    db.add(Block('mimc', Int(songs)))               # database item count
+    db.add(Block('mctc', Int(containers)))          # database container count
+    return db
+
+def containerRecord(playlist, count):
+    """Return an ``mlit`` container record for the given playlist."""
+    r = Block('mlit', List())                       # container record
+    r.add(Block('miid', Int(playlist.id)))          # container id
+    r.add(Block('mper', Long(playlist.id)))         # container persistent id
+    r.add(Block('minm', _string(playlist.name)))    # container name
+    r.add(Block('mimc', Int(count)))                # number of items
+    return r
+
+def containerItemRecord(record, entry):
+    """
+    Return an encoded ``mlit`` song record with the song's container item
+    id (its playlist entry's id) appended to it.
+    """
+    mcti = Block('mcti', Int(entry)).serialize()
+    size = len(record) - 8 + len(mcti)
+    return _header.pack('mlit', size) + record[8:] + mcti
+
+"""Song content codes and the Song columns that provide their values."""
+_songColumns = {
+    'miid': 'id',
+    'minm': 'title',
+    'mper': 'id',
+    'asal': 'album',
+    'asar': 'artist',
+    'asbr': 'bitrate',
+    'asbt': 'bpm',
+    'ascm': 'comment',
+    'asco': 'compilation',
+    'ascp': 'composer',
+    'asda': 'dateadded',
+    'asdm': 'datemodified',
+    'asdc': 'disccount',
+    'asdn': 'discnumber',
+    'asfm': 'format',
+    'asgn': 'genre',
+    'assr': 'samplerate',
+    'assz': 'size',
+    'astm': 'time',
+    'astc': 'trackcount',
+    'astn': 'tracknumber',
+    'asyr': 'year',
+}
+
+"""Song content codes and the functions that provide their values."""
+_songFields = dict([(tag, attrgetter(name))
+                    for tag, name in _songColumns.iteritems()])
+_songFields['mikd'] = lambda song: 2                # item kind (2 for music)
+
+"""Content code names (such as ``daap.songalbum``) mapped to their tags."""
+_names = dict([(code.name, tag) for tag, code in _codes.iteritems()])
+
+"""The song fields returned when a request doesn't specify any."""
+DEFAULT_META = ('mikd', 'miid', 'minm', 'mper', 'asal', 'asar')
+
+def parseMeta(request):
+    """
+    Return the tuple of song tags requested by the request's ``meta``
+    argument, in the order they were requested.  Unknown or unsupported
+    fields are ignored.
+    """
+    values = request.args.get('meta')
+    if not values:
+        return DEFAULT_META
+
+    tags = []
+    for value in values:
+        for name in value.split(','):
+            tag = _names.get(name.strip())
+            if tag in _songFields and tag not in tags:
+                tags.append(tag)
+    return tuple(tags)
+
+def queryText(request):
+    """Return the request's ``query`` (or ``filter``) argument, or None."""
+    values = request.args.get('query') or request.args.get('filter')
+    if not values:
+        return None
+    return values[0]
+
+def parseQuery(request):
+    """
+    Return the SQL clause compiled from the request's ``query`` (or
+    ``filter``) argument, or None if the request doesn't filter its results.
+    Raises query.QueryError if the expression is malformed.
+    """
+    text = queryText(request)
+    if text is None:
+        return None
+    return query.compile(text)
+
+def parseIndex(request):
+    """
+    Return the inclusive (start, end) range of records requested by the
+    request's ``index`` argument (such as ``0-99``), or None if the request
+    doesn't ask for a range.  The end is None for open ranges (``100-``).
+    Raises ValueError if the range is malformed.
+    """
+    values = request.args.get('index')
+    if not values:
+        return None
+    first, sep, last = values[0].partition('-')
+    try:
+        start = int(first)
+        if not sep:
+            end = start
+        elif last.strip():
+            end = int(last)
+        else:
+            end = None
+    except ValueError:
+        start = -1
+    if start < 0 or (end is not None and end < start):
+        raise ValueError('Invalid index range: %s' % values[0])
+    return start, end
+
+def parseDelta(request):
+    """
+    Return the revision from which the request's ``delta`` argument asks
+    for the changes, or None if the request wants a complete listing.
+    Raises ValueError if the revision is malformed.
+    """
+    values = request.args.get('delta')
+    if not values:
+        return None
+    try:
+        delta = int(values[0])
+    except ValueError:
+        delta = -1
+    if delta < 0:
+        raise ValueError('Invalid delta revision: %s' % values[0])
+    return delta or None
+
+def deletedRecords(ids):
+    """Return the encoded ``miid`` records of an ``mudl`` listing."""
+    return ''.join([Block('miid', Int(id)).serialize() for id in ids])
+
+def sliceRange(sequence, span):
+    """Return the part of a sequence within a parseIndex() range."""
+    start, end = span
+    if end is None:
+        return sequence[start:]
+    return sequence[start:end + 1]
+
+def browseRecords(values):
+    """
+    Return the number of values and their encoded ``mlit`` browse records.
+    Unlike other listings, each browse record is just the value's string.
+    """
+    pack = _header.pack
+    records = []
+    for value in values:
+        value = _string(value)
+        records.append(pack('mlit', len(value)))
+        records.append(value)
+    return len(values), ''.join(records)
+
+def songRecord(song, tags=DEFAULT_META):
+    """
+    Return an ``mlit`` listing record for the given song containing the
+    requested tags.  Fields without a value are omitted.
+    """
+    r = Block('mlit', List())                       # song entry
+    for tag in tags:
+        value = _songFields[tag](song)
+        if value is None:
+            continue
+        type = _codes[tag].type
+        if type is String:
+            value = _string(value)
+        else:
+            value = type(value)
+        r.add(Block(tag, value))
+    return r
+
+def songRecordSize(tags=DEFAULT_META):
+    """
+    Return a SQL expression for the length of a song's ``mlit`` record with
+    the given tags, exactly as songRecord() encodes it.  Tags that aren't
+    Song columns always have a value.
+    """
+    size = literal(8)
+    for tag in tags:
+        type = _codes[tag].type
+        name = _songColumns.get(tag)
+        if name is None:
+            size = size + (8 + type.size)
+            continue
+        column = Song.__table__.c[name]
+        if type is String:
+            # Strings are stored (and sent) as UTF-8.
+            size = size + func.coalesce(
+                func.length(cast(column, Binary)) + 8, 0)
+        else:
+            size = size + case([(column == None, 0)], else_=8 + type.size)
+    return size
+
+class RecordCache(object):
+    """
+    A least-recently-used cache of encoded song records, keyed by the song's
+    id and the tuple of requested tags.  Entries are invalidated as soon as
+    their song's row is changed.
+
+    Listings read every song in id order, and a cache that is smaller than
+    such a scan misses on every record.  The cache therefore holds at least
+    ``maxsize`` records, and reserve() makes room for ``sets`` records per
+    song of the largest listing that has been read.  (Clients tend to
+    request their listings with just one or two sets of tags.)
+    """
+
+    def __init__(self, maxsize=100000, sets=2):
+        self.maxsize = maxsize
+        self.sets = sets
+        self.entries = OrderedDict()
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.revision = 0
+        self.lock = threading.Lock()
+
+    def get(self, song, tags, revision=None):
+        """
+        Return the encoded record for the given song and tags.  The cache
+        may be used from any thread.  Songs that were read at an older
+        ``revision`` of the library than the latest invalidation may have
+        changed since, so their records are encoded but not stored.
+        """
+        key = (song.id, tags)
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.hits += 1
+                self.entries[key] = data
+                return data
+            self.misses += 1
+
+        data = songRecord(song, tags).serialize()
+        with self.lock:
+            if revision is not None and revision < self.revision:
+                return data
+            if key not in self.entries:
+                self.keys.setdefault(song.id, set()).add(tags)
+                if len(self.entries) >= self.maxsize:
+                    self._evict()
+            self.entries[key] = data
+        return data
+
+    def reserve(self, count):
+        """Make room for the records of a listing of ``count`` songs."""
+        self.maxsize = max(self.maxsize, count * self.sets)
+
+    def invalidate(self, changes, revision):
+        """
+        Discard the records of any songs changed by the given revision of
+        the library.
+        """
+        with self.lock:
+            self.revision = max(self.revision, revision)
+            for cls, id in changes:
+                if cls is not Song:
+                    continue
+                for tags in self.keys.pop(id, ()):
+                    del self.entries[(id, tags)]
+
+    def clear(self):
+        """Discard every cached record."""
+        with self.lock:
+            self.entries.clear()
+            self.keys.clear()
+
+    def _evict(self):
+        (id, tags), data = self.entries.popitem(last=False)
+        metas = self.keys[id]
+        metas.discard(tags)
+        if not metas:
+            del self.keys[id]
+
+#
+# Instrumentation
+#
+
+class Request(server.Request):
+    """
+    A request that records its endpoint, latency and response size in the
+    server's metrics once it completes.  The endpoint is named by the
+    ``endpoint`` attribute of the resource that renders the request.
+    """
+
+    endpoint = 'other'
+    started = 0.0
+
+    def process(self):
+        self.started = time.time()
+        server.Request.process(self)
+
+    def render(self, resrc):
+        self.endpoint = getattr(resrc, 'endpoint', None) or 'other'
+        server.Request.render(self, resrc)
+
+    def finish(self):
+        server.Request.finish(self)
+        metrics = Resource.metrics
+        if metrics is not None and self.finished:
+            metrics.request(self.endpoint, time.time() - self.started,
+                            self.sentLength, self.code)
+
+    def connectionLost(self, reason):
+        finished = self.finished
+        server.Request.connectionLost(self, reason)
+        metrics = Resource.metrics
+        if metrics is not None and not finished:
+            metrics.abort(self.endpoint)
+
+
+class Site(server.Site):
+    requestFactory = Request
+
+
 class Resource:
-    """Base Abstract Resource"""
+    """
+    Base Abstract Resource
+
+    Unless ``requiresSession`` is false, requests must identify a live
+    session with their ``session-id`` argument, or they are refused.
+    """
 
     implements(resource.IResource)
 
     isLeaf = False
+    endpoint = None
+    requiresSession = True
+    artwork = None
+    browse = None
     library = None
+    metrics = None
+    records = None
+    responses = None
+    sessions = None
 
     def putChild(self, path, child):
         from twisted.web.server import UnsupportedMethod
@@ -280,24 +1145,202 @@ class Resource:
             request.setResponseCode(http.BAD_REQUEST, 'Invalid request')
             return False
 
+        # Clients respond to a refused session by logging in again.
+        if self.requiresSession and self.sessions is not None and \
+           self.session(request) is None:
+            request.setResponseCode(http.FORBIDDEN, 'Invalid session')
+            return False
+
         # TODO: Respect the complete ALLOWED_VERSIONS set.
 #        if request.getHeader('Client-DAAP-Version') != ['1.0']:
 #            request.setResponseCode(http.BAD_REQUEST, 'Invalid request')
 #            return False
 
         request.setHeader('Content-Type', CONTENT_TYPE)
+        request.setHeader('Vary', 'Accept-Encoding')
         return True
 
+    def session(self, request):
+        """
+        Return the session identified by the request's ``session-id``
+        argument, or None if it doesn't identify a live session.  This also
+        keeps the session from expiring.
+        """
+        if self.sessions is None:
+            return None
+        try:
+            id = int(request.args['session-id'][0])
+        except (KeyError, ValueError):
+            return None
+        return self.sessions.get(id)
+
+    def cachedResponse(self, request):
+        """
+        Send the cached response for this request, if one is available.
+        Returns None if the response must be generated.
+        """
+        if self.responses is None:
+            return None
+        revision = self.library.revision
+        body = self.responses.get(request, revision)
+        if body is None:
+            return None
+        return self.send(request, body, revision)
+
+    def respond(self, request, body, revision):
+        """Cache and send a complete response generated at a revision."""
+        if self.responses is not None:
+            self.responses.put(request, revision, body)
+        return self.send(request, body, revision)
+
+    def send(self, request, body, revision):
+        """
+        Send a complete response body, gzip-compressing it if the client
+        accepts that encoding and the body is large enough to benefit.
+        Compressed bodies are cached alongside their uncompressed originals,
+        and large bodies are compressed off of the reactor thread.
+        """
+        if len(body) < COMPRESS_MINIMUM or not acceptsGzip(request):
+            request.setHeader('Content-Length', str(len(body)))
+            return body
+
+        def _send(compressed):
+            request.setHeader('Content-Encoding', 'gzip')
+            request.setHeader('Content-Length', str(len(compressed)))
+            return compressed
+
+        def _store(compressed):
+            if self.responses is not None:
+                self.responses.put(request, revision, compressed, 'gzip')
+            return compressed
+
+        if self.responses is not None:
+            compressed = self.responses.get(request, revision, 'gzip')
+            if compressed is not None:
+                return _send(compressed)
+
+        if len(body) < COMPRESS_THREAD_MINIMUM:
+            return _send(_store(gzip(body)))
+
+        from twisted.internet.threads import deferToThread
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def _write(compressed):
+            if not finished:
+                request.write(_send(compressed))
+                request.finish()
+
+        def _failed(failure):
+            log.err(failure, 'Failed to compress response')
+            if not finished:
+                request.setHeader('Content-Length', str(len(body)))
+                request.write(body)
+                request.finish()
+
+        d = deferToThread(gzip, body)
+        d.addCallback(_store)
+        d.addCallbacks(_write, _failed)
+        return NOT_DONE_YET
+
+    def deferred(self, request, d):
+        """
+        Complete the request once the given Deferred fires with a response
+        body.  A result of NOT_DONE_YET indicates that the request has been
+        (or will be) completed some other way.  Returns NOT_DONE_YET.
+        """
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def _respond(body):
+            if body is not NOT_DONE_YET and not finished:
+                request.write(body)
+                request.finish()
+
+        def _failed(failure):
+            log.err(failure, 'Failed to render %s' % (request.path,))
+            if not finished:
+                request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+                request.setHeader('Content-Length', '0')
+                request.finish()
+
+        d.addCallbacks(_respond, _failed)
+        return NOT_DONE_YET
+
+    def deltaListing(self, response, records, deleted):
+        """
+        Return the body of a delta listing response: the ``response``
+        container block (already populated with its status blocks), holding
+        an ``mlcl`` listing of the given encoded records followed by an
+        ``mudl`` listing of the deleted ids (if there are any).
+        """
+        records = ''.join(records)
+        body = [child.serialize() for child in response.children]
+        body.append(_header.pack('mlcl', len(records)))
+        body.append(records)
+        if deleted:
+            records = deletedRecords(deleted)
+            body.append(_header.pack('mudl', len(records)))
+            body.append(records)
+        body = ''.join(body)
+        return _header.pack(response.tag, len(body)) + body
+
+    def streamListing(self, request, response, listing, revision):
+        """
+        Send a listing response whose ``mlcl`` records are those of the
+        given listing (a SongListing, or a list of encoded records), which
+        were all read at the given revision of the library.  The response
+        is sent as a complete (cached) body, or its records are streamed by
+        a ListingProducer.
+
+        ``response`` is the outer container block (such as ``adbs``) which
+        has already been populated with its leading status blocks.
+        """
+        if isinstance(listing, list):
+            listing = RecordList(listing)
+        size = listing.size
+
+        # The container header using its final size, followed by its status
+        # blocks and the listing's header.
+        prefix = [_header.pack(response.tag, response.size + 8 + size)]
+        prefix.extend([child.serialize() for child in response.children])
+        prefix.append(_header.pack('mlcl', size))
+        prefix = ''.join(prefix)
+
+        # Complete responses are cached as long as they aren't too large.
+        store = None
+        total = len(prefix) + size
+        if self.responses is not None and self.responses.accepts(total):
+            # Clients that accept compressed responses are better served by
+            # a complete (cached) body that can be compressed in one go.
+            if acceptsGzip(request):
+                d = readListing(listing)
+                d.addCallback(lambda records: self.respond(
+                    request, prefix + records, revision))
+                return d
+            store = lambda body: self.responses.put(request, revision, body)
+
+        request.setHeader('Content-Length', str(total))
+        producer = ListingProducer(request, prefix, listing, store)
+        producer.start()
+
+        return NOT_DONE_YET
+
 
 class RootResource(Resource):
+    endpoint = 'root'
+    requiresSession = False
 
     def __init__(self):
         self.children = {
             'server-info':          ServerInfoResource,
             'content-codes':        ContentCodesResource,
             'login':                LoginResource,
+            'logout':               LogoutResource,
             'update':               UpdateResource,
             'databases':            DatabasesResource,
+            'metrics':              MetricsResource,
         }
 
     def getChildWithDefault(self, name, request):
@@ -312,13 +1355,18 @@ class RootResource(Resource):
 
 
 class ServerInfoResource(Resource):
-    
     isLeaf = True
+    endpoint = 'server-info'
+    requiresSession = False
 
     def render(self, request):
         if not self.preRender(request):
             return ''
 
+        body = self.cachedResponse(request)
+        if body is not None:
+            return body
+
         name = String(self.library.name)
 
         # Respond with protocol versions appropriate to this request's client.
@@ -339,143 +1387,849 @@ class ServerInfoResource(Resource):
         r.add(Block('apro', apro))                  # DAAP protocol version
         r.add(Block('minm', name))                  # server name
         r.add(Block('msau', Byte(0)))               # authentication method
-        r.add(Block('mstm', Int(1800)))             # timeout (seconds)
+        r.add(Block('mstm', Int(self.sessions.timeout)))  # timeout (seconds)
  
         # These blocks indicate that we support various features.  The
         # presence of these blocks is enough to signal our support, so the
         # value is required to be zero.
 #       r.add(Block('msex', Byte(0)))               # extensions?
 #       r.add(Block('msix', Byte(0)))               # indexing?
-#       r.add(Block('msbr', Byte(0)))               # browsing?
-#       r.add(Block('msqy', Byte(0)))               # querying?
-#       r.add(Block('msup', Byte(0)))               # updating?
+        r.add(Block('msbr', Byte(0)))               # browsing
+        r.add(Block('msqy', Byte(0)))               # querying
+        r.add(Block('msup', Byte(0)))               # updating
 #       r.add(Block('mspi', Byte(0)))               # persistent IDs?
-#       r.add(Block('msal', Byte(0)))               # auto-logout?
+        r.add(Block('msal', Byte(0)))               # auto-logout
 #       r.add(Block('msrs', Byte(0)))               # resolve (requires mspi)?
 
-        # database count
-        r.add(Block('msdc', Int(self.library.playlists.count())))
+        # database count (the library is served as a single database)
+        r.add(Block('msdc', Int(1)))
 
-        return r.serialize()
+        return self.respond(request, r.serialize(), self.library.revision)
 
 class ContentCodesResource(Resource):
     isLeaf = True
+    endpoint = 'content-codes'
+    requiresSession = False
+
+    def render(self, request):
+        if not self.preRender(request):
+            return ''
+
+        body = self.cachedResponse(request)
+        if body is not None:
+            return body
+
+        r = Block('mccr', List())                   # content codes response
+        r.add(Block('mstt', Int(200)))              # status
+        for tag in sorted(_codes):
+            code = _codes[tag]
+            d = Block('mdcl', List())               # dictionary
+            d.add(Block('mcnm', Int(struct.unpack('>i', tag)[0])))
+            d.add(Block('mcna', String(code.name)))
+            d.add(Block('mcty', Short(code.type.id)))
+            r.add(d)
+
+        return self.respond(request, r.serialize(), self.library.revision)
 
 
 class LoginResource(Resource):
     isLeaf = True
+    endpoint = 'login'
+    requiresSession = False
+
+    def render(self, request):
+        if not self.preRender(request):
+            return ''
+
+        session = self.sessions.create()
+
+        r = Block('mlog', List())                   # login response
+        r.add(Block('mstt', Int(200)))              # status
+        r.add(Block('mlid', Int(session.id)))       # session id
+
+        return r.serialize()
+
+
+class LogoutResource(Resource):
+    isLeaf = True
+    endpoint = 'logout'
+
+    def render(self, request):
+        if not self.preRender(request):
+            return ''
+
+        session = self.session(request)
+        if session is not None:
+            self.sessions.remove(session.id)
+
+        request.setResponseCode(http.NO_CONTENT)
+        return ''
 
 
 class UpdateResource(Resource):
     isLeaf = True
+    endpoint = 'update'
+
+    def render(self, request):
+        if not self.preRender(request):
+            return ''
+
+        try:
+            revision = int(request.args.get('revision-number', ['0'])[0])
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST, 'Invalid request')
+            return ''
+
+        session = self.session(request)
+
+        # Hold the request open until the library has moved past the client's
+        # current revision.  Clients with an out-of-date (or no) revision are
+        # answered immediately.
+        d = self.library.waitForRevision(revision)
+        if d.called:
+            return self._response(session, d.result)
+
+        # The session tracks its in-flight update so that it can be cancelled
+        # if the session is logged out or expires.
+        if session is not None:
+            session.addUpdate(d)
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def _finish(revision):
+            if not finished:
+                request.write(self._response(session, revision))
+                request.finish()
+
+        def _cancelled(failure):
+            failure.trap(CancelledError)
+            if not finished:
+                request.setResponseCode(http.NO_CONTENT)
+                request.finish()
+
+        d.addCallbacks(_finish, _cancelled)
+        request.notifyFinish().addErrback(lambda reason: d.cancel())
+        return NOT_DONE_YET
+
+    def _response(self, session, revision):
+        if session is not None:
+            session.sent(revision)
+
+        r = Block('mupd', List())                   # update response
+        r.add(Block('mstt', Int(200)))              # status
+        r.add(Block('musr', Int(revision)))         # server revision
+        return r.serialize()
 
 
 class DatabasesResource(Resource):
     isLeaf = False
+    endpoint = 'databases'
 
     def render(self, request):
         if not self.preRender(request):
             return ''
 
+        body = self.cachedResponse(request)
+        if body is not None:
+            return body
+
+        revision = self.library.revision
+        d = gatherResults([self.library.getSongIds(),
+                           self.library.getPlaylistIds()])
+        d.addCallback(self._render, request, revision)
+        return self.deferred(request, d)
+
+    def _render(self, counts, request, revision):
+        # The whole library is served as a single database, whose containers
+        # are its playlists.
+        songs, playlists = counts
+        record = databaseRecord(self.library.name, len(songs), len(playlists))
+
         r = Block('avdb', List())                   # database response
         r.add(Block('mstt', Int(200)))              # status
         r.add(Block('muty', Byte(0)))               # update type (always 0)
         r.add(Block('mtco', Int(1)))                # matching record count
         r.add(Block('mrco', Int(1)))                # returned record count
+        return self.streamListing(request, r, [record.serialize()], revision)
 
-        databases = Block('mlcl', List())           # record listing
+    def getChild(self, path, request):
+        try:
+            id = int(path)
+        except ValueError:
+            return error.NoResource()
+        if id != DATABASE_ID:
+            return error.NoResource()
+        return DatabaseResource(id)
 
-        for p in self.library.playlists.all():
-            db = Block('mlit', List())              # database record
-            db.add(Block('miid', Int(p.id)))        # database id
-            db.add(Block('mper', Long(p.id)))       # database persistent id
-            db.add(Block('minm', String(p.name)))   # database name
-            db.add(Block('mimc', Int(0)))           # database item count
-            db.add(Block('mctc', Int(0)))           # database container count
-            databases.add(db)
+    def getChildWithDefault(self, name, request):
+        return self.getChild(name, request)
 
-        r.add(databases)
 
-        return r.serialize()
+class DatabaseResource(Resource):
+    isLeaf = False
+    endpoint = 'database'
 
-    def getChild(self, path, request):
-        id = int(path)
-        return DatabaseItemsResource(id)
+    def __init__(self, id):
+        self.id = id
+        self.children = {
+            'items':                DatabaseItemsResource,
+            'browse':               DatabaseBrowseResource,
+            'containers':           DatabaseContainersResource,
+        }
 
     def getChildWithDefault(self, name, request):
-        return self.getChild(name, request)
+        try:
+            return self.children[name](self.id)
+        except KeyError:
+            return error.NoResource()
+
+    def render(self, request):
+        request.setResponseCode(http.BAD_REQUEST, 'Invalid request')
+        return ''
 
 
 class DatabaseItemsResource(Resource):
-    isLeaf = True
+    isLeaf = False
+    endpoint = 'items'
 
     def __init__(self, id):
         self.id = id
 
+    def getChildWithDefault(self, name, request):
+        # Song files are requested as "<id>.<format>" (e.g. "42.mp3").
+        try:
+            id = int(name.split('.', 1)[0])
+        except ValueError:
+            return error.NoResource()
+        return SongResource(id)
+
     def render(self, request):
         if not self.preRender(request):
             return ''
 
-        playlist = self.library.playlists.filter_by(id=self.id)
+        body = self.cachedResponse(request)
+        if body is not None:
+            return body
+
+        try:
+            clause = parseQuery(request)
+            span = parseIndex(request)
+            delta = parseDelta(request)
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST, str(e))
+            return ''
 
-        name = String('Test Song Name')
+        key = queryText(request)
+        if delta is not None:
+            d = self.library.changelog.changes(delta)
+            d.addCallback(self._renderChanges, request, clause, key, span)
+        else:
+            d = self._renderListing(request, clause, key, span)
+        return self.deferred(request, d)
 
+    def _renderListing(self, request, clause, key, span):
+        if span is not None:
+            d = self.library.getSongIds(clause, key)
+            d.addCallback(self._renderRange, request, span)
+        else:
+            d = self._render(request, clause)
+        return d
+
+    def _renderChanges(self, changes, request, clause, key, span):
+        # Clients are sent a complete listing if the change log can't tell
+        # what has changed since their revision.
+        if changes is None:
+            return self._renderListing(request, clause, key, span)
+        d = self.library.getSongIds(clause, key)
+        d.addCallback(self._renderDelta, changes[Change.SONG], request, span)
+        return d
+
+    def _response(self, matching, returned):
         r = Block('adbs', List())                   # song list
         r.add(Block('mstt', Int(200)))              # status
         r.add(Block('muty', Byte(0)))               # update type (always 0)
-        r.add(Block('mtco', Int(1)))                # matching record count
-        r.add(Block('mrco', Int(1)))                # returned record count
+        r.add(Block('mtco', Int(matching)))         # matching record count
+        r.add(Block('mrco', Int(returned)))         # returned record count
+        return r
+
+    @inlineCallbacks
+    def _render(self, request, clause):
+        tags = parseMeta(request)
+        listing = yield self.library.listSongs(
+            lambda song, revision: self.records.get(song, tags, revision),
+            songRecordSize(tags), clause=clause)
+        self.records.reserve(listing.count)
+        returnValue(self.streamListing(
+            request, self._response(listing.count, listing.count), listing,
+            listing.revision))
+
+    @inlineCallbacks
+    def _renderRange(self, ids, request, span):
+        tags = parseMeta(request)
+
+        # Only the requested slice of the (ordered) matching ids is read, but
+        # the client is likely to page through the rest of them.
+        self.records.reserve(len(ids))
+        listing = yield self.library.listSongs(
+            lambda song, revision: self.records.get(song, tags, revision),
+            songRecordSize(tags), ids=sliceRange(ids, span))
+        returnValue(self.streamListing(
+            request, self._response(len(ids), listing.count), listing,
+            listing.revision))
+
+    @inlineCallbacks
+    def _renderDelta(self, ids, changed, request, span):
+        revision = self.library.revision
+        tags = parseMeta(request)
+
+        # Changed songs that (still) match are listed.  As far as the
+        # client's listing is concerned, the others have been deleted.
+        matching = []
+        deleted = []
+        for id in changed:
+            i = bisect_left(ids, id)
+            if i < len(ids) and ids[i] == id:
+                matching.append(id)
+            else:
+                deleted.append(id)
+        if span is not None:
+            matching = sliceRange(matching, span)
+
+        found = yield self.library.readSongs(
+            lambda song: (song.id, self.records.get(song, tags, revision)),
+            ids=matching)
+        if len(found) != len(matching):
+            present = set([id for id, record in found])
+            deleted.extend([id for id in matching if id not in present])
+            deleted.sort()
+
+        records = [record for id, record in found]
+        body = self.deltaListing(self._response(len(ids), len(records)),
+                                 records, deleted)
+        returnValue(self.respond(request, body, revision))
+
+
+class DatabaseBrowseResource(Resource):
+    isLeaf = False
+    endpoint = 'browse'
 
-        song = Block('mlit', List())                # song entry
-        song.add(Block('mikd', Byte(2)))            # item kind (2 for music)
-        song.add(Block('miid', Int(1)))             # song id
-        song.add(Block('minm', String('Name')))     # song name
-        song.add(Block('mper', Long(1)))            # song persistent id
+    """Browse listings mapped to their Song fields and listing tags."""
+    listings = {
+        'artists':      ('artist',      'abar'),
+        'albums':       ('album',       'abal'),
+        'genres':       ('genre',       'abgn'),
+        'composers':    ('composer',    'abcp'),
+    }
 
-        song.add(Block('asal', String('Album')))    # song persistent id
+    def __init__(self, id):
+        self.id = id
 
-        list = Block('mlcl', List())                # record listing
-        list.add(song)
+    def getChildWithDefault(self, name, request):
+        try:
+            field, tag = self.listings[name]
+        except KeyError:
+            return error.NoResource()
+        return BrowseResource(self.id, field, tag)
 
-        r.add(list)
+    def render(self, request):
+        request.setResponseCode(http.BAD_REQUEST, 'Invalid request')
+        return ''
 
-        return r.serialize()
+
+class BrowseResource(Resource):
+    isLeaf = True
+    endpoint = 'browse'
+
+    def __init__(self, id, field, tag):
+        self.id = id
+        self.field = field
+        self.tag = tag
+
+    def render(self, request):
+        if not self.preRender(request):
+            return ''
+
+        body = self.cachedResponse(request)
+        if body is not None:
+            return body
+
+        # Wait for the browse index to catch up with the library.  It can't
+        # be served while it is failing to do so.
+        d = self.browse.wait(self.library.revision)
+        d.addCallbacks(self._render, self._unavailable,
+                       callbackArgs=(request,), errbackArgs=(request,))
+        return self.deferred(request, d)
+
+    def _unavailable(self, failure, request):
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.setHeader('Content-Length', '0')
+        return ''
+
+    def _render(self, revision, request):
+        count, records = self.browse.encode(self.field, browseRecords)
+
+        r = Block('abro', List())                   # browse response
+        r.add(Block('mstt', Int(200)))              # status
+        r.add(Block('muty', Byte(0)))               # update type (always 0)
+        r.add(Block('mtco', Int(count)))            # matching record count
+        r.add(Block('mrco', Int(count)))            # returned record count
+
+        # The (cached) records are appended to the response as-is.
+        body = [_header.pack(r.tag, r.size + 8 + len(records))]
+        body.extend([child.serialize() for child in r.children])
+        body.append(_header.pack(self.tag, len(records)))
+        body.append(records)
+
+        return self.respond(request, ''.join(body), revision)
+
+
+class SongResource(Resource):
+    isLeaf = False
+    endpoint = 'song'
+
+    """Song formats mapped to their MIME content types."""
+    contentTypes = {
+        'aac':      'audio/aac',
+        'flac':     'audio/flac',
+        'm4a':      'audio/mp4',
+        'mp3':      'audio/mpeg',
+        'mp4':      'audio/mp4',
+        'ogg':      'audio/ogg',
+        'wma':      'audio/x-ms-wma',
+    }
+
+    def __init__(self, id):
+        self.id = id
+
+    def getChildWithDefault(self, name, request):
+        if name == 'extra_data':
+            return ExtraDataResource(self.id)
+        return error.NoResource()
+
+    def render(self, request):
+        if not self.preRender(request):
+            return ''
+
+        d = self.library.getSong(self.id)
+        d.addCallback(self._serve, request)
+        return self.deferred(request, d)
+
+    def _serve(self, song, request):
+        if song is None:
+            return error.NoResource().render(request)
+
+        path = song.path.encode(sys.getfilesystemencoding() or 'utf-8')
+        try:
+            file = open(path, 'rb')
+        except IOError:
+            return error.NoResource().render(request)
+
+        # Serve the requested byte range of the file, if any.
+        size = os.fstat(file.fileno()).st_size
+        try:
+            byteRange = parseRange(request.getHeader('Range'), size)
+        except ValueError:
+            file.close()
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            request.setHeader('Content-Range', 'bytes */%d' % size)
+            return ''
+
+        if byteRange is None:
+            offset, length = 0, size
+        else:
+            start, end = byteRange
+            offset, length = start, end - start + 1
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader('Content-Range',
+                              'bytes %d-%d/%d' % (start, end, size))
+
+        contentType = self.contentTypes.get(song.format,
+                                            'application/octet-stream')
+        request.setHeader('Content-Type', contentType)
+        request.setHeader('Content-Length', str(length))
+        request.setHeader('Accept-Ranges', 'bytes')
+
+        if length == 0:
+            file.close()
+            return ''
+
+        FileProducer(request, file, offset, length).start()
+        return NOT_DONE_YET
+
+
+class ExtraDataResource(Resource):
+    isLeaf = False
+    endpoint = 'extra-data'
+
+    def __init__(self, id):
+        self.id = id
+        self.children = {
+            'artwork':              ArtworkResource,
+        }
+
+    def getChildWithDefault(self, name, request):
+        try:
+            return self.children[name](self.id)
+        except KeyError:
+            return error.NoResource()
+
+    def render(self, request):
+        request.setResponseCode(http.BAD_REQUEST, 'Invalid request')
+        return ''
+
+
+class ArtworkResource(Resource):
+    isLeaf = True
+    endpoint = 'artwork'
+
+    def __init__(self, id):
+        self.id = id
+
+    def render(self, request):
+        if not self.preRender(request):
+            return ''
+        if self.artwork is None:
+            return error.NoResource().render(request)
+
+        d = self.library.getSong(self.id)
+        d.addCallback(self._serve, request)
+        return self.deferred(request, d)
+
+    @inlineCallbacks
+    def _serve(self, song, request):
+        if song is None:
+            returnValue(error.NoResource().render(request))
+
+        image = yield self.artwork.get(song)
+        file = None
+        if image is not None and image.data is None:
+            try:
+                file = open(image.path, 'rb')
+            except IOError:
+                # The image has gone missing from the disk cache, so it is
+                # extracted again.
+                self.artwork.forget(song)
+                image = yield self.artwork.get(song)
+        if image is None:
+            returnValue(error.NoResource().render(request))
+
+        # Images are named by their contents, so their digests make ideal
+        # entity tags.
+        request.setHeader('Content-Type', image.type)
+        if request.setETag('"%s"' % image.digest) == http.CACHED:
+            if file is not None:
+                file.close()
+            returnValue('')
+
+        if image.data is not None:
+            request.setHeader('Content-Length', str(len(image.data)))
+            returnValue(image.data)
+
+        size = os.fstat(file.fileno()).st_size
+        request.setHeader('Content-Length', str(size))
+        FileProducer(request, file, 0, size).start()
+        self.artwork.promote(image)
+        returnValue(NOT_DONE_YET)
 
 
 class DatabaseContainersResource(Resource):
+    isLeaf = False
+    endpoint = 'containers'
+
+    def __init__(self, id):
+        self.id = id
+
+    def getChildWithDefault(self, name, request):
+        try:
+            id = int(name)
+        except ValueError:
+            return error.NoResource()
+        return ContainerResource(self.id, id)
+
+    def render(self, request):
+        if not self.preRender(request):
+            return ''
+
+        body = self.cachedResponse(request)
+        if body is not None:
+            return body
+
+        try:
+            span = parseIndex(request)
+            delta = parseDelta(request)
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST, str(e))
+            return ''
+
+        if delta is not None:
+            d = self.library.changelog.changes(delta)
+        else:
+            d = succeed(None)
+        d.addCallback(self._renderListing, request, span)
+        return self.deferred(request, d)
+
+    @inlineCallbacks
+    def _renderListing(self, changes, request, span):
+        revision = self.library.revision
+        ids = yield self.library.getPlaylistIds()
+
+        def encode(playlist, count):
+            return containerRecord(playlist, count).serialize()
+
+        # Clients are sent a complete listing unless they asked for the
+        # changes since a revision that the change log can answer for.
+        if changes is None:
+            if span is None:
+                records = yield self.library.readPlaylists(encode,
+                                                           counts=True)
+                matching = len(records)
+            else:
+                records = yield self.library.readPlaylists(
+                    encode, ids=sliceRange(ids, span), counts=True)
+                matching = len(ids)
+            returnValue(self.streamListing(
+                request, self._response(matching, len(records)), records,
+                revision))
+
+        matching = []
+        deleted = []
+        for id in changes[Change.PLAYLIST]:
+            i = bisect_left(ids, id)
+            if i < len(ids) and ids[i] == id:
+                matching.append(id)
+            else:
+                deleted.append(id)
+        if span is not None:
+            matching = sliceRange(matching, span)
+
+        records = yield self.library.readPlaylists(encode, ids=matching,
+                                                   counts=True)
+        body = self.deltaListing(self._response(len(ids), len(records)),
+                                 records, deleted)
+        returnValue(self.respond(request, body, revision))
+
+    def _response(self, matching, returned):
+        r = Block('aply', List())                   # container list
+        r.add(Block('mstt', Int(200)))              # status
+        r.add(Block('muty', Byte(0)))               # update type (always 0)
+        r.add(Block('mtco', Int(matching)))         # matching record count
+        r.add(Block('mrco', Int(returned)))         # returned record count
+        return r
+
+
+class ContainerResource(Resource):
+    isLeaf = False
+    endpoint = 'container'
+
+    def __init__(self, db, id):
+        self.db = db
+        self.id = id
+        self.children = {
+            'items':                ContainerItemsResource,
+        }
+
+    def getChildWithDefault(self, name, request):
+        try:
+            return self.children[name](self.db, self.id)
+        except KeyError:
+            return error.NoResource()
+
+    def render(self, request):
+        request.setResponseCode(http.BAD_REQUEST, 'Invalid request')
+        return ''
+
+
+class ContainerItemsResource(Resource):
     isLeaf = True
+    endpoint = 'container-items'
+
+    def __init__(self, db, id):
+        self.db = db
+        self.id = id
 
     def render(self, request):
         if not self.preRender(request):
             return ''
 
-        name = String('Test Song Name')
+        body = self.cachedResponse(request)
+        if body is not None:
+            return body
 
-        r = Block('aply', List())                   # song list
+        try:
+            span = parseIndex(request)
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST, str(e))
+            return ''
+
+        d = self.library.getPlaylistEntries(self.id)
+        d.addCallback(self._render, request, span)
+        return self.deferred(request, d)
+
+    @inlineCallbacks
+    def _render(self, playlist, request, span):
+        tags = parseMeta(request)
+        entries, songs = playlist
+        count = len(entries)
+        if span is not None:
+            entries = sliceRange(entries, span)
+            songs = sliceRange(songs, span)
+
+        # Songs deleted since the entries were read are left out, so they
+        # aren't counted as returned.
+        listing = yield self.library.listSongs(
+            lambda song, entry, revision: containerItemRecord(
+                self.records.get(song, tags, revision), entry),
+            songRecordSize(tags + ('mcti',)), ids=songs, entries=entries)
+
+        r = Block('apso', List())                   # container song list
         r.add(Block('mstt', Int(200)))              # status
         r.add(Block('muty', Byte(0)))               # update type (always 0)
-        r.add(Block('mtco', Int(1)))                # matching record count
-        r.add(Block('mrco', Int(1)))                # returned record count
+        r.add(Block('mtco', Int(count)))            # matching record count
+        r.add(Block('mrco', Int(listing.count)))    # returned record count
 
-        item = Block('mlit', List())                # song entry
-        item.add(Block('miid', Int(1)))             # song id
-        item.add(Block('mper', Long(1)))            # song persistent id
-        item.add(Block('minm', String('Playlist'))) # song name
-        item.add(Block('mimc', Int(0)))             # number of items
+        returnValue(self.streamListing(request, r, listing, listing.revision))
 
-        list = Block('mlcl', List())                # record listing
-        list.add(item)
 
-        r.add(list)
+class MetricsResource(Resource):
+    """
+    The server's metrics, in the Prometheus text format.  These are only
+    available to clients connecting from the local host.
+    """
 
-        return r.serialize()
+    isLeaf = True
+    endpoint = 'metrics'
+    requiresSession = False
 
+    def render(self, request):
+        from marconi.metrics import CONTENT_TYPE
+
+        if request.method.upper() != 'GET':
+            request.setResponseCode(http.BAD_REQUEST, 'Invalid request')
+            return ''
+        if request.getClientIP() not in ('127.0.0.1', '::1'):
+            request.setResponseCode(http.FORBIDDEN)
+            return ''
+        if self.metrics is None:
+            return error.NoResource().render(request)
 
-def getService(library, port=3689):
-    """Return a DAAP server service instance attached to the given port."""
-    from twisted.application.internet import TCPServer
-    from twisted.web import server
+        request.setHeader('Content-Type', CONTENT_TYPE)
+        return self.metrics.render()
+
+
+def _registerMetrics(metrics, library, caches, sessions):
+    """Register gauges sampling the server's caches and sessions."""
+    def ratio(cache):
+        total = cache.hits + cache.misses
+        return total and float(cache.hits) / total or 0.0
+
+    for attr, type, help in (('hits', 'counter', 'Cache hits.'),
+                             ('misses', 'counter', 'Cache misses.')):
+        for name, cache in caches:
+            metrics.gauge('marconi_cache_%s_total' % attr, help,
+                          lambda cache=cache, attr=attr: getattr(cache, attr),
+                          type, (('cache', name),))
+    for name, cache in caches:
+        metrics.gauge('marconi_cache_hit_ratio', 'Cache hit ratio.',
+                      lambda cache=cache: ratio(cache),
+                      labels=(('cache', name),))
+    metrics.gauge('marconi_sessions', 'Active client sessions.',
+                  lambda: len(sessions))
+    metrics.gauge('marconi_library_revision', 'Library revision number.',
+                  lambda: library.revision)
+
+
+def getService(library, port=3689, reusePort=False, snapshots=None,
+               sessions=None):
+    """
+    Return a DAAP server service instance attached to the given port.  If
+    ``reusePort`` is true, the port is bound with SO_REUSEPORT so that
+    several worker processes can share it.  Client sessions are kept in the
+    given SessionTable, or in a new one.
+
+    The browse index and cached responses are restored from the library's
+    snapshot, if it has one.  Unless ``snapshots`` is None, a new snapshot
+    is saved next to the database at shutdown ('shutdown') or after each
+    revision as well ('revision').
+    """
+    from twisted.application.internet import TCPServer, TimerService
+    from twisted.application.service import MultiService
 
     Resource.library = library
-
-    return TCPServer(port, server.Site(server.Site(RootResource())))
+    Resource.metrics = Metrics()
+    Resource.records = RecordCache()
+    Resource.responses = ResponseCache()
+    if sessions is None:
+        sessions = SessionTable()
+    Resource.sessions = sessions
+    library.observe(lambda changes: Resource.records.invalidate(
+        changes, library.revision))
+
+    # The browse index is loaded as soon as the database threads start,
+    # unless the library's snapshot (which saves encoding the most recently
+    # requested responses, too) is still current.
+    Resource.browse = BrowseIndex(library)
+    snapshot = library.snapshot
+    if snapshot is not None and snapshot.revision == library.revision:
+        snapshot.restore('browse', Resource.browse)
+        snapshot.restoreResponses(Resource.responses)
+    library.snapshot = None
+    Resource.browse.load()
+
+    # Extracted artwork is cached on disk next to the database (unless the
+    # database is itself in memory).
+    path = library.db.url.database
+    directory = None
+    if path not in (None, '', ':memory:'):
+        directory = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                 'artwork')
+    Resource.artwork = ArtworkCache(library, directory)
+    Resource.artwork.load()
+
+    library.metrics = Resource.metrics
+    _registerMetrics(Resource.metrics, library,
+                     (('records', Resource.records),
+                      ('responses', Resource.responses),
+                      ('artwork', Resource.artwork)),
+                     Resource.sessions)
+
+    root = MultiService()
+
+    if reusePort:
+        from marconi.workers import ReusePortServer
+        service = ReusePortServer(port, Site(RootResource()))
+    else:
+        service = TCPServer(port, Site(RootResource()))
+    service.setServiceParent(root)
+
+    # A single timer sweeps idle sessions out of the session table.
+    service = TimerService(Resource.sessions.resolution,
+                           Resource.sessions.sweep)
+    service.setServiceParent(root)
+
+    if snapshots is not None and directory is not None:
+        from marconi.snapshot import SnapshotService, snapshotPath
+        mirrors = {'browse': Resource.browse}
+        if library.catalog is not None:
+            mirrors['catalog'] = library.catalog
+        service = SnapshotService(library, snapshotPath(path), mirrors,
+                                  Resource.responses,
+                                  everyRevision=snapshots == 'revision')
+        service.setServiceParent(root)
+
+    # The change log only needs to reach back as far as the oldest revision
+    # from which a live session may still request a delta.  Read-only
+    # libraries leave that to the process that writes the log.
+    if library.readonly:
+        return root
+
+    def compact():
+        revision = Resource.sessions.oldestRevision()
+        if revision is None:
+            revision = library.revision
+        library.changelog.compact(revision)
+
+    service = TimerService(COMPACT_INTERVAL, compact)
+    service.setServiceParent(root)
+
+    return root
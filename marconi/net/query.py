@@ -0,0 +1,284 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+DAAP query expressions.  Clients filter listings using the ``query`` (or
+``filter``) argument, whose value is an expression such as::
+
+    'daap.songartist:Foo'+'daap.songgenre:Rock'
+    ('daap.songgenre:Jazz','daap.songgenre:Blues')+'dmap.itemname:*love*'
+
+Each quoted predicate compares a field with a value; ``!:`` negates the
+comparison, and a ``*`` at either end of the value matches any prefix or
+suffix.  Strings are compared without regard to (ASCII) case.  Backslashes
+escape the following character, so ``\:`` and ``\*`` are literal.
+Predicates are combined with ``+`` (or a space, since ``+`` is often decoded
+as one) for AND and ``,`` for OR, and may be grouped with parentheses.
+
+Expressions are compiled into SQLAlchemy clauses against Song so that they
+are evaluated by SQLite, using the indexes declared on the song columns
+(see db.NOCASE_INDEXES).
+"""
+
+import sys
+from sqlalchemy import Unicode, and_, collate, not_, or_
+
+from marconi.db import Song
+
+class QueryError(ValueError):
+    """Raised for malformed query expressions."""
+
+"""Query field names mapped to the names of the Song columns they compare."""
+COLUMNS = {
+    'dmap.itemid':              'id',
+    'dmap.persistentid':        'id',
+    'dmap.itemname':            'title',
+    'daap.songalbum':           'album',
+    'daap.songartist':          'artist',
+    'daap.songbitrate':         'bitrate',
+    'daap.songbeatsperminute':  'bpm',
+    'daap.songcomment':         'comment',
+    'daap.songcompilation':     'compilation',
+    'daap.songcomposer':        'composer',
+    'daap.songdateadded':       'dateadded',
+    'daap.songdatemodified':    'datemodified',
+    'daap.songdisccount':       'disccount',
+    'daap.songdiscnumber':      'discnumber',
+    'daap.songformat':          'format',
+    'daap.songgenre':           'genre',
+    'daap.songsamplerate':      'samplerate',
+    'daap.songsize':            'size',
+    'daap.songtime':            'time',
+    'daap.songtrackcount':      'trackcount',
+    'daap.songtracknumber':     'tracknumber',
+    'daap.songyear':            'year',
+}
+
+"""Query fields that have the same value for every song."""
+CONSTANTS = {
+    'dmap.itemkind':                2,
+    'com.apple.itunes.mediakind':   1,
+}
+
+#
+# Parsing
+#
+# Expressions are parsed into nested tuples: ('and', [...]), ('or', [...])
+# and ('match', field, negated, value, prefix, suffix), where ``prefix`` and
+# ``suffix`` indicate that the value only needs to match the beginning or
+# end of the field.
+
+def _predicate(text, pos):
+    """Parse the quoted predicate starting at text[pos]."""
+    chars = []
+    escaped = []
+    pos += 1
+    while True:
+        if pos >= len(text):
+            raise QueryError('Unterminated predicate')
+        c = text[pos]
+        pos += 1
+        if c == '\\':
+            if pos >= len(text):
+                raise QueryError('Unterminated escape sequence')
+            chars.append(text[pos])
+            escaped.append(True)
+            pos += 1
+        elif c == "'":
+            break
+        else:
+            chars.append(c)
+            escaped.append(False)
+
+    # Only unescaped characters can separate the field from the value or
+    # act as wildcards.
+    for i, c in enumerate(chars):
+        if c == ':' and not escaped[i]:
+            break
+    else:
+        raise QueryError("Predicate without a ':'")
+
+    field = ''.join(chars[:i]).strip()
+    negated = field.endswith('!')
+    if negated:
+        field = field[:-1]
+
+    value = chars[i + 1:]
+    escaped = escaped[i + 1:]
+    prefix = suffix = False
+    if value and value[0] == '*' and not escaped[0]:
+        value, escaped, suffix = value[1:], escaped[1:], True
+    if value and value[-1] == '*' and not escaped[-1]:
+        value, prefix = value[:-1], True
+
+    return ('match', field, negated, ''.join(value), prefix, suffix), pos
+
+def _skip(text, pos):
+    while pos < len(text) and text[pos] in ' +':
+        pos += 1
+    return pos
+
+def _expression(text, pos):
+    """Parse a comma-separated (OR) sequence of terms."""
+    terms = []
+    while True:
+        term, pos = _term(text, pos)
+        terms.append(term)
+        if pos < len(text) and text[pos] == ',':
+            pos += 1
+            continue
+        break
+    if len(terms) == 1:
+        return terms[0], pos
+    return ('or', terms), pos
+
+def _term(text, pos):
+    """Parse an AND sequence of factors."""
+    factors = []
+    while True:
+        pos = _skip(text, pos)
+        if pos >= len(text):
+            break
+        c = text[pos]
+        if c == '(':
+            factor, pos = _expression(text, pos + 1)
+            pos = _skip(text, pos)
+            if pos >= len(text) or text[pos] != ')':
+                raise QueryError("Missing ')'")
+            pos += 1
+        elif c == "'":
+            factor, pos = _predicate(text, pos)
+        else:
+            break
+        factors.append(factor)
+    if not factors:
+        raise QueryError('Empty expression at position %d' % pos)
+    if len(factors) == 1:
+        return factors[0], pos
+    return ('and', factors), pos
+
+def parse(text):
+    """Parse a query expression into a tree of nested tuples."""
+    tree, pos = _expression(text, 0)
+    pos = _skip(text, pos)
+    if pos != len(text):
+        raise QueryError("Unexpected '%s' at position %d" % (text[pos], pos))
+    return tree
+
+#
+# Compilation
+#
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _fold(value):
+    """Fold a string's case the way SQLite's NOCASE collation does."""
+    return u''.join([u'A' <= c <= u'Z' and c.lower() or c for c in value])
+
+def _successor(value):
+    """
+    Return the least string that sorts (by NOCASE) after every string that
+    begins with the given (folded) one, or None if there isn't a simple one.
+    SQLite compares strings by their UTF-8 encodings, which sort like their
+    code points, so that is the string with its last character incremented.
+    """
+    if not value or u'\ud800' <= value[-1] <= u'\udfff':
+        return None
+    code = ord(value[-1]) + 1
+    if code > sys.maxunicode:
+        return None
+    if 0xd800 <= code <= 0xdfff:
+        # Surrogates never appear in UTF-8 encoded strings.
+        code = 0xe000
+    c = unichr(code)
+    if u'A' <= c <= u'Z':
+        # Folded strings don't contain upper case letters.
+        c = u'['
+    return value[:-1] + c
+
+def _match(field, negated, value, prefix, suffix):
+    """
+    Compile a single predicate into a clause.  True and False are returned
+    for predicates whose result is the same for every song, which includes
+    predicates on unknown fields (which are ignored).
+
+    Strings are compared without regard to (ASCII) case, as LIKE compares
+    them, and prefix matches are compiled to ranges, so that they can both
+    use the columns' NOCASE indexes.
+    """
+    if field in CONSTANTS:
+        try:
+            result = int(value) == CONSTANTS[field]
+        except ValueError:
+            result = False
+        return result != negated
+
+    name = COLUMNS.get(field)
+    if name is None:
+        return True
+    column = Song.__table__.c[name]
+
+    if not isinstance(column.type, Unicode):
+        # Numeric columns only support exact matches.
+        try:
+            clause = column == int(value)
+        except ValueError:
+            return negated
+    else:
+        value = _fold(value.decode('utf-8', 'replace'))
+        nocase = collate(column, 'NOCASE')
+        upper = _successor(value)
+        if (prefix or suffix) and not value:
+            clause = column != None
+        elif prefix and not suffix and upper is not None:
+            clause = and_(nocase >= value, nocase < upper)
+        elif prefix or suffix:
+            pattern = _escape(value)
+            if suffix:
+                pattern = '%' + pattern
+            if prefix:
+                pattern = pattern + '%'
+            clause = column.like(pattern, escape='\\')
+        else:
+            clause = nocase == value
+
+    if negated:
+        return or_(column == None, not_(clause))
+    return clause
+
+def _compile(tree):
+    op = tree[0]
+    if op == 'match':
+        return _match(*tree[1:])
+
+    clauses = []
+    for child in tree[1]:
+        clause = _compile(child)
+        if clause is True or clause is False:
+            # Short-circuit (or drop) constant clauses.
+            if clause == (op == 'or'):
+                return clause
+            continue
+        clauses.append(clause)
+
+    if not clauses:
+        return op == 'and'
+    if len(clauses) == 1:
+        return clauses[0]
+    if op == 'and':
+        return and_(*clauses)
+    return or_(*clauses)
+
+def compile(text):
+    """
+    Compile a query expression into a SQLAlchemy clause against Song, or
+    None if the expression matches every song.  Raises QueryError if the
+    expression is malformed.
+    """
+    clause = _compile(parse(text))
+    if clause is True:
+        return None
+    if clause is False:
+        return Song.id == None
+    return clause
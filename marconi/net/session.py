@@ -0,0 +1,149 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+DAAP client sessions.  Sessions are created by ``/login``, identified by the
+``session-id`` query argument on subsequent requests, and expire after they
+have been idle for the advertised timeout.
+
+Expiration uses a timer wheel: the timeout is divided into a fixed number of
+slots, each holding the sessions last seen during that slot's interval.  A
+single periodic sweep advances the wheel and expires every session in the
+slot it reuses, so idle sessions cost no timers and touching a session is a
+constant-time move between two sets.  A session with an ``/update`` request
+held open isn't idle, however long the request is held.
+"""
+
+import random
+
+class Session(object):
+    """
+    A single client session.  Besides its expiration bookkeeping, a session
+    holds the client's per-connection state: the last library revision it
+    was sent, the revision it was sent before that (from which the client
+    may still request a delta) and the Deferreds of its in-flight
+    ``/update`` requests.
+    """
+
+    __slots__ = ('id', 'slot', 'revision', 'previous', 'updates')
+
+    def __init__(self, id, slot):
+        self.id = id
+        self.slot = slot
+        self.revision = 0
+        self.previous = 0
+        self.updates = None
+
+    def __repr__(self):
+        return '<Session(%d)>' % (self.id,)
+
+    def sent(self, revision):
+        """Record that the client has been sent the given revision."""
+        if revision != self.revision:
+            self.previous = self.revision
+            self.revision = revision
+
+    def addUpdate(self, d):
+        """Track an in-flight update request's Deferred until it fires."""
+        # Most sessions never have an update in flight, so the set is only
+        # created on demand to keep idle sessions small.
+        if self.updates is None:
+            self.updates = set()
+        self.updates.add(d)
+        d.addBoth(self._discardUpdate, d)
+
+    def _discardUpdate(self, result, d):
+        if self.updates is not None:
+            self.updates.discard(d)
+        return result
+
+    def expire(self):
+        """Cancel any of this session's outstanding update requests."""
+        updates, self.updates = self.updates, None
+        for d in updates or ():
+            d.cancel()
+
+class SessionTable(object):
+    """
+    A table of sessions that expire after ``timeout`` seconds of idleness,
+    measured with a precision of ``resolution`` seconds.  sweep() must be
+    called every ``resolution`` seconds.
+    """
+
+    def __init__(self, timeout=1800, resolution=30):
+        self.timeout = timeout
+        self.resolution = resolution
+        self.sessions = {}
+        self.wheel = [set() for i in xrange(max(timeout // resolution, 1))]
+        self.current = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self):
+        """Create and return a new session with a unique, positive id."""
+        while True:
+            id = random.randint(1, 0x7fffffff)
+            if id not in self.sessions:
+                break
+        return self.add(id)
+
+    def add(self, id):
+        """Add and return a session with the given (unused) id."""
+        session = Session(id, self.current)
+        self.sessions[id] = session
+        self.wheel[self.current].add(session)
+        return session
+
+    def get(self, id):
+        """
+        Return the session with the given id, or None if there isn't one.
+        Looking up a session counts as activity and postpones its expiration.
+        """
+        session = self.sessions.get(id)
+        if session is None:
+            return None
+        if session.slot != self.current:
+            self.wheel[session.slot].discard(session)
+            self.wheel[self.current].add(session)
+            session.slot = self.current
+        return session
+
+    def remove(self, id):
+        """Remove (log out) the session with the given id."""
+        session = self.sessions.pop(id, None)
+        if session is not None:
+            self.wheel[session.slot].discard(session)
+            session.expire()
+        return session
+
+    def oldestRevision(self):
+        """
+        Return the oldest library revision from which a live session's
+        client may still request a delta, or None if there isn't one.
+        """
+        revisions = [session.previous or session.revision
+                     for session in self.sessions.itervalues()]
+        revisions = [revision for revision in revisions if revision]
+        return revisions and min(revisions) or None
+
+    def sweep(self):
+        """
+        Advance the wheel by one slot, expiring the sessions in the slot that
+        is about to be reused.  They haven't been seen for a full timeout,
+        unless they are waiting on a held update request, in which case they
+        are kept as though they had just been seen.  Returns the list of
+        sessions that expired.
+        """
+        self.current = (self.current + 1) % len(self.wheel)
+        sessions = self.wheel[self.current]
+        self.wheel[self.current] = set()
+        expired = []
+        for session in sessions:
+            if session.updates:
+                self.wheel[self.current].add(session)
+                continue
+            del self.sessions[session.id]
+            session.expire()
+            expired.append(session)
+        return expired
@@ -0,0 +1,152 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Efficient file streaming for HTTP responses.  Files are sent directly from
+the kernel's page cache to the client's socket using sendfile() when it is
+available, falling back to large buffered reads otherwise.  Both paths are
+driven by a pull producer, so a file is only read as quickly as its client
+can receive it.
+"""
+
+import errno
+from twisted.internet.interfaces import IPullProducer, ISSLTransport
+from zope.interface import implements
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+def parseRange(header, size):
+    """
+    Parse an HTTP ``Range`` header for a resource of the given size into an
+    inclusive (start, end) byte range.  None is returned if the header is
+    missing or isn't a single byte range (in which case the entire resource
+    should be sent), and ValueError is raised if the range can't be
+    satisfied.
+    """
+    if not header:
+        return None
+    units, sep, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # A suffix range (e.g. "-500") for the last N bytes.
+            length = int(last)
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return None
+
+    if not first:
+        if length <= 0 or size == 0:
+            raise ValueError('Unsatisfiable suffix range: %s' % header)
+        return (max(size - length, 0), size - 1)
+
+    # A last byte before the first makes the header invalid (rather than
+    # unsatisfiable), so it is ignored.
+    if last and end < start:
+        return None
+    if start >= size:
+        raise ValueError('Unsatisfiable range: %s' % header)
+    return (start, min(end, size - 1))
+
+class FileProducer(object):
+    """
+    A pull producer that writes ``length`` bytes of an open file, starting at
+    ``offset``, to a request.  The first chunk is always written through the
+    request so that the response headers are sent first.  Twisted only asks
+    a pull producer for more data once the transport's buffer has drained,
+    so subsequent chunks can be handed directly to sendfile().
+    """
+
+    implements(IPullProducer)
+
+    chunkSize = 256 * 1024
+
+    def __init__(self, request, file, offset, length):
+        self.request = request
+        self.file = file
+        self.offset = offset
+        self.remaining = length
+        self.started = False
+
+        transport = request.transport
+        self.sendfile = (sendfile is not None and
+                         not ISSLTransport.providedBy(transport) and
+                         hasattr(transport, 'getHandle'))
+
+    def start(self):
+        """Begin streaming the file to the request."""
+        self.request.notifyFinish().addErrback(self._connectionLost)
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.file is None:
+            return
+        if self.remaining <= 0:
+            self._finish()
+            return
+
+        count = min(self.chunkSize, self.remaining)
+        if self.started and self.sendfile:
+            try:
+                sent = sendfile(self.request.transport.getHandle().fileno(),
+                                self.file.fileno(), self.offset, count)
+            except (OSError, IOError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    self._abort()
+                    return
+                sent = 0
+            else:
+                if sent == 0:
+                    # The file has been truncated underneath us.
+                    self._abort()
+                    return
+                # Account for the bytes that bypassed request.write().
+                self.request.sentLength += sent
+        else:
+            self.file.seek(self.offset)
+            data = self.file.read(count)
+            if not data:
+                self._abort()
+                return
+            self.request.write(data)
+            sent = len(data)
+
+        self.started = True
+        self.offset += sent
+        self.remaining -= sent
+
+        if self.remaining <= 0:
+            self._finish()
+        elif self.sendfile:
+            # Nothing has been written through the transport, so ask it to
+            # call us again once the socket is writable.
+            self.request.transport.startWriting()
+
+    def stopProducing(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _finish(self):
+        self.stopProducing()
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def _abort(self):
+        self.stopProducing()
+        self.request.unregisterProducer()
+        self.request.transport.loseConnection()
+
+    def _connectionLost(self, reason):
+        self.stopProducing()
@@ -0,0 +1,464 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+The library scanner walks directory trees looking for audio files and keeps
+the ``songs`` table in sync with them.  Tags and audio properties are
+extracted in a pool of worker processes, while the rows they produce are
+written by the library's writer in large, batched transactions.
+
+Each song's file size, modification time and inode are recorded alongside
+its path.  A rescan compares a fresh directory walk against that index and
+only extracts tags from new or changed files, so rescanning an unchanged
+library never reads any audio data.
+"""
+
+import os
+import sys
+import time
+from multiprocessing import Pool
+from sqlalchemy import bindparam, func, or_, select
+from twisted.internet.threads import blockingCallFromThread, deferToThread
+from twisted.python import log
+
+from marconi.db import Playlist, PlaylistSong, Song, changes
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+"""File extensions (and their DAAP song formats) recognized as audio."""
+AUDIO_FORMATS = {
+    '.aac':     u'aac',
+    '.flac':    u'flac',
+    '.m4a':     u'm4a',
+    '.mp3':     u'mp3',
+    '.mp4':     u'mp4',
+    '.ogg':     u'ogg',
+    '.wma':     u'wma',
+}
+
+"""Song columns written by the scanner.  Every extracted row has each one."""
+COLUMNS = ('path', 'title', 'album', 'artist', 'bitrate', 'bpm', 'comment',
+           'compilation', 'composer', 'dateadded', 'datemodified',
+           'disccount', 'discnumber', 'format', 'genre', 'samplerate', 'size',
+           'time', 'trackcount', 'tracknumber', 'year', 'mtime', 'inode')
+
+def _decode(path, encoding):
+    """
+    Return a file system path as a unicode string, or None if it can't be
+    decoded.  Songs are stored by their unicode paths, so files whose names
+    can't be decoded are skipped (and logged) rather than stored under a
+    mangled name that could never be opened again.
+    """
+    try:
+        return path.decode(encoding)
+    except UnicodeDecodeError:
+        log.msg('Skipping %r: its name is not valid %s' % (path, encoding))
+        return None
+
+def _scandir(top):
+    """Yield (path, (mtime, size, inode)) for the audio files beneath top."""
+    stack = [top]
+    while stack:
+        try:
+            entries = scandir(stack.pop())
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                ext = os.path.splitext(entry.name)[1].lower()
+                if ext in AUDIO_FORMATS:
+                    st = entry.stat()
+                    yield entry.path, (st.st_mtime, st.st_size, st.st_ino)
+            except OSError:
+                continue
+
+def _walk(top):
+    """The os.walk() equivalent of _scandir(), used without scandir."""
+    for dirpath, dirnames, filenames in os.walk(top):
+        for filename in filenames:
+            ext = os.path.splitext(filename)[1].lower()
+            if ext in AUDIO_FORMATS:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, (st.st_mtime, st.st_size, st.st_ino)
+
+def walk(paths):
+    """
+    Yield (path, (mtime, size, inode)) for every audio file found beneath the
+    given paths.  Only directory entries are read; file contents are not.
+    """
+    for top in paths:
+        if scandir is not None:
+            files = _scandir(top)
+        else:
+            files = _walk(top)
+        for entry in files:
+            yield entry
+
+def _first(tags, key):
+    """Return the first value of the given tag as a unicode string."""
+    values = tags.get(key)
+    if values:
+        return unicode(values[0]).strip() or None
+    return None
+
+def _number(tags, key):
+    """Return a tag's leading integer value (e.g. 3 for '3/12')."""
+    value = _first(tags, key)
+    if value:
+        value = value.split('/')[0].split('-')[0].strip()
+        if value.isdigit():
+            return int(value)
+    return None
+
+def _total(tags, key):
+    """Return a tag's trailing total value (e.g. 12 for '3/12')."""
+    value = _first(tags, key)
+    if value and '/' in value:
+        value = value.split('/', 1)[1].strip()
+        if value.isdigit():
+            return int(value)
+    return None
+
+def extract(path):
+    """
+    Return a dictionary of Song column values for the audio file at the given
+    path, or None if the file couldn't be read.  This runs in the worker
+    processes, so it must be importable and free of shared state.
+    """
+    import mutagen
+
+    try:
+        st = os.stat(path)
+        audio = mutagen.File(path, easy=True)
+    except Exception:
+        return None
+    if audio is None:
+        return None
+
+    if isinstance(path, str):
+        try:
+            path = path.decode(sys.getfilesystemencoding() or 'utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    tags = audio.tags or {}
+    info = audio.info
+    ext = os.path.splitext(path)[1].lower()
+
+    row = dict.fromkeys(COLUMNS)
+    row.update(
+        path = path,
+        title = _first(tags, 'title') or os.path.splitext(
+                    os.path.basename(path))[0],
+        album = _first(tags, 'album'),
+        artist = _first(tags, 'artist'),
+        bpm = _number(tags, 'bpm'),
+        comment = _first(tags, 'comment'),
+        composer = _first(tags, 'composer'),
+        dateadded = int(time.time()),
+        datemodified = int(st.st_mtime),
+        disccount = _total(tags, 'discnumber'),
+        discnumber = _number(tags, 'discnumber'),
+        format = AUDIO_FORMATS.get(ext),
+        genre = _first(tags, 'genre'),
+        size = st.st_size,
+        trackcount = _total(tags, 'tracknumber'),
+        tracknumber = _number(tags, 'tracknumber'),
+        year = _number(tags, 'date'),
+        mtime = st.st_mtime,
+        inode = st.st_ino,
+    )
+    if _first(tags, 'compilation') in (u'1', u'True'):
+        row['compilation'] = 1
+
+    bitrate = getattr(info, 'bitrate', None)
+    if bitrate:
+        row['bitrate'] = bitrate // 1000
+    samplerate = getattr(info, 'sample_rate', None)
+    if samplerate:
+        row['samplerate'] = samplerate
+    length = getattr(info, 'length', None)
+    if length:
+        row['time'] = int(length * 1000)
+
+    return row
+
+class Scanner(object):
+    """
+    Scans directories into the library.  ``processes`` worker processes
+    extract tags (defaulting to one per CPU), and their rows are written by
+    the library's writer, ``batchSize`` rows per statement and
+    ``commitSize`` rows per transaction.
+    """
+
+    def __init__(self, library, processes=None, batchSize=1000,
+                 commitSize=20000):
+        self.library = library
+        self.engine = library.db
+        self.processes = processes
+        self.batchSize = batchSize
+        self.commitSize = commitSize
+
+    def scan(self, paths):
+        """
+        Scan the given paths, bringing the library up to date with them.  New
+        and changed files are (re-)extracted, and the songs for any files that
+        have disappeared from beneath the paths (or that can no longer be
+        read) are removed.  Returns a Deferred that fires with a tuple of the
+        number of songs that were added, updated and removed.
+
+        The scan runs in a thread, which waits for each transaction to be
+        committed before extracting any more rows.
+        """
+        return deferToThread(self._scan, paths)
+
+    def _scan(self, paths):
+        start = time.time()
+
+        # Walk the file system using byte string paths so that file names
+        # which can't be decoded are still found (and reported).
+        fsencoding = sys.getfilesystemencoding() or 'utf-8'
+        paths = [isinstance(path, unicode) and path.encode(fsencoding) or path
+                 for path in paths]
+
+        # Load the (path -> id, mtime, size, inode) index of every song
+        # beneath the scanned paths.
+        roots = [_decode(os.path.join(path, ''), fsencoding)
+                 for path in paths]
+        roots = [root for root in roots if root is not None]
+        index = {}
+        query = select([Song.path, Song.id, Song.mtime, Song.size, Song.inode])
+        for path, id, mtime, size, inode in self.engine.execute(query):
+            for root in roots:
+                if path.startswith(root):
+                    index[path] = (id, (mtime, size, inode))
+                    break
+
+        # Compare the file system against the index.  Anything left in the
+        # index afterward no longer exists.
+        ids = {}
+        candidates = []
+        for path, stat in walk(paths):
+            key = _decode(path, fsencoding)
+            if key is None:
+                continue
+            known = index.pop(key, None)
+            if known is None:
+                candidates.append(path)
+            elif known[1] != stat:
+                ids[key] = known[0]
+                candidates.append(path)
+
+        added = updated = 0
+        extracted = set()
+        if candidates:
+            pool = Pool(self.processes)
+            try:
+                rows = pool.imap_unordered(extract, candidates, chunksize=64)
+                added, updated = self._write(
+                    self._extracted(rows, extracted), ids)
+            finally:
+                pool.close()
+                pool.join()
+
+        removed = [id for id, stat in index.itervalues()]
+        removed += self._unread(ids, extracted)
+        if removed:
+            self._commit([], {}, removed)
+
+        elapsed = time.time() - start
+        count = added + updated
+        log.msg('Scanned %d files in %.1fs (%.0f files/sec): '
+                '%d added, %d updated, %d removed' %
+                (count, elapsed, count / max(elapsed, 0.001),
+                 added, updated, len(removed)))
+
+        return added, updated, len(removed)
+
+    def _write(self, rows, ids):
+        """
+        Write the given rows, ``commitSize`` at a time, returning the number
+        of songs that were added and updated.
+        """
+        added = updated = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.commitSize:
+                result = self._commit(batch, ids)
+                added, updated = added + result[0], updated + result[1]
+                batch = []
+        if batch:
+            result = self._commit(batch, ids)
+            added, updated = added + result[0], updated + result[1]
+        return added, updated
+
+    def _commit(self, rows, ids, removed=()):
+        # Runs in the scan's thread, and waits for the library's writer.
+        return blockingCallFromThread(self.library.reactor, self.library.write,
+                                      self.apply, rows, ids, removed)
+
+    def prepare(self, paths):
+        """
+        Compare the given files and directories against the library and
+        extract the tags of those that are new or changed.  Tags are
+        extracted in this process rather than in worker processes, so this
+        suits small batches of paths, like those reported by a Watcher.
+        Returns the ``rows``, ``ids`` and ``removed`` arguments that apply()
+        takes to bring the library up to date.
+        """
+        fsencoding = sys.getfilesystemencoding() or 'utf-8'
+        paths = [isinstance(path, unicode) and path.encode(fsencoding) or path
+                 for path in paths]
+
+        # Load the index of the songs at or beneath each of the paths.  LIKE
+        # treats some characters as wildcards, so matches are confirmed here.
+        index = {}
+        for path in paths:
+            key = _decode(path, fsencoding)
+            if key is None:
+                continue
+            prefix = os.path.join(key, u'')
+            query = select([Song.path, Song.id, Song.mtime, Song.size,
+                            Song.inode],
+                           or_(Song.path == key, Song.path.startswith(prefix)))
+            for row in self.engine.execute(query):
+                if row[0] == key or row[0].startswith(prefix):
+                    index[row[0]] = (row[1], tuple(row[2:]))
+
+        # Find the audio files that exist now.  A file may be named more than
+        # once, directly and beneath a directory.
+        files = {}
+        for path in paths:
+            if os.path.isdir(path):
+                files.update(walk([path]))
+            elif os.path.splitext(path)[1].lower() in AUDIO_FORMATS:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (st.st_mtime, st.st_size, st.st_ino)
+
+        ids = {}
+        candidates = []
+        for path, stat in files.iteritems():
+            key = _decode(path, fsencoding)
+            if key is None:
+                continue
+            known = index.pop(key, None)
+            if known is None:
+                candidates.append(path)
+            elif known[1] != stat:
+                ids[key] = known[0]
+                candidates.append(path)
+
+        extracted = set()
+        rows = list(self._extracted(map(extract, candidates), extracted))
+        removed = [id for id, stat in index.itervalues()]
+        return rows, ids, removed + self._unread(ids, extracted)
+
+    def apply(self, session, rows, ids={}, removed=()):
+        """
+        Write the given rows within the given session's transaction, using
+        batched executemany() statements, so that the changes are made (and
+        notified) along with the session's others when it is committed.
+        Rows whose paths appear in ``ids`` update the song with that id; all
+        others are inserted.  The songs whose ids are listed in ``removed``
+        are deleted.  Returns a tuple of the number of songs that were added,
+        updated and removed.
+        """
+        inserts = []
+        updates = []
+        added = updated = 0
+        changed = set()
+
+        connection = session.connection()
+        for row in rows:
+            if row is None:
+                continue
+            if self._sort(row, ids, inserts, updates):
+                added += 1
+            else:
+                updated += 1
+            if len(inserts) + len(updates) >= self.batchSize:
+                self._flush(connection, inserts, updates, changed)
+        self._flush(connection, inserts, updates, changed)
+        if removed:
+            self._remove(connection, removed, changed)
+        changes.record(session, changed)
+        return added, updated, len(removed)
+
+    def _extracted(self, rows, paths):
+        """Yield the rows that were extracted, adding their paths to a set."""
+        for row in rows:
+            if row is not None:
+                paths.add(row['path'])
+                yield row
+
+    def _unread(self, ids, extracted):
+        """
+        Return the ids of the songs whose changed files could no longer be
+        read.  They are removed, just like the songs of missing files, so
+        that they aren't extracted again by every scan.
+        """
+        return [id for path, id in ids.iteritems() if path not in extracted]
+
+    def _sort(self, row, ids, inserts, updates):
+        """Queue a row as an insert (returning True) or an update."""
+        id = ids.get(row['path'])
+        if id is None:
+            inserts.append(row)
+            return True
+        # Preserve the song's original date-added value.
+        row.pop('dateadded', None)
+        row['_id'] = id
+        updates.append(row)
+        return False
+
+    def _flush(self, connection, inserts, updates, changed):
+        """Execute (and empty) the queued inserts and updates."""
+        if inserts:
+            # New rows are given ids beyond the highest existing one, so
+            # they can be identified without reading back their paths.
+            last = connection.execute(
+                select([func.max(Song.id)])).scalar() or 0
+            connection.execute(Song.__table__.insert(), inserts)
+            query = select([Song.id], Song.id > last)
+            changed.update([(Song, id)
+                            for (id,) in connection.execute(query)])
+        if updates:
+            update = Song.__table__.update().where(
+                Song.id == bindparam('_id'))
+            connection.execute(update, updates)
+            changed.update([(Song, row['_id']) for row in updates])
+        del inserts[:]
+        del updates[:]
+
+    def _remove(self, connection, ids, changed):
+        """Delete songs within the connection's current transaction."""
+        table = Song.__table__
+        members = PlaylistSong.__table__
+        changed.update([(Song, id) for id in ids])
+        # Stay well below SQLite's limit on bound parameters.
+        for i in xrange(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            # The songs are removed from any playlists they were in.
+            query = select([members.c.playlist_id],
+                           members.c.song_id.in_(chunk), distinct=True)
+            changed.update([(Playlist, id)
+                            for (id,) in connection.execute(query)])
+            connection.execute(members.delete(members.c.song_id.in_(chunk)))
+            connection.execute(table.delete(table.c.id.in_(chunk)))
@@ -0,0 +1,297 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Warm-start snapshots.  Building the song catalog and browse indexes and
+encoding the first listings takes longer the larger the library is, and
+after a restart the first clients would pay that cost.  Instead, the server
+saves a snapshot of that state next to its database when it shuts down (and,
+optionally, after each revision), and a server that starts at the same
+library revision picks up where the last one left off.
+
+A snapshot file holds a table of contents followed by the data it lists.
+Named sections (the mirrors' dumps) are stored in marshal format, and the
+cached responses are stored as raw bodies.  Snapshots are memory-mapped when
+they are opened, so responses are served straight from the file, and each
+section is only read when it is restored.
+
+A snapshot is only used if its fingerprint matches the database's: the
+latest revision in the change log, which is committed along with each
+change, and the highest id and number of its songs.  The snapshot is also
+deleted as soon as the library moves past it, whether or not a new one is
+written later, so that a server that stops without writing a new snapshot
+rarely leaves a stale one behind.
+"""
+
+import errno
+import marshal
+import mmap
+import os
+import struct
+import sys
+from sqlalchemy import func, select
+from twisted.application import service
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+from marconi.db import Change, Song
+
+MAGIC = 'MARCONI-SNAPSHOT'
+
+# Snapshots are only read by the kind of platform that wrote them, since
+# the catalog's arrays are stored in native byte order.
+FORMAT = (1, sys.byteorder, sys.maxsize)
+
+_length = struct.Struct('!Q')
+
+def snapshotPath(database):
+    """Return the path of the snapshot for the given database file."""
+    return database + '.snapshot'
+
+def fingerprint(connection):
+    """
+    Return a fingerprint of the committed state of the database that the
+    given connection (or session, or engine) reads: the latest revision in
+    its change log, and the highest id and number of its songs.
+    """
+    revision = connection.execute(
+        select([func.max(Change.revision)])).scalar()
+    last, count = connection.execute(
+        select([func.max(Song.id), func.count(Song.id)])).fetchone()
+    # An empty log starts out at the first revision.
+    return (revision or 1, last or 0, count)
+
+def write(path, revision, fingerprint, sections, responses):
+    """
+    Write a snapshot of the library at the given revision, whose database
+    had the given fingerprint.  ``sections`` maps names to marshalled
+    values, and ``responses`` is a list of (key, encoding, body) tuples from
+    ResponseCache.dump().  The file is replaced atomically.
+    """
+    toc = {'format': FORMAT, 'revision': revision,
+           'fingerprint': fingerprint, 'sections': {}, 'responses': []}
+    blobs = []
+    offset = 0
+    for name, blob in sections.iteritems():
+        toc['sections'][name] = (offset, len(blob))
+        blobs.append(blob)
+        offset += len(blob)
+    for key, encoding, body in responses:
+        toc['responses'].append((key, encoding, offset, len(body)))
+        blobs.append(body)
+        offset += len(body)
+
+    header = marshal.dumps(toc)
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_length.pack(len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    os.rename(temp, path)
+
+def remove(path):
+    """Remove the snapshot at the given path, if there is one."""
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+class Snapshot(object):
+    """A snapshot file, memory-mapped for reading."""
+
+    def __init__(self, path, map, toc, start):
+        self.path = path
+        self.map = map
+        self.revision = toc['revision']
+        self.fingerprint = toc.get('fingerprint')
+        self.sections = toc['sections']
+        self.responses = toc['responses']
+        self.start = start
+
+    def __repr__(self):
+        return '<Snapshot(%r, %d)>' % (self.path, self.revision)
+
+    def matches(self, db):
+        """
+        Return True if the snapshot was taken of the database as it is now,
+        judging by its fingerprint.
+        """
+        return self.fingerprint == fingerprint(db)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open the snapshot at the given path.  Returns None if there isn't a
+        (readable) one.
+        """
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                return None
+        finally:
+            f.close()
+
+        try:
+            start = len(MAGIC) + _length.size
+            if map[:len(MAGIC)] != MAGIC:
+                raise ValueError('not a snapshot')
+            size, = _length.unpack(map[len(MAGIC):start])
+            toc = marshal.loads(map[start:start + size])
+            if toc.get('format') != FORMAT:
+                raise ValueError('unsupported format')
+        except (ValueError, EOFError, TypeError, struct.error) as e:
+            log.msg('Ignoring snapshot %s: %s' % (path, e))
+            map.close()
+            return None
+        return cls(path, map, toc, start + size)
+
+    def section(self, name):
+        """Return the value of the given section, or None."""
+        entry = self.sections.get(name)
+        if entry is None:
+            return None
+        offset, length = entry
+        offset += self.start
+        return marshal.loads(self.map[offset:offset + length])
+
+    def restore(self, name, mirror):
+        """
+        Restore a mirror from the given section.  Returns True if it was
+        restored.
+        """
+        try:
+            state = self.section(name)
+            if state is None:
+                return False
+            mirror.restore(self.revision, state)
+        except Exception:
+            log.err(None, 'Failed to restore %r from %r' % (mirror, self))
+            return False
+        return True
+
+    def restoreResponses(self, responses):
+        """Fill a ResponseCache with the snapshot's responses."""
+        responses.restore(self.revision,
+            [(key, encoding, buffer(self.map, self.start + offset, length))
+             for key, encoding, offset, length in self.responses])
+
+class SnapshotService(service.Service):
+    """
+    Writes snapshots of a library's ``mirrors`` (a dictionary of them, by
+    section name) and ResponseCache ``responses`` to the given path when the
+    service stops, and also after each revision (at most every ``delay``
+    seconds) if ``everyRevision`` is true.  Either way, the snapshot is
+    deleted as soon as the library moves past it.
+    """
+
+    def __init__(self, library, path, mirrors, responses,
+                 everyRevision=False, delay=30.0):
+        self.library = library
+        self.path = path
+        self.mirrors = mirrors
+        self.responses = responses
+        self.everyRevision = everyRevision
+        self.delay = delay
+        self.call = None
+        self.writing = None
+        self.removed = False
+
+        library.observe(self._changed)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        return self.save()
+
+    def save(self):
+        """
+        Write a snapshot of the library's current state.  Returns a
+        Deferred that fires once it has been written (or skipped, if the
+        library moved on before it could be).
+        """
+        from twisted.internet.defer import succeed
+
+        if self.writing is not None:
+            # Only one snapshot is written at a time.
+            d = self.writing
+            d.addCallback(lambda _: self.save())
+            return d
+
+        # The library's state is captured here, in the reactor thread, but
+        # it is written to the file in another.
+        revision = self.library.revision
+        sections = {}
+        for name, mirror in self.mirrors.iteritems():
+            state = mirror.dump()
+            if state is not None:
+                sections[name] = marshal.dumps(state)
+        responses = self.responses and self.responses.dump(revision) or []
+        if not sections and not responses:
+            return succeed(None)
+
+        def _write(fingerprint):
+            # Changes committed since the state was captured would make the
+            # snapshot stale before it was even written.
+            if fingerprint[0] != revision:
+                return None
+            d = deferToThread(write, self.path, revision, fingerprint,
+                              sections, responses)
+            d.addCallback(_written)
+            return d
+
+        def _written(result):
+            if self.library.revision == revision:
+                self.removed = False
+            else:
+                # The library moved on while the snapshot was written.
+                self._remove()
+
+        def _done(result):
+            self.writing = None
+            return result
+
+        self.writing = self.library.read(fingerprint)
+        self.writing.addCallback(_write)
+        self.writing.addErrback(log.err, 'Failed to write a snapshot')
+        self.writing.addBoth(_done)
+        return self.writing
+
+    def _remove(self):
+        self.removed = True
+        try:
+            remove(self.path)
+        except OSError as e:
+            log.msg('Unable to remove snapshot %s: %s' % (self.path, e))
+
+    def _changed(self, changes):
+        from twisted.internet import reactor
+
+        # The snapshot on disk no longer matches the library.
+        if not self.removed:
+            self._remove()
+
+        if not self.everyRevision:
+            return
+        if self.running and (self.call is None or not self.call.active()):
+            self.call = reactor.callLater(self.delay, self._save)
+
+    def _save(self):
+        # Mirrors that are still catching up with the library are skipped,
+        # so wait for them (or for them to fail).
+        from twisted.internet.defer import DeferredList
+
+        revision = self.library.revision
+        d = DeferredList([mirror.wait(revision)
+                          for mirror in self.mirrors.itervalues()],
+                         consumeErrors=True)
+        d.addCallback(lambda _: self.running and self.save())
@@ -0,0 +1,231 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+import hashlib
+import os
+from twisted.internet.defer import inlineCallbacks
+from twisted.test.proto_helpers import StringTransport
+from twisted.web import http
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.test_web import DummyRequest
+
+from marconi import artwork
+from marconi.artwork import ArtworkCache, artworkKey
+from marconi.db import Song
+from marconi.net.daap import ArtworkResource
+from marconi.test.test_base import LibraryTestCase
+
+def _image(name, size=32):
+    """Return the data of a (fake) JPEG image of the given size."""
+    return ('\xff\xd8' + name * size)[:size]
+
+class ArtworkTestCase(LibraryTestCase):
+    """Serves artwork from fake audio files, counting every extraction."""
+
+    def setUp(self):
+        LibraryTestCase.setUp(self)
+        self.images = {}
+        self.extracted = []
+        self.patch(artwork, 'extract', self._extract)
+
+    def _extract(self, path):
+        self.extracted.append(path)
+        data = self.images.get(path)
+        return data and (data, 'image/jpeg')
+
+    @inlineCallbacks
+    def _add(self, *songs):
+        """Add songs given as (path, album, image data) tuples."""
+        def _add(session):
+            for path, album, data in songs:
+                song = Song(path.decode('ascii'), u'Title')
+                song.album = album
+                song.artist = album and u'Artist'
+                song.mtime = 1.0
+                session.add(song)
+        yield self.library.write(_add)
+        for path, album, data in songs:
+            if data is not None:
+                self.images[path] = data
+
+    def _song(self, id):
+        return self.library.getSong(id)
+
+class ArtworkCacheTests(ArtworkTestCase):
+
+    @inlineCallbacks
+    def test_memory(self):
+        # Images are extracted once per album, and kept in memory.
+        yield self._add(('/a.mp3', u'Album', _image('a')),
+                        ('/b.mp3', u'Album', _image('b')))
+        cache = ArtworkCache(self.library)
+        first = yield self._song(1)
+        second = yield self._song(2)
+        image = yield cache.get(first)
+        self.assertEqual((image.data, image.type), (_image('a'), 'image/jpeg'))
+        self.assertEqual(image.digest, hashlib.sha1(_image('a')).hexdigest())
+        self.assertIdentical(image.path, None)
+
+        image = yield cache.get(second)
+        self.assertEqual(image.data, _image('a'))
+        self.assertEqual(self.extracted, ['/a.mp3'])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    @inlineCallbacks
+    def test_concurrent(self):
+        # Concurrent requests share a single extraction.
+        yield self._add(('/a.mp3', u'Album', _image('a')))
+        cache = ArtworkCache(self.library)
+        song = yield self._song(1)
+        first, second = cache.get(song), cache.get(song)
+        self.assertEqual(len(cache.pending[artworkKey(song)]), 2)
+        image = yield first
+        self.assertEqual(image.data, _image('a'))
+        image = yield second
+        self.assertEqual(image.data, _image('a'))
+        self.assertEqual(self.extracted, ['/a.mp3'])
+
+    @inlineCallbacks
+    def test_missing(self):
+        # Songs without artwork are only read once too.
+        yield self._add(('/a.mp3', None, None))
+        cache = ArtworkCache(self.library)
+        song = yield self._song(1)
+        image = yield cache.get(song)
+        self.assertIdentical(image, None)
+        image = yield cache.get(song)
+        self.assertIdentical(image, None)
+        self.assertEqual(self.extracted, ['/a.mp3'])
+        self.assertEqual(cache.entries[artworkKey(song)], (1, None, None))
+
+    @inlineCallbacks
+    def test_evict(self):
+        # The least recently served images are evicted from memory, and
+        # images too large to be worth keeping are never kept.
+        yield self._add(*[('/%s.mp3' % name, name.decode('ascii'),
+                           _image(name, 24)) for name in 'abcde'])
+        yield self._add(('/f.mp3', u'f', _image('f', 25)))
+        cache = ArtworkCache(self.library, maxsize=96)
+        songs = []
+        for id in xrange(1, 7):
+            song = yield self._song(id)
+            songs.append(song)
+        for song in songs[:4]:
+            yield cache.get(song)
+        yield cache.get(songs[0])
+        yield cache.get(songs[4])
+        digests = [hashlib.sha1(_image(name, 24)).hexdigest()
+                   for name in 'cdae']
+        self.assertEqual(cache.images.keys(), digests)
+        self.assertEqual(cache.size, 96)
+
+        image = yield cache.get(songs[5])
+        self.assertEqual(image.data, _image('f', 25))
+        self.assertEqual(cache.images.keys(), digests)
+
+    @inlineCallbacks
+    def test_disk(self):
+        # Images are stored on disk, and served from there by later caches
+        # without being extracted again.
+        directory = self.mktemp()
+        yield self._add(('/a.mp3', u'Album', _image('a')),
+                        ('/b.mp3', None, None))
+        cache = ArtworkCache(self.library, directory)
+        first = yield self._song(1)
+        second = yield self._song(2)
+        image = yield cache.get(first)
+        yield cache.get(second)
+        with open(cache._path(image.digest, image.type), 'rb') as f:
+            self.assertEqual(f.read(), _image('a'))
+        self.assertTrue(cache._path(image.digest, image.type).endswith(
+            '.jpg'))
+
+        # Entries are recorded by the library's writer.
+        yield self.library.write(lambda session: None)
+        cache = ArtworkCache(self.library, directory)
+        yield cache.load()
+        image = yield cache.get(first)
+        self.assertEqual(image.path,
+                         os.path.join(directory, image.digest[:2],
+                                      image.digest + '.jpg'))
+        self.assertIdentical(image.data, None)
+        image = yield cache.get(second)
+        self.assertIdentical(image, None)
+        self.assertEqual(self.extracted, ['/a.mp3', '/b.mp3'])
+
+    @inlineCallbacks
+    def test_changed(self):
+        # Artwork is extracted again once its file has changed, and its
+        # recorded entry is discarded.
+        yield self._add(('/a.mp3', u'Album', _image('a')))
+        cache = ArtworkCache(self.library)
+        song = yield self._song(1)
+        yield cache.get(song)
+        yield self.library.write(lambda session: None)
+
+        def _touch(session):
+            session.query(Song).get(1).mtime = 2.0
+        yield self.library.write(_touch)
+        self.assertEqual(cache.entries, {})
+        yield self.library.write(lambda session: None)
+        reloaded = ArtworkCache(self.library)
+        yield reloaded.load()
+        self.assertEqual(reloaded.entries, {})
+        song = yield self._song(1)
+        image = yield cache.get(song)
+        self.assertEqual(image.data, _image('a'))
+        self.assertEqual(self.extracted, ['/a.mp3', '/a.mp3'])
+
+class ArtworkResourceTests(ArtworkTestCase):
+
+    def _render(self, id, cache):
+        """Render a song's artwork, returning the finished request."""
+        resource = ArtworkResource(id)
+        resource.library = self.library
+        resource.artwork = cache
+        request = DummyRequest([''])
+        request.transport = StringTransport()
+        d = request.notifyFinish()
+        body = resource.render(request)
+        self.assertIdentical(body, NOT_DONE_YET)
+        d.addCallback(lambda _: request)
+        return d
+
+    @inlineCallbacks
+    def test_memory(self):
+        yield self._add(('/a.mp3', u'Album', _image('a')))
+        request = yield self._render(1, ArtworkCache(self.library))
+        self.assertEqual(request.responseCode, None)
+        self.assertEqual(request.outgoingHeaders['content-type'],
+                         'image/jpeg')
+        self.assertEqual(''.join(request.written), _image('a'))
+
+    @inlineCallbacks
+    def test_notFound(self):
+        # Songs without artwork (and missing songs) are not found.
+        yield self._add(('/a.mp3', u'Album', None))
+        cache = ArtworkCache(self.library)
+        for id in (1, 1, 42):
+            request = yield self._render(id, cache)
+            self.assertEqual(request.responseCode, http.NOT_FOUND)
+        self.assertEqual(self.extracted, ['/a.mp3'])
+
+    @inlineCallbacks
+    def test_disk(self):
+        # Images on disk are streamed from there, and are extracted again
+        # if they have gone missing.
+        yield self._add(('/a.mp3', u'Album', _image('a')))
+        directory = self.mktemp()
+        cache = ArtworkCache(self.library, directory)
+        song = yield self._song(1)
+        image = yield cache.get(song)
+        cache.images.clear()
+        request = yield self._render(1, cache)
+        self.assertEqual(request.outgoingHeaders['content-length'], '32')
+        self.assertEqual(''.join(request.written), _image('a'))
+
+        cache.images.clear()
+        os.remove(cache._path(image.digest, image.type))
+        request = yield self._render(1, cache)
+        self.assertEqual(''.join(request.written), _image('a'))
+        self.assertEqual(self.extracted, ['/a.mp3', '/a.mp3'])
@@ -0,0 +1,285 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+import os
+import time
+from array import array
+from sqlalchemy import select
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from marconi import base, db
+from marconi.base import Library
+from marconi.db import Playlist, PlaylistSong, Song
+from marconi.scanner import Scanner
+
+# The spacing of a playlist's positions.
+STEP = PlaylistSong.POSITION_STEP
+
+# The longest that a listing may take while the library is being imported
+# into, in seconds.  Idle listings take a few milliseconds.
+LATENCY_BOUND = 0.5
+
+def _rows(first, count):
+    return [{'path': u'/music/%d.mp3' % i, 'title': u'Song %d' % i}
+            for i in xrange(first, first + count)]
+
+class LibraryTestCase(unittest.TestCase):
+    """Runs its tests against an empty, memory-based library."""
+
+    def setUp(self):
+        self.engine = db.create(':memory:')
+        self.library = Library(self.engine, 'Test', catalog=False)
+
+    def tearDown(self):
+        self.close(self.library)
+        db.Base.metadata.bind = None
+
+    def close(self, library):
+        """Stop a library and its threads."""
+        if library.running:
+            reactor.removeSystemEventTrigger(library.shutdownID)
+            library._stop()
+        db.changes.unsubscribe(library._notify)
+
+class MemoizeTests(LibraryTestCase):
+
+    def setUp(self):
+        LibraryTestCase.setUp(self)
+        self.patch(base, 'MEMO_SIZE', 400)
+
+    def _memoize(self, key, length):
+        def _query(session):
+            return array('i', range(length))
+        return self.library._memoize(key, _query)
+
+    def test_cached(self):
+        d = self._memoize('a', 10)
+        def _check(result):
+            self.assertEqual(list(result), range(10))
+            self.assertIdentical(self.library.memo['a'][0], result)
+            self.assertEqual(self.library.memoSize, 40)
+        d.addCallback(_check)
+        return d
+
+    def test_evict(self):
+        # The least recently used results are evicted, one at a time, until
+        # the rest fit.
+        d = self._memoize('a', 40)
+        d.addCallback(lambda _: self._memoize('b', 40))
+        d.addCallback(lambda _: self._memoize('a', 40))
+        d.addCallback(lambda _: self._memoize('c', 40))
+        def _check(result):
+            self.assertEqual(self.library.memo.keys(), ['a', 'c'])
+            self.assertEqual(self.library.memoSize, 320)
+        d.addCallback(_check)
+        return d
+
+    def test_tooLarge(self):
+        d = self._memoize('a', 10)
+        d.addCallback(lambda _: self._memoize('b', 101))
+        def _check(result):
+            self.assertEqual(self.library.memo.keys(), ['a'])
+        d.addCallback(_check)
+        return d
+
+    def test_revision(self):
+        d = self._memoize('a', 10)
+        def _check(result):
+            self.library.advance(self.library.revision + 1, set())
+            self.assertEqual(len(self.library.memo), 0)
+            self.assertEqual(self.library.memoSize, 0)
+        d.addCallback(_check)
+        return d
+
+class PlaylistTests(LibraryTestCase):
+
+    def setUp(self):
+        LibraryTestCase.setUp(self)
+        session = db.Session(bind=self.engine)
+        session.add(Playlist(u'Playlist'))
+        for id in xrange(1, 4):
+            session.add(Song(u'/music/%d.mp3' % id, u'Song %d' % id))
+        session.commit()
+        session.close()
+        self.playlist = 1
+
+    def _entries(self):
+        """Return the playlist's (entry id, song id, position) rows."""
+        table = PlaylistSong.__table__
+        query = select([table.c.id, table.c.song_id, table.c.position],
+                       table.c.playlist_id == self.playlist,
+                       order_by=[table.c.position])
+        return [tuple(row) for row in self.engine.execute(query)]
+
+    def _order(self):
+        return [entry for entry, song, position in self._entries()]
+
+    def _setPositions(self, positions):
+        table = PlaylistSong.__table__
+        for entry, position in enumerate(positions):
+            self.engine.execute(table.update(table.c.id == entry + 1),
+                                position=position)
+
+    def test_append(self):
+        d = self.library.appendSongs(self.playlist, [1, 2, 3])
+        d.addCallback(lambda _: self.library.appendSongs(self.playlist, [1]))
+        def _check(_):
+            self.assertEqual(self._entries(), [(1, 1, STEP), (2, 2, STEP * 2),
+                                               (3, 3, STEP * 3),
+                                               (4, 1, STEP * 4)])
+        d.addCallback(_check)
+        return d
+
+    def test_appendNothing(self):
+        revision = self.library.revision
+        d = self.library.appendSongs(self.playlist, [])
+        def _check(_):
+            self.assertEqual(self._entries(), [])
+            self.assertEqual(self.library.revision, revision)
+        d.addCallback(_check)
+        return d
+
+    def test_move(self):
+        # Only the moved entry is written, halfway into the gap before the
+        # entry that it's moved in front of.
+        d = self.library.appendSongs(self.playlist, [1, 2, 3])
+        d.addCallback(lambda _: self.library.moveEntry(self.playlist, 3, 2))
+        def _check(_):
+            self.assertEqual(self._entries(), [(1, 1, STEP),
+                                               (3, 3, STEP + STEP // 2),
+                                               (2, 2, STEP * 2)])
+        d.addCallback(_check)
+        d.addCallback(lambda _: self.library.moveEntry(self.playlist, 1))
+        d.addCallback(lambda _: self.assertEqual(self._order(), [3, 2, 1]))
+        return d
+
+    def test_moveFirst(self):
+        d = self.library.appendSongs(self.playlist, [1, 2, 3])
+        d.addCallback(lambda _: self.library.moveEntry(self.playlist, 3, 1))
+        d.addCallback(lambda _: self.assertEqual(self._entries()[0],
+                                                 (3, 3, STEP // 2)))
+        return d
+
+    def test_moveMissing(self):
+        d = self.library.appendSongs(self.playlist, [1, 2])
+        d.addCallback(lambda _: self.library.moveEntry(self.playlist, 1, 42))
+        self.assertFailure(d, ValueError)
+        d.addCallback(lambda _: self.assertEqual(self._order(), [1, 2]))
+        return d
+
+    def test_renumber(self):
+        # Adjacent positions leave no room between them, so the playlist is
+        # renumbered before the entry is moved.
+        d = self.library.appendSongs(self.playlist, [1, 2, 3])
+        d.addCallback(lambda _: self._setPositions([1, 2, 3]))
+        d.addCallback(lambda _: self.library.moveEntry(self.playlist, 3, 2))
+        def _check(_):
+            self.assertEqual(self._entries(), [(1, 1, STEP),
+                                               (3, 3, STEP + STEP // 2),
+                                               (2, 2, STEP * 2)])
+        d.addCallback(_check)
+        return d
+
+    @inlineCallbacks
+    def test_gapsRunOut(self):
+        # Moving entries into the same gap halves it each time, until the
+        # playlist has to be renumbered.  The order is kept throughout.
+        renumbered = []
+        renumber = self.library._renumber
+        def _renumber(session, playlist):
+            renumbered.append(playlist)
+            renumber(session, playlist)
+        self.library._renumber = _renumber
+
+        yield self.library.appendSongs(self.playlist, [1, 2, 3, 1, 2])
+        order = [1, 2, 3, 4, 5]
+        for i in xrange(12):
+            entry = order.pop()
+            order.insert(1, entry)
+            yield self.library.moveEntry(self.playlist, entry, order[2])
+            self.assertEqual(self._order(), order)
+        self.assertEqual(renumbered, [self.playlist])
+
+        positions = [position for entry, song, position in self._entries()]
+        self.assertEqual(len(set(positions)), len(positions))
+
+    def test_remove(self):
+        d = self.library.appendSongs(self.playlist, [1, 2, 3, 1])
+        d.addCallback(lambda _: self.library.removeEntries(self.playlist,
+                                                           [1, 3]))
+        def _check(_):
+            self.assertEqual(self._entries(), [(2, 2, STEP * 2),
+                                               (4, 1, STEP * 4)])
+        d.addCallback(_check)
+        return d
+
+    def test_revision(self):
+        # Each change to a playlist's entries makes a new revision.
+        revision = self.library.revision
+        d = self.library.appendSongs(self.playlist, [1, 2])
+        d.addCallback(lambda _: self.library.moveEntry(self.playlist, 2, 1))
+        d.addCallback(lambda _: self.library.removeEntries(self.playlist,
+                                                           [1]))
+        d.addCallback(lambda _: self.assertEqual(self.library.revision,
+                                                 revision + 3))
+        return d
+
+class FileLibraryTestCase(LibraryTestCase):
+    """
+    Runs its tests against a file-based library, which has a writer thread,
+    holding the ``songs`` songs that setUp() adds.
+    """
+
+    songs = 10
+
+    def setUp(self):
+        self.directory = os.path.abspath(self.mktemp())
+        os.makedirs(self.directory)
+        self.path = os.path.join(self.directory, 'library.db')
+        self.engine = db.create(self.path)
+        self.library = Library(self.engine, 'Test', catalog=False)
+        self.scanner = Scanner(self.library)
+        return self.library.write(self.scanner.apply, _rows(1, self.songs))
+
+    def open(self, **kwargs):
+        """Open another library on the same database."""
+        library = Library(self.engine, 'Test', catalog=False, **kwargs)
+        self.addCleanup(self.close, library)
+        return library
+
+class WriteLatencyTests(FileLibraryTestCase):
+    """
+    Listings are read from the library while its writer imports songs, so
+    that reads and writes really do run side by side.
+    """
+
+    songs = 1000
+
+    @inlineCallbacks
+    def test_listingLatency(self):
+        # Far more writes are queued than the writer takes on at once, and
+        # queueing them doesn't hold up the reactor.
+        self.library.writer.maxsize = 4
+        start = time.time()
+        writes = [self.library.write(self.scanner.apply,
+                                     _rows(1001 + i * 100, 100))
+                  for i in xrange(100)]
+        self.assertTrue(time.time() - start < LATENCY_BOUND)
+        self.assertTrue(self.library.writer.pending)
+
+        latencies = []
+        while not writes[-1].called:
+            start = time.time()
+            songs = yield self.library.getSongs(0, 100)
+            latencies.append(time.time() - start)
+            self.assertEqual(len(songs), 100)
+        for d in writes:
+            yield d
+
+        self.assertTrue(latencies)
+        self.assertTrue(max(latencies) < LATENCY_BOUND,
+                        'Listing took %.3fs' % (max(latencies),))
+        count = self.engine.execute('SELECT COUNT(*) FROM songs').scalar()
+        self.assertEqual(count, 11000)
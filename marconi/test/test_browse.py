@@ -0,0 +1,72 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+from twisted.trial import unittest
+
+from marconi.browse import BrowseIndex
+from marconi.test.test_mirror import FakeLibrary
+
+class BrowseIndexTests(unittest.TestCase):
+
+    rows = [
+        # id, artist, album, genre, composer
+        (1, u'Miles Davis', u'Kind of Blue', u'Jazz', u'Miles Davis'),
+        (2, u'Miles Davis', u'Bitches Brew', u'Jazz', None),
+        (3, u'Bill Evans', u'Kind of Blue', None, None),
+    ]
+
+    def setUp(self):
+        self.index = BrowseIndex(FakeLibrary())
+        self.index.replace(self.rows)
+
+    def test_values(self):
+        self.assertEqual(list(self.index['album']),
+                         [u'Bitches Brew', u'Kind of Blue'])
+        self.assertEqual(self.index['artist'].counts,
+                         {u'Bill Evans': 1, u'Miles Davis': 2})
+        self.assertEqual(sorted(self.index.strings),
+                         [u'Bill Evans', u'Bitches Brew', u'Jazz',
+                          u'Kind of Blue', u'Miles Davis'])
+        # Songs share a single copy of each string.
+        self.assertIdentical(self.index.rows[1][0], self.index.rows[1][3])
+
+    def test_deleted(self):
+        # Strings are released along with the last song that has them, in
+        # any of its fields.
+        self.index.update([3], [])
+        self.assertEqual(list(self.index['artist']), [u'Miles Davis'])
+        self.assertNotIn(u'Bill Evans', self.index.strings)
+        self.assertIn(u'Kind of Blue', self.index.strings)
+
+        self.index.update([1], [])
+        self.assertEqual(list(self.index['album']), [u'Bitches Brew'])
+        self.assertEqual(list(self.index['composer']), [])
+        self.assertNotIn(u'Kind of Blue', self.index.strings)
+        self.assertIn(u'Miles Davis', self.index.strings)
+
+        self.index.update([2], [])
+        self.assertEqual(self.index.strings, {})
+        self.assertEqual(self.index.lastId(), 0)
+
+    def test_changed(self):
+        self.index.update([], [(3, u'Bill Evans', u'Sunday at the Village '
+                                u'Vanguard', u'Jazz', None)])
+        self.index.update([], [(2, u'Miles', u'Bitches Brew', u'Jazz',
+                                None)])
+        self.assertEqual(sorted(self.index.strings),
+                         [u'Bill Evans', u'Bitches Brew', u'Jazz',
+                          u'Kind of Blue', u'Miles', u'Miles Davis',
+                          u'Sunday at the Village Vanguard'])
+        self.index.update([], [(1, u'Miles', u'Kind of Blue', u'Jazz',
+                                None)])
+        self.assertNotIn(u'Miles Davis', self.index.strings)
+
+    def test_undumped(self):
+        # Restored indexes release their strings just the same.
+        index = BrowseIndex(FakeLibrary())
+        index.undump(self.index.state())
+        self.assertEqual(index.strings, self.index.strings)
+        self.assertEqual(index.rows, self.index.rows)
+        index.update([1, 2, 3], [])
+        self.assertEqual(index.strings, {})
+        self.assertEqual(len(index['artist']), 0)
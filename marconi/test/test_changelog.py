@@ -0,0 +1,66 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+from sqlalchemy import select
+
+from marconi.db import Change, Song
+from marconi.test.test_base import LibraryTestCase
+
+class ChangeLogTests(LibraryTestCase):
+
+    def _entries(self):
+        table = Change.__table__
+        query = select([table.c.revision, table.c.kind, table.c.item],
+                       order_by=[table.c.id])
+        return [tuple(row) for row in self.engine.execute(query)]
+
+    def _add(self, session, path, fail=False):
+        song = Song(path, u'Song')
+        session.add(song)
+        session.flush()
+        if fail:
+            raise RuntimeError('write failed')
+        return song.id
+
+    def test_logged(self):
+        # A transaction's entries are committed along with it, and the
+        # library moves to the revision they were logged at.
+        d = self.library.write(self._add, u'/music/1.mp3')
+        def _check(id):
+            self.assertEqual(self._entries(), [(2, Change.SONG, id)])
+            self.assertEqual(self.library.revision, 2)
+            self.assertEqual(self.library.changelog.revision, 2)
+        d.addCallback(_check)
+        d.addCallback(lambda _: self.library.write(self._add, u'/music/2.mp3'))
+        d.addCallback(lambda id: self.assertEqual(self._entries()[-1],
+                                                  (3, Change.SONG, id)))
+        return d
+
+    def test_rolledBack(self):
+        d = self.library.write(self._add, u'/music/1.mp3', fail=True)
+        self.assertFailure(d, RuntimeError)
+        def _check(_):
+            self.assertEqual(self._entries(), [])
+            self.assertEqual(self.library.revision, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_unlogged(self):
+        # Transactions that don't change songs or playlists don't make a
+        # revision.
+        d = self.library.write(lambda session: session.execute(
+            Change.__table__.delete()))
+        def _check(_):
+            self.assertEqual(self._entries(), [])
+            self.assertEqual(self.library.revision, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_resume(self):
+        # A new library picks up at the log's latest revision.
+        d = self.library.write(self._add, u'/music/1.mp3')
+        def _check(_):
+            self.assertEqual(self.library.changelog.__class__(
+                self.library).revision, 2)
+        d.addCallback(_check)
+        return d
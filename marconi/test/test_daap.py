@@ -0,0 +1,727 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+import random
+import struct
+import zlib
+from array import array
+from sqlalchemy import select
+from twisted.internet.defer import DeferredList, fail, gatherResults
+from twisted.internet.error import ConnectionDone
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web import error, http
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.test_web import DummyRequest
+
+from marconi import db
+from marconi.db import Song
+from marconi.net import daap
+from marconi.net.daap import DEFAULT_META, Block, Byte, \
+                             ContainerItemsResource, DatabaseResource, \
+                             DatabasesResource, Date, Int, List, \
+                             ListingProducer, Long, RecordCache, RecordList, \
+                             Resource, ResponseCache, ServerInfoResource, \
+                             Short, String, UpdateResource, Version, \
+                             acceptsGzip, decode, encode, iterBlocks, \
+                             readListing, songRecord, songRecordSize
+from marconi.net.session import SessionTable
+from marconi.test.test_base import LibraryTestCase
+
+def _songs(count):
+    songs = []
+    for id in xrange(1, count + 1):
+        song = Song(u'/music/%d.mp3' % id, u'Song %d' % id)
+        song.id = id
+        songs.append(song)
+    return songs
+
+def _serialize(block):
+    """Serialize a block recursively, one block at a time."""
+    data = struct.pack('>4si', block.tag, block.size)
+    data += block.value.serialize()
+    return data + ''.join([_serialize(child) for child in block.children])
+
+class EncodeTests(unittest.TestCase):
+
+    def _check(self, block):
+        data = encode(block)
+        self.assertIsInstance(data, bytearray)
+        self.assertEqual(len(data), 8 + block.size)
+        self.assertEqual(str(data), _serialize(block))
+        self.assertEqual(block.serialize(), _serialize(block))
+
+    def test_scalars(self):
+        r = Block('msrv', List())
+        r.add(Block('mstt', Int(200)))
+        r.add(Block('msau', Byte(255)))
+        r.add(Block('mcty', Short(-2)))
+        r.add(Block('mper', Long(-1)))
+        r.add(Block('mper', Long(0x7fffffffffffffff)))
+        r.add(Block('asda', Date(1234567890)))
+        r.add(Block('mpro', Version(2 << 16)))
+        r.add(Block('apro', Version((3 << 16) | 1)))
+        self._check(r)
+
+    def test_strings(self):
+        r = Block('mlit', List())
+        r.add(Block('minm', String('Caf\xc3\xa9')))
+        r.add(Block('asal', String('')))
+        r.add(Block('asar', String('x' * 1000)))
+        self._check(r)
+        self._check(Block('minm', String('Title')))
+
+    def test_nested(self):
+        r = Block('adbs', List())
+        r.add(Block('mstt', Int(200)))
+        listing = Block('mlcl', List())
+        for song in _songs(3):
+            listing.add(songRecord(song, DEFAULT_META + ('asda',)))
+        listing.add(Block('mlit', List()))
+        r.add(listing)
+        r.add(Block('mudl', List()))
+        self._check(r)
+
+    def test_browse(self):
+        # Browse listings' items are strings.
+        r = Block('abro', List())
+        listing = Block('abar', List())
+        for name in ('Artist', '', 'Caf\xc3\xa9'):
+            listing.add(Block('mlit', String(name)))
+        r.add(listing)
+        self._check(r)
+
+class DecodeTests(unittest.TestCase):
+
+    def _response(self):
+        r = Block('adbs', List())
+        r.add(Block('mstt', Int(200)))
+        listing = Block('mlcl', List())
+        for song in _songs(2):
+            listing.add(songRecord(song, DEFAULT_META + ('asda',)))
+        r.add(listing)
+        return r
+
+    def test_roundTrip(self):
+        block = self._response()
+        data = block.serialize()
+        view = decode(data)
+        self.assertEqual((view.tag, len(view)), ('adbs', len(data)))
+        self.assertEqual(view.toBlock().serialize(), data)
+
+        records = list(view.find('mlcl'))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1].find('minm').value, 'Song 2')
+        self.assertIsInstance(records[1].find('mper').value, Long)
+        self.assertEqual(records[1].find('mikd').value, 2)
+        self.assertIdentical(records[1].find('asar'), None)
+
+    def test_browse(self):
+        r = Block('abro', List())
+        listing = Block('abgn', List())
+        listing.add(Block('mlit', String('Jazz')))
+        r.add(listing)
+        view = decode(r.serialize())
+        (item,) = list(view.find('abgn'))
+        self.assertIdentical(item.type, String)
+        self.assertEqual(item.value, 'Jazz')
+
+    def test_truncated(self):
+        data = self._response().serialize()
+        self.assertRaises(ValueError, decode, data[:6])
+        self.assertRaises(ValueError, decode, data[:-1])
+
+        # A child that runs past the end of its container.
+        data = struct.pack('>4si', 'mlcl', 12) + \
+               struct.pack('>4si', 'mstt', 8) + '\0' * 8
+        self.assertRaises(ValueError, list, decode(data))
+
+        # A scalar value of the wrong size.
+        data = struct.pack('>4si', 'mstt', 2) + '\0\0'
+        self.assertRaises(ValueError, getattr, decode(data), 'value')
+
+    def test_unknown(self):
+        # Unknown tags decode to their raw bytes, and are skipped over.
+        data = struct.pack('>4si', 'mlit', 26) + \
+               struct.pack('>4si', 'zzzz', 6) + 'secret' + \
+               Block('miid', Int(7)).serialize()
+        view = decode(data)
+        unknown, known = list(view)
+        self.assertIdentical(unknown.type, None)
+        self.assertEqual(unknown.value, 'secret')
+        self.assertEqual(list(unknown), [])
+        self.assertEqual(known.value, 7)
+
+    def test_zeroCopy(self):
+        # Views share the decoded buffer rather than copying it.
+        data = bytearray(self._response().serialize())
+        view = decode(data)
+        listing = view.find('mlcl')
+        record = list(listing)[0]
+        self.assertIdentical(record.buffer, view.buffer)
+        title = record.find('minm')
+        raw = title.raw
+        self.assertIsInstance(raw, memoryview)
+        data[title.offset + 8] = 'X'
+        self.assertEqual(raw.tobytes(), 'Xong 1')
+        self.assertEqual(title.value, 'Xong 1')
+
+    def test_iterBlocks(self):
+        blocks = [Block('mstt', Int(200)), Block('minm', String('Name')),
+                  self._response()]
+        data = ''.join([block.serialize() for block in blocks])
+        self.assertEqual([view.tag for view in iterBlocks(data)],
+                         ['mstt', 'minm', 'adbs'])
+        self.assertRaises(ValueError, list, iterBlocks(data + 'mst'))
+
+class RecordCacheTests(unittest.TestCase):
+
+    def _scan(self, cache, songs):
+        for song in songs:
+            cache.get(song, DEFAULT_META)
+
+    def test_get(self):
+        cache = RecordCache()
+        song = _songs(1)[0]
+        data = cache.get(song, DEFAULT_META)
+        self.assertEqual(data, songRecord(song, DEFAULT_META).serialize())
+        self.assertEqual(cache.get(song, DEFAULT_META), data)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_invalidate(self):
+        cache = RecordCache()
+        song = _songs(1)[0]
+        cache.get(song, DEFAULT_META)
+        cache.invalidate([(Song, song.id)], 2)
+        cache.get(song, DEFAULT_META)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_stale(self):
+        # Songs read before the latest invalidation may have changed since
+        # (while they were being read), so their records aren't stored.
+        cache = RecordCache()
+        first, second = _songs(2)
+        cache.invalidate([(Song, first.id)], 3)
+        cache.get(first, DEFAULT_META, 2)
+        cache.get(second, DEFAULT_META, 3)
+        self.assertEqual(cache.keys.keys(), [second.id])
+        cache.get(first, DEFAULT_META)
+        self.assertEqual(sorted(cache.keys), [first.id, second.id])
+
+    def test_threads(self):
+        # The cache is shared by the reactor and the database threads.
+        cache = RecordCache(maxsize=50)
+        songs = _songs(100)
+        def _scan(revision):
+            for song in songs:
+                cache.get(song, DEFAULT_META, revision)
+        def _invalidate():
+            for i, song in enumerate(songs):
+                cache.invalidate([(Song, song.id)], i)
+        d = DeferredList([deferToThread(_scan, 0), deferToThread(_scan, 100),
+                          deferToThread(_invalidate)], fireOnOneErrback=True)
+        def _check(_):
+            # The entries and their index still agree.
+            self.assertTrue(len(cache.entries) <= 50)
+            self.assertEqual(sorted(cache.entries),
+                             sorted([(id, tags)
+                                     for id, metas in cache.keys.iteritems()
+                                     for tags in metas]))
+        d.addCallback(_check)
+        return d
+
+    def test_evict(self):
+        cache = RecordCache(maxsize=2)
+        first, second, third = _songs(3)
+        self._scan(cache, (first, second, first, third))
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(cache.keys.keys(), [first.id, third.id])
+
+    def test_reserve(self):
+        # A scan of more songs than the cache holds misses on every record
+        # until the cache has reserved room for them.
+        songs = _songs(30)
+        cache = RecordCache(maxsize=20)
+        self._scan(cache, songs)
+        self._scan(cache, songs)
+        self.assertEqual(cache.hits, 0)
+
+        cache.reserve(len(songs))
+        self.assertEqual(cache.maxsize, 60)
+        self._scan(cache, songs)
+        cache.hits = cache.misses = 0
+        self._scan(cache, songs)
+        self.assertEqual((cache.hits, cache.misses), (30, 0))
+
+        # It never shrinks to fit smaller listings.
+        cache.reserve(5)
+        self.assertEqual(cache.maxsize, 60)
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def _request(self, session='1', **args):
+        request = DummyRequest(['databases'])
+        request.path = '/databases'
+        request.args['session-id'] = [session]
+        for name, value in args.iteritems():
+            request.args[name] = [value]
+        return request
+
+    def test_revision(self):
+        # Responses are only served at the revision they were generated at.
+        cache = ResponseCache()
+        cache.put(self._request(), 5, 'five')
+        self.assertEqual(cache.get(self._request(), 5), 'five')
+        self.assertIdentical(cache.get(self._request(), 6), None)
+        self.assertIdentical(cache.get(self._request(), 5, 'gzip'), None)
+        self.assertIdentical(cache.get(self._request(meta='all'), 5), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_invalidate(self):
+        # Responses generated at a newer revision discard the older ones,
+        # and responses that are older than the cached ones aren't kept.
+        cache = ResponseCache()
+        cache.put(self._request(), 5, 'five')
+        cache.put(self._request(), 6, 'six')
+        self.assertEqual(cache.entries.values(), ['six'])
+        self.assertEqual((cache.revision, cache.size), (6, 3))
+        cache.put(self._request(meta='all'), 5, 'five')
+        self.assertEqual(cache.entries.values(), ['six'])
+        self.assertIdentical(cache.get(self._request(), 5), None)
+
+    def test_session(self):
+        # Every client's session shares the same cached response.
+        cache = ResponseCache()
+        cache.put(self._request('1'), 5, 'five')
+        self.assertEqual(cache.get(self._request('2'), 5), 'five')
+
+    def test_size(self):
+        cache = ResponseCache(maxsize=8, maxentry=5)
+        cache.put(self._request(), 5, 'sixsix')
+        cache.put(self._request(meta='a'), 5, 'five')
+        cache.put(self._request(meta='b'), 5, 'fiver')
+        self.assertEqual(cache.entries.values(), ['five'])
+
+class AcceptsGzipTests(unittest.TestCase):
+
+    def _accepts(self, header):
+        request = DummyRequest([''])
+        if header is not None:
+            request.headers['accept-encoding'] = header
+        return acceptsGzip(request)
+
+    def test_listed(self):
+        for header in ('gzip', 'GZIP', 'x-gzip', 'deflate, gzip',
+                       'gzip;q=0.5', 'gzip; Q=1.0', 'identity, gzip;q=0.1'):
+            self.assertTrue(self._accepts(header), header)
+
+    def test_refused(self):
+        for header in (None, '', 'identity', 'deflate', 'gzip;q=0',
+                       'gzip;q=0.000', 'gzip;q=bogus', 'gzipped',
+                       'gzip;q=0, identity', '*;q=0'):
+            self.assertFalse(self._accepts(header), header)
+
+    def test_wildcard(self):
+        # The wildcard stands for gzip unless gzip is listed itself.
+        self.assertTrue(self._accepts('*'))
+        self.assertTrue(self._accepts('identity;q=1, *;q=0.5'))
+        self.assertFalse(self._accepts('gzip;q=0, *'))
+        self.assertTrue(self._accepts('gzip, *;q=0'))
+
+class SendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = Resource()
+        self.resource.responses = ResponseCache()
+
+    def _send(self, body, encoding='gzip'):
+        request = FakeRequest(pausing=False)
+        request.headers['accept-encoding'] = encoding
+        return request, self.resource.send(request, body, 5)
+
+    def _body(self, size):
+        words = ['daap', 'song', 'album', 'artist', 'genre']
+        return ' '.join([random.choice(words) for i in xrange(size // 4)])
+
+    def _decompress(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    def test_small(self):
+        request, data = self._send('x' * (daap.COMPRESS_MINIMUM - 1))
+        self.assertEqual(len(data), daap.COMPRESS_MINIMUM - 1)
+        self.assertNotIn('content-encoding', request.outgoingHeaders)
+
+    def test_identity(self):
+        body = self._body(4096)
+        request, data = self._send(body, 'identity')
+        self.assertIdentical(data, body)
+        self.assertEqual(self.resource.responses.entries, {})
+
+    def test_cached(self):
+        # The compressed body is cached, and decompresses to the plain one.
+        body = self._body(4096)
+        request, data = self._send(body)
+        self.assertEqual(request.outgoingHeaders['content-encoding'], 'gzip')
+        self.assertEqual(request.outgoingHeaders['content-length'],
+                         str(len(data)))
+        self.assertTrue(len(data) < len(body))
+        self.assertEqual(self._decompress(data), body)
+        cached = self.resource.responses.get(request, 5, 'gzip')
+        self.assertEqual(cached, data)
+
+        request, again = self._send(body)
+        self.assertIdentical(again, data)
+        self.assertEqual(request.outgoingHeaders['content-encoding'], 'gzip')
+
+    def test_threaded(self):
+        # Large bodies are compressed in a thread.
+        body = self._body(daap.COMPRESS_THREAD_MINIMUM)
+        request, data = self._send(body)
+        self.assertIdentical(data, NOT_DONE_YET)
+        d = request.notifyFinish()
+        def _check(_):
+            data = ''.join(request.written)
+            self.assertEqual(request.outgoingHeaders['content-length'],
+                             str(len(data)))
+            self.assertEqual(self._decompress(data), body)
+            self.assertEqual(self.resource.responses.get(request, 5, 'gzip'),
+                             data)
+        d.addCallback(_check)
+        return d
+
+class SessionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = SessionTable()
+
+    def _preRender(self, cls, session=None):
+        resource = cls()
+        resource.sessions = self.sessions
+        request = DummyRequest([''])
+        if session is not None:
+            request.args['session-id'] = [session]
+        return resource.preRender(request), request.responseCode
+
+    def test_required(self):
+        self.assertEqual(self._preRender(DatabasesResource),
+                         (False, http.FORBIDDEN))
+        self.assertEqual(self._preRender(DatabasesResource, '42'),
+                         (False, http.FORBIDDEN))
+        self.assertEqual(self._preRender(DatabasesResource, 'bogus'),
+                         (False, http.FORBIDDEN))
+
+        session = self.sessions.create()
+        self.assertEqual(self._preRender(DatabasesResource, str(session.id)),
+                         (True, None))
+
+        self.sessions.remove(session.id)
+        self.assertEqual(self._preRender(DatabasesResource, str(session.id)),
+                         (False, http.FORBIDDEN))
+
+    def test_notRequired(self):
+        self.assertEqual(self._preRender(ServerInfoResource), (True, None))
+
+class ContainerItemsTests(LibraryTestCase):
+
+    def setUp(self):
+        LibraryTestCase.setUp(self)
+        session = db.Session(bind=self.engine)
+        for song in _songs(2):
+            song.id = None
+            session.add(song)
+        session.commit()
+        session.close()
+
+    def _render(self, entries, songs):
+        """Render a playlist, returning its status blocks and records."""
+        resource = ContainerItemsResource(None, 1)
+        resource.library = self.library
+        resource.records = RecordCache()
+        def streamListing(request, response, listing, revision):
+            return response, listing
+        resource.streamListing = streamListing
+        playlist = array('i', entries), array('i', songs)
+        d = resource._render(playlist, DummyRequest(['']), None)
+        def _blocks((response, listing)):
+            counts = dict([(block.tag, block.value)
+                           for block in response.children])
+            d = readListing(listing)
+            d.addCallback(lambda records: (counts, listing, records))
+            return d
+        d.addCallback(_blocks)
+        return d
+
+    def test_missing(self):
+        # Songs deleted since the playlist was read aren't returned, and
+        # aren't counted as returned either.
+        d = self._render([10, 11, 12], [1, 42, 2])
+        def _check((counts, listing, records)):
+            self.assertEqual((counts['mtco'], counts['mrco']), (3, 2))
+            self.assertEqual(len(records), listing.size)
+            self.assertEqual(records.count('mlit'), 2)
+        d.addCallback(_check)
+        return d
+
+class RecordSizeTests(LibraryTestCase):
+
+    def test_size(self):
+        # The SQL size of each record matches its encoded length, whichever
+        # of its fields are NULL, empty or not ASCII.
+        tags = DEFAULT_META + ('asbr', 'ascm', 'asco', 'asda', 'asgn', 'asyr')
+        songs = [Song(u'/music/1.mp3', u'Song'),
+                 Song(u'/music/2.mp3', u'Caf\xe9 \u266b'),
+                 Song(u'/music/3.mp3', u'')]
+        songs[0].album = u'Album'
+        songs[0].bitrate = 128
+        songs[0].year = 1999
+        songs[1].artist = u'\xc9dith Piaf'
+        songs[1].comment = u''
+        songs[2].genre = u'\u97f3\u697d'
+        songs[2].compilation = 0
+        session = db.Session(bind=self.engine)
+        session.add_all(songs)
+        session.commit()
+
+        query = select([Song.id, songRecordSize(tags)], order_by=[Song.id])
+        sizes = [size for id, size in self.engine.execute(query)]
+        self.assertEqual(sizes, [len(songRecord(song, tags).serialize())
+                                 for song in songs])
+        session.close()
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.connected = True
+
+    def loseConnection(self):
+        self.connected = False
+
+class FakeRequest(DummyRequest):
+    """A request whose producer is only resumed when the test says so."""
+
+    def __init__(self, pausing=True):
+        DummyRequest.__init__(self, [''])
+        self.path = '/'
+        self.transport = FakeTransport()
+        self.producer = None
+        self.pausing = pausing
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        DummyRequest.write(self, data)
+        # The transport's buffer fills up after every write.
+        if self.pausing and self.producer is not None:
+            self.producer.pauseProducing()
+
+class ListingProducerTests(unittest.TestCase):
+
+    def _produce(self, store=None):
+        self.request = FakeRequest()
+        self.listing = RecordList(['a', 'b', 'c'], batchSize=2)
+        producer = ListingProducer(self.request, 'prefix', self.listing,
+                                   store)
+        producer.start()
+        return producer
+
+    def test_paused(self):
+        # A batch is only written once the transport has room for it.
+        producer = self._produce()
+        self.assertEqual(self.request.written, ['prefix'])
+        producer.resumeProducing()
+        self.assertEqual(self.request.written, ['prefix', 'ab'])
+        producer.resumeProducing()
+        producer.resumeProducing()
+        self.assertEqual(self.request.written, ['prefix', 'ab', 'c'])
+        self.assertEqual(self.request.finished, 1)
+        self.assertIdentical(self.request.producer, None)
+        self.assertIdentical(producer.body, None)
+
+    def test_store(self):
+        # Only cacheable responses are kept, and only until they are stored.
+        stored = []
+        producer = self._produce(stored.append)
+        while not self.request.finished:
+            producer.resumeProducing()
+        self.assertEqual(stored, ['prefixabc'])
+        self.assertIdentical(producer.body, None)
+
+    def test_stopped(self):
+        # Listings are closed (and never stored) if the client disconnects.
+        stored = []
+        producer = self._produce(stored.append)
+        producer.resumeProducing()
+        producer.stopProducing()
+        producer.resumeProducing()
+        self.assertEqual(self.request.written, ['prefix', 'ab'])
+        self.assertEqual(self.listing.records, [])
+        self.assertEqual(stored, [])
+
+    def test_failed(self):
+        # The connection is dropped if the listing can't be read.
+        producer = self._produce()
+        self.listing.read = lambda: fail(RuntimeError('read failed'))
+        producer.resumeProducing()
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertFalse(self.request.transport.connected)
+        self.assertFalse(self.request.finished)
+
+def _render(resource, library):
+    """
+    Render a resource, returning a Deferred that fires with a View of its
+    response.
+    """
+    resource.library = library
+    request = FakeRequest(pausing=False)
+    d = request.notifyFinish()
+    body = resource.render(request)
+    if body is not NOT_DONE_YET:
+        request.write(body)
+        request.finish()
+    d.addCallback(lambda _: decode(''.join(request.written)))
+    return d
+
+class DatabasesTests(LibraryTestCase):
+
+    def _databases(self):
+        d = _render(DatabasesResource(), self.library)
+        def _records(response):
+            self.assertEqual(response.find('mtco').value, 1)
+            self.assertEqual(response.find('mrco').value, 1)
+            return [dict([(child.tag, child.value) for child in record])
+                    for record in response.find('mlcl')]
+        d.addCallback(_records)
+        return d
+
+    def test_empty(self):
+        # A library without any songs or playlists is still a database.
+        d = self._databases()
+        d.addCallback(self.assertEqual, [{'miid': 1, 'mper': 1,
+                                          'minm': 'Test', 'mimc': 0,
+                                          'mctc': 0}])
+        return d
+
+    def test_counts(self):
+        session = db.Session(bind=self.engine)
+        for song in _songs(3):
+            song.id = None
+            session.add(song)
+        session.add_all([db.Playlist(u'First'), db.Playlist(u'Second')])
+        session.commit()
+        session.close()
+
+        d = self._databases()
+        def _check(records):
+            self.assertEqual(len(records), 1)
+            self.assertEqual((records[0]['mimc'], records[0]['mctc']), (3, 2))
+        d.addCallback(_check)
+        return d
+
+    def test_cached(self):
+        # The cached response is served until the library changes.
+        resource = DatabasesResource()
+        resource.responses = ResponseCache()
+        d = _render(resource, self.library)
+        d.addCallback(lambda _: _render(resource, self.library))
+        def _cached(response):
+            self.assertEqual(resource.responses.hits, 1)
+            return self.library.write(lambda session: session.add(
+                Song(u'/music/1.mp3', u'Song 1')))
+        d.addCallback(_cached)
+        d.addCallback(lambda _: _render(resource, self.library))
+        def _check(response):
+            record = response.find('mlcl').find('mlit')
+            self.assertEqual(record.find('mimc').value, 1)
+            self.assertEqual(resource.responses.revision,
+                             self.library.revision)
+            self.assertEqual(resource.responses.hits, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_serverInfo(self):
+        resource = ServerInfoResource()
+        resource.sessions = SessionTable()
+        d = _render(resource, self.library)
+        d.addCallback(lambda response: self.assertEqual(
+            response.find('msdc').value, 1))
+        return d
+
+    def test_child(self):
+        # The library's database is the only one.
+        resource = DatabasesResource()
+        self.assertIsInstance(resource.getChild('1', None), DatabaseResource)
+        self.assertIsInstance(resource.getChild('2', None), error.NoResource)
+        self.assertIsInstance(resource.getChild('x', None), error.NoResource)
+
+class UpdateTests(LibraryTestCase):
+
+    def setUp(self):
+        LibraryTestCase.setUp(self)
+        self.sessions = SessionTable()
+        self.session = self.sessions.create()
+
+    def _update(self, revision):
+        """Request an update, returning the request and its response."""
+        resource = UpdateResource()
+        resource.library = self.library
+        resource.sessions = self.sessions
+        request = FakeRequest(pausing=False)
+        request.args['session-id'] = [str(self.session.id)]
+        request.args['revision-number'] = [str(revision)]
+        return request, resource.render(request)
+
+    def _add(self):
+        return self.library.write(lambda session: session.add(
+            Song(u'/music/1.mp3', u'Song 1')))
+
+    def test_stale(self):
+        # Clients that are behind are answered immediately.
+        request, body = self._update(self.library.revision - 1)
+        self.assertEqual(decode(body).find('musr').value,
+                         self.library.revision)
+        self.assertEqual(self.session.revision, self.library.revision)
+        self.assertEqual(self.library.waiters, [])
+
+    def test_write(self):
+        # Clients that are up to date are answered once the library changes.
+        revision = self.library.revision
+        request, body = self._update(revision)
+        self.assertIdentical(body, NOT_DONE_YET)
+        self.assertEqual(len(self.session.updates), 1)
+        d = gatherResults([request.notifyFinish(), self._add()])
+        def _check(_):
+            self.assertTrue(self.library.revision > revision)
+            response = decode(''.join(request.written))
+            self.assertEqual(response.find('musr').value,
+                             self.library.revision)
+            self.assertEqual(self.session.revision, self.library.revision)
+            self.assertEqual(self.session.updates, set())
+        d.addCallback(_check)
+        return d
+
+    def test_disconnect(self):
+        # Requests from clients that go away stop waiting.
+        request, body = self._update(self.library.revision)
+        request.processingFailed(Failure(ConnectionDone()))
+        self.assertEqual(self.library.waiters, [])
+        self.assertEqual(self.session.updates, set())
+        d = self._add()
+        def _check(_):
+            self.assertEqual(request.written, [])
+            self.assertEqual(request.finished, 0)
+        d.addCallback(_check)
+        return d
+
+    def test_logout(self):
+        # Requests are answered without an update when their session ends.
+        request, body = self._update(self.library.revision)
+        self.sessions.remove(self.session.id)
+        self.assertEqual(request.responseCode, http.NO_CONTENT)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.written, [])
+        self.assertEqual(self.library.waiters, [])
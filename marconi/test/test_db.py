@@ -0,0 +1,53 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+import os
+import sqlite3
+
+from twisted.trial import unittest
+
+from marconi import db
+
+class UpgradeTests(unittest.TestCase):
+
+    def setUp(self):
+        # A database created before the scanner recorded each song's file
+        # system state.
+        self.path = os.path.abspath(self.mktemp())
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE songs (id INTEGER PRIMARY KEY, '
+                           'path VARCHAR(1024) UNIQUE, title VARCHAR)')
+        connection.execute("INSERT INTO songs (path, title) "
+                           "VALUES ('/music/a.mp3', 'A')")
+        connection.commit()
+        connection.close()
+
+    def tearDown(self):
+        db.Base.metadata.bind = None
+
+    def test_readWrite(self):
+        engine = db.create(self.path)
+        self.assertEqual(db.missingColumns(engine), [])
+        rows = engine.execute('SELECT path, mtime, inode FROM songs')
+        self.assertEqual(list(rows), [(u'/music/a.mp3', None, None)])
+
+    def test_readOnly(self):
+        self.assertRaises(ValueError, db.create, self.path, readonly=True)
+        db.create(self.path)
+        db.create(self.path, readonly=True)
+
+    def test_nocaseIndexes(self):
+        # The string columns' case-sensitive indexes are replaced by NOCASE
+        # ones.
+        connection = sqlite3.connect(self.path)
+        connection.execute('ALTER TABLE songs ADD COLUMN artist VARCHAR')
+        connection.execute('CREATE INDEX ix_songs_artist ON songs (artist)')
+        connection.commit()
+        connection.close()
+
+        engine = db.create(self.path)
+        query = "SELECT name FROM sqlite_master WHERE type = 'index'"
+        indexes = set([name for (name,) in engine.execute(query)])
+        self.assertNotIn('ix_songs_artist', indexes)
+        for index in db.NOCASE_INDEXES.itervalues():
+            self.assertIn(index, indexes)
@@ -0,0 +1,98 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from marconi.db import Song
+from marconi.listing import SongListing
+from marconi.test.test_base import FileLibraryTestCase, LibraryTestCase, \
+                                   _rows
+
+def _encode(song, revision):
+    return '%d;' % song.id
+
+def _encodeEntry(song, entry, revision):
+    return '%d:%d;' % (song.id, entry)
+
+# Every encoded record is two bytes long (for songs 1 to 9).
+_size = Song.id * 0 + 2
+
+@inlineCallbacks
+def _batches(listing):
+    """Read (and then close) a listing, returning its batches."""
+    batches = []
+    while True:
+        data = yield listing.read()
+        if not data:
+            break
+        batches.append(data)
+    listing.close()
+    returnValue(batches)
+
+class SongListingTests(FileLibraryTestCase):
+
+    songs = 9
+
+    def _listing(self, encode=_encode, **kwargs):
+        listing = SongListing(self.library, encode, _size, batchSize=4,
+                              **kwargs)
+        self.addCleanup(listing.close)
+        return listing.open()
+
+    @inlineCallbacks
+    def test_batches(self):
+        listing = yield self._listing()
+        self.assertEqual((listing.count, listing.size), (9, 18))
+        batches = yield _batches(listing)
+        self.assertEqual(batches, ['1;2;3;4;', '5;6;7;8;', '9;'])
+        self.assertIdentical(listing.connection, None)
+        data = yield listing.read()
+        self.assertEqual(data, '')
+
+    @inlineCallbacks
+    def test_snapshot(self):
+        # Every batch is read from the revision the listing was opened at,
+        # however the library changes in the meantime.
+        listing = yield self._listing()
+        revision = listing.revision
+        first = yield listing.read()
+        yield self.library.write(self.scanner.apply, _rows(10, 5),
+                                 removed=[6])
+        self.assertTrue(self.library.revision > revision)
+
+        batches = yield _batches(listing)
+        self.assertEqual(first + ''.join(batches), '1;2;3;4;5;6;7;8;9;')
+
+    @inlineCallbacks
+    def test_ids(self):
+        # Songs are listed in the order of their ids, as often as they are
+        # listed, along with their entries.  Missing songs are left out.
+        ids = [3, 42, 1, 3, 9]
+        listing = yield self._listing(_encodeEntry, ids=ids,
+                                      entries=[10, 11, 12, 13, 14])
+        self.assertEqual((listing.count, listing.size), (4, 8))
+        batches = yield _batches(listing)
+        self.assertEqual(''.join(batches), '3:10;1:12;3:13;9:14;')
+
+    @inlineCallbacks
+    def test_clause(self):
+        listing = yield self._listing(clause=Song.id > 6)
+        self.assertEqual((listing.count, listing.size), (3, 6))
+        batches = yield _batches(listing)
+        self.assertEqual(batches, ['7;8;9;'])
+
+class MemoryListingTests(LibraryTestCase):
+
+    @inlineCallbacks
+    def test_buffered(self):
+        # Memory-based databases can't hold a read transaction open, so their
+        # listings are read when they are opened.
+        yield self.library.write(lambda session: session.add_all(
+            [Song(u'/music/%d.mp3' % i, u'Song %d' % i)
+             for i in xrange(1, 4)]))
+        listing = SongListing(self.library, _encode, _size, batchSize=2)
+        yield listing.open()
+        self.assertIdentical(listing.connection, None)
+        self.assertEqual(len(listing.buffer), 3)
+        batches = yield _batches(listing)
+        self.assertEqual(batches, ['1;2;', '3;'])
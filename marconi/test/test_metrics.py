@@ -0,0 +1,163 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+import re
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web import http
+from twisted.web.server import NOT_DONE_YET
+
+from marconi.metrics import CONTENT_TYPE, Histogram, Metrics
+from marconi.net.daap import MetricsResource, Resource, Site
+
+# A sample line of the text exposition format: a metric name, its optional
+# labels (whose values may contain escaped characters) and its value.
+SAMPLE = re.compile(r'^[a-z_]+(\{([a-z]+="([^"\\\n]|\\[\\"n])*",?)+\})? '
+                    r'[-+0-9.e]+$')
+
+class HeldResource(Resource):
+    """A resource whose requests are never finished."""
+
+    isLeaf = True
+    endpoint = 'held'
+
+    def render(self, request):
+        return NOT_DONE_YET
+
+class HistogramTests(unittest.TestCase):
+
+    def test_lines(self):
+        # Buckets are rendered cumulatively, ending with +Inf.
+        histogram = Histogram((1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.lines('h', (('a', 'b'),))), [
+            'h_bucket{a="b",le="1"} 2',
+            'h_bucket{a="b",le="2"} 3',
+            'h_bucket{a="b",le="+Inf"} 4',
+            'h_sum{a="b"} 6.0',
+            'h_count{a="b"} 4'])
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def _samples(self):
+        """Return a dict of the rendered samples' values by name."""
+        samples = {}
+        for line in self.metrics.render().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = value
+        return samples
+
+    def test_format(self):
+        # Every metric is introduced by its help and type, and every other
+        # line is a sample of the last metric introduced.
+        self.metrics.request('databases', 0.01, 100, 200)
+        self.metrics.query(0.002)
+        self.metrics.gauge('marconi_sessions', 'Sessions.', lambda: 2)
+        text = self.metrics.render()
+        self.assertTrue(text.endswith('\n'))
+
+        names = []
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                names.append(line.split()[2])
+            elif line.startswith('# TYPE '):
+                name, type = line.split()[2:]
+                self.assertEqual(name, names[-1])
+                self.assertIn(type, ('counter', 'gauge', 'histogram'))
+            else:
+                self.assertTrue(SAMPLE.match(line), line)
+                self.assertTrue(line.startswith(names[-1]), line)
+        self.assertEqual(len(names), len(set(names)))
+        self.assertIn('marconi_sessions', names)
+
+    def test_requests(self):
+        self.metrics.request('databases', 0.01, 100, 200)
+        self.metrics.request('databases', 0.2, 50, 200)
+        self.metrics.request('login', 0.001, 0, 403)
+        self.metrics.abort('update')
+        samples = self._samples()
+        label = '{endpoint="%s"}'
+        self.assertEqual(samples['marconi_requests_total' +
+                                 label % 'databases'], '2')
+        self.assertEqual(samples['marconi_response_bytes_total' +
+                                 label % 'databases'], '150')
+        self.assertEqual(samples['marconi_request_errors_total' +
+                                 label % 'databases'], '0')
+        self.assertEqual(samples['marconi_request_errors_total' +
+                                 label % 'login'], '1')
+        self.assertEqual(samples['marconi_requests_aborted_total' +
+                                 label % 'update'], '1')
+        self.assertEqual(samples['marconi_requests_total' +
+                                 label % 'update'], '0')
+        self.assertEqual(samples['marconi_request_duration_seconds_count' +
+                                 label % 'databases'], '2')
+        self.assertEqual(samples['marconi_request_duration_seconds_bucket'
+                                 '{endpoint="databases",le="0.01"}'], '1')
+
+    def test_escaping(self):
+        self.metrics.gauge('marconi_test', 'Line one\nback\\slash "quoted"',
+                           lambda: 1, labels=(('name', 'a\\b"c\nd'),))
+        self.metrics.gauge('marconi_test', 'Ignored.', lambda: 2.5,
+                           labels=(('name', u'caf\xe9'),))
+        lines = self.metrics.render().splitlines()
+        start = lines.index('# TYPE marconi_test gauge') - 1
+        self.assertEqual(lines[start:], [
+            '# HELP marconi_test Line one\\nback\\\\slash "quoted"',
+            '# TYPE marconi_test gauge',
+            'marconi_test{name="a\\\\b\\"c\\nd"} 1',
+            'marconi_test{name="caf\xc3\xa9"} 2.5'])
+        for line in lines[start + 2:]:
+            self.assertTrue(SAMPLE.match(line.replace('\xc3\xa9', 'e')),
+                            line)
+
+class MetricsResourceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.patch(Resource, 'metrics', self.metrics)
+
+    def _get(self, resource, path, host='127.0.0.1'):
+        """Serve a GET request, returning the response and its channel."""
+        site = Site(resource, timeout=None)
+        channel = site.buildProtocol(None)
+        transport = StringTransport(peerAddress=IPv4Address('TCP', host, 80))
+        channel.makeConnection(transport)
+        channel.dataReceived('GET %s HTTP/1.0\r\n\r\n' % path)
+        return transport.value(), channel
+
+    def test_render(self):
+        response, channel = self._get(MetricsResource(), '/metrics')
+        headers, body = response.split('\r\n\r\n', 1)
+        self.assertTrue(headers.startswith('HTTP/1.0 200'))
+        self.assertIn('Content-Type: %s' % CONTENT_TYPE, headers)
+        # The request is only counted once it has been sent.
+        self.assertNotIn('endpoint="metrics"', body)
+        endpoint = self.metrics.endpoints['metrics']
+        self.assertEqual((endpoint.requests, endpoint.bytes, endpoint.errors),
+                         (1, len(body), 0))
+
+        response, channel = self._get(MetricsResource(), '/metrics')
+        self.assertIn('marconi_requests_total{endpoint="metrics"} 1',
+                      response)
+
+    def test_remote(self):
+        # Only local clients may read the metrics.
+        response, channel = self._get(MetricsResource(), '/metrics',
+                                      '10.0.0.1')
+        self.assertTrue(response.startswith('HTTP/1.0 %d' % http.FORBIDDEN))
+        endpoint = self.metrics.endpoints['metrics']
+        self.assertEqual((endpoint.requests, endpoint.errors), (1, 1))
+
+    def test_aborted(self):
+        response, channel = self._get(HeldResource(), '/held')
+        channel.connectionLost(Failure(ConnectionDone()))
+        endpoint = self.metrics.endpoints['held']
+        self.assertEqual((endpoint.requests, endpoint.aborted), (0, 1))
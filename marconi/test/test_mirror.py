@@ -0,0 +1,112 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from zope.interface import implements
+from zope.interface.verify import verifyClass
+
+from marconi.browse import BrowseIndex
+from marconi.catalog import Catalog
+from marconi.mirror import RETRY_DELAY, IMirror, Mirror
+
+def _result(d):
+    """Return the result (or Failure) that the Deferred has fired with."""
+    results = []
+    d.addBoth(results.append)
+    return results[0]
+
+class FakeLibrary(object):
+    """A library whose database reads are completed by the test."""
+
+    def __init__(self):
+        self.revision = 1
+        self.reactor = Clock()
+        self.reads = []
+
+    def observe(self, observer):
+        pass
+
+    def run(self, func, *args):
+        d = Deferred()
+        self.reads.append(d)
+        return d
+
+class ListMirror(Mirror):
+
+    implements(IMirror)
+
+    def __init__(self, library):
+        Mirror.__init__(self, library)
+        self.rows = []
+
+    def lastId(self):
+        return self.rows and self.rows[-1][0] or 0
+
+    def replace(self, rows):
+        self.rows = list(rows)
+
+    def update(self, ids, rows):
+        rows = dict([(row[0], row) for row in rows])
+        self.rows = [row for row in self.rows if row[0] not in ids]
+        self.rows = sorted(self.rows + rows.values())
+
+    def state(self):
+        return self.rows
+
+    def undump(self, state):
+        self.replace(state)
+
+class MirrorTests(unittest.TestCase):
+
+    def test_interface(self):
+        for cls in (ListMirror, Catalog, BrowseIndex):
+            self.assertTrue(verifyClass(IMirror, cls))
+
+    def setUp(self):
+        self.library = FakeLibrary()
+        self.mirror = ListMirror(self.library)
+        self.mirror.load()
+
+    def _fail(self):
+        self.library.reads.pop().errback(RuntimeError('database is locked'))
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_load(self):
+        d = self.mirror.wait(1)
+        self.library.reads.pop().callback([(1, u'Song')])
+        self.assertEqual(_result(d), 1)
+        self.assertEqual(self.mirror.rows, [(1, u'Song')])
+
+    def test_failed(self):
+        # Waiters are failed along with the update, and later waiters fail
+        # straight away until the mirror has been reloaded.
+        d = self.mirror.wait(1)
+        self._fail()
+        _result(d).trap(RuntimeError)
+        _result(self.mirror.wait(1)).trap(RuntimeError)
+        self.assertEqual(self.library.reads, [])
+
+        self.library.reactor.advance(RETRY_DELAY)
+        self.library.reads.pop().callback([(1, u'Song')])
+        self.assertEqual(_result(self.mirror.wait(1)), 1)
+        self.assertIdentical(self.mirror.failure, None)
+        self.assertEqual(self.mirror.delay, RETRY_DELAY)
+
+    def test_backoff(self):
+        self._fail()
+        self.library.reactor.advance(RETRY_DELAY)
+        self._fail()
+        self.library.reactor.advance(RETRY_DELAY)
+        self.assertEqual(self.library.reads, [])
+        self.library.reactor.advance(RETRY_DELAY)
+        self.assertEqual(len(self.library.reads), 1)
+
+    def test_changedWhileWaiting(self):
+        # Changes made while the mirror waits to be reloaded don't read the
+        # database before the delay has passed.
+        self._fail()
+        self.library.revision = 2
+        self.mirror._changed([])
+        self.assertEqual(self.library.reads, [])
@@ -0,0 +1,159 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+from sqlalchemy import select
+from twisted.trial import unittest
+
+from marconi import db
+from marconi.db import Song
+from marconi.net import query
+from marconi.net.query import QueryError
+
+class ParseTests(unittest.TestCase):
+
+    def test_predicate(self):
+        self.assertEqual(query.parse("'daap.songartist:Foo'"),
+                         ('match', 'daap.songartist', False, 'Foo',
+                          False, False))
+        self.assertEqual(query.parse("'daap.songartist!:*Foo*'"),
+                         ('match', 'daap.songartist', True, 'Foo',
+                          True, True))
+
+    def test_operators(self):
+        tree = query.parse("('daap.songgenre:Jazz','daap.songgenre:Blues')"
+                           "+'dmap.itemname:*love*' 'daap.songyear:1959'")
+        self.assertEqual(tree[0], 'and')
+        self.assertEqual([child[0] for child in tree[1]],
+                         ['or', 'match', 'match'])
+        self.assertEqual([child[3] for child in tree[1][0][1]],
+                         ['Jazz', 'Blues'])
+
+    def test_escapes(self):
+        # Escaped characters never separate the field from the value, and
+        # are never wildcards.
+        self.assertEqual(query.parse(r"'daap.songartist:AC\:DC'"),
+                         ('match', 'daap.songartist', False, 'AC:DC',
+                          False, False))
+        self.assertEqual(query.parse(r"'a\:b:c'")[1:4], ('a:b', False, 'c'))
+        self.assertEqual(query.parse(r"'daap.songartist:\*NSYNC\*'"),
+                         ('match', 'daap.songartist', False, '*NSYNC*',
+                          False, False))
+        self.assertEqual(query.parse(r"'daap.songartist:\**'"),
+                         ('match', 'daap.songartist', False, '*',
+                          True, False))
+        self.assertEqual(query.parse(r"'dmap.itemname:it\'s'")[3], "it's")
+        self.assertEqual(query.parse(r"'dmap.itemname:a\\'")[3], 'a\\')
+
+    def test_malformed(self):
+        for text in ("'daap.songartist:Foo", "'daap.songartist'",
+                     r"'daap.songartist\:Foo'", "'daap.songartist:Foo\\",
+                     "('daap.songartist:Foo'", '', "'a:b' )", "'a:b',"):
+            self.assertRaises(QueryError, query.parse, text)
+
+class SuccessorTests(unittest.TestCase):
+
+    def test_successor(self):
+        self.assertEqual(query._successor(u'ab'), u'ac')
+        self.assertEqual(query._successor(u'a@'), u'a[')
+        self.assertEqual(query._successor(u'a\ud7ff'), u'a\ue000')
+        self.assertEqual(query._successor(u''), None)
+        self.assertEqual(query._successor(u'\U0010ffff'), None)
+
+class CompileTests(unittest.TestCase):
+
+    songs = [
+        (u'Foo Fighters', u'Everlong', 1997),
+        (u'foo', u'Bar', 2001),
+        (u'Foobar', u'Love Song', None),
+        (u'AC/DC', u'Thunderstruck', 1990),
+        (u'100%_Pure', u'Lovely', 2005),
+        (None, u'Untitled', 2005),
+        (u'Fop', u'Glove', 1997),
+        (u'Fo\xe9', u'Caf\xe9', 1997),
+    ]
+
+    def setUp(self):
+        self.engine = db.create(':memory:')
+        session = db.Session(bind=self.engine)
+        for i, (artist, title, year) in enumerate(self.songs):
+            song = Song(u'/music/%d.mp3' % i, title)
+            song.artist = artist
+            song.year = year
+            session.add(song)
+        session.commit()
+        session.close()
+
+    def tearDown(self):
+        db.Base.metadata.bind = None
+
+    def _titles(self, text):
+        clause = query.compile(text)
+        rows = self.engine.execute(select([Song.title], clause,
+                                          order_by=[Song.id]))
+        return [title for (title,) in rows]
+
+    def test_exact(self):
+        # Strings are compared without regard to case.
+        self.assertEqual(self._titles("'daap.songartist:FOO'"), [u'Bar'])
+        self.assertEqual(self._titles("'daap.songartist:foo fighters'"),
+                         [u'Everlong'])
+        self.assertEqual(self._titles("'daap.songartist:fo\xc3\xa9'"),
+                         [u'Caf\xe9'])
+
+    def test_prefix(self):
+        self.assertEqual(self._titles("'daap.songartist:foo*'"),
+                         [u'Everlong', u'Bar', u'Love Song'])
+        self.assertEqual(self._titles("'daap.songartist:FOO F*'"),
+                         [u'Everlong'])
+        self.assertEqual(self._titles("'daap.songartist:100%_*'"),
+                         [u'Lovely'])
+        self.assertEqual(self._titles("'daap.songartist:*'"),
+                         [title for artist, title, year in self.songs
+                          if artist is not None])
+
+    def test_suffix(self):
+        self.assertEqual(self._titles("'dmap.itemname:*song'"),
+                         [u'Love Song'])
+        self.assertEqual(self._titles("'dmap.itemname:*LOVE*'"),
+                         [u'Love Song', u'Lovely', u'Glove'])
+        self.assertEqual(self._titles("'daap.songartist:*%_*'"),
+                         [u'Lovely'])
+
+    def test_negated(self):
+        # Songs without a value don't match, so negations include them.
+        self.assertEqual(self._titles("'daap.songartist!:foo*'"),
+                         [u'Thunderstruck', u'Lovely', u'Untitled', u'Glove',
+                          u'Caf\xe9'])
+        self.assertEqual(self._titles("'daap.songyear!:1997'"),
+                         [u'Bar', u'Love Song', u'Thunderstruck', u'Lovely',
+                          u'Untitled'])
+
+    def test_numbers(self):
+        self.assertEqual(self._titles("'daap.songyear:2005'"),
+                         [u'Lovely', u'Untitled'])
+        self.assertEqual(self._titles("'daap.songyear:soon'"), [])
+        self.assertEqual(self._titles("'daap.songyear!:soon'"),
+                         [title for artist, title, year in self.songs])
+
+    def test_constants(self):
+        self.assertEqual(query.compile("'dmap.itemkind:2'"), None)
+        self.assertEqual(query.compile("'com.apple.itunes.mediakind:1'+"
+                                       "'dmap.unknown:x'"), None)
+        self.assertEqual(self._titles("'dmap.itemkind:4'"), [])
+        self.assertEqual(self._titles("'dmap.itemkind:4',"
+                                      "'daap.songyear:1990'"),
+                         [u'Thunderstruck'])
+
+    def test_indexed(self):
+        # Exact and prefix matches on the indexed columns use their NOCASE
+        # indexes.
+        connection = self.engine.raw_connection()
+        for text in ("'daap.songartist:Foo'", "'daap.songartist:Foo*'",
+                     "'daap.songgenre:Ro*'"):
+            compiled = select([Song.id], query.compile(text)).compile(
+                bind=self.engine)
+            params = [compiled.params[key] for key in compiled.positiontup]
+            plan = connection.execute('EXPLAIN QUERY PLAN ' + str(compiled),
+                                      params).fetchall()
+            self.assertIn('_nocase', plan[0][-1])
+        connection.close()
@@ -0,0 +1,93 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+import os
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import log
+
+from marconi import db
+from marconi.scanner import Scanner
+from marconi.test.test_base import FileLibraryTestCase
+
+class ScannerTests(FileLibraryTestCase):
+
+    songs = 0
+
+    def setUp(self):
+        d = FileLibraryTestCase.setUp(self)
+        self.scanner = Scanner(self.library, processes=1)
+        return d
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def _paths(self):
+        query = 'SELECT path FROM songs ORDER BY path'
+        return [path for (path,) in self.engine.execute(query)]
+
+    def _addSong(self, path):
+        session = db.Session(bind=self.engine)
+        song = db.Song(path.decode('utf-8'), u'Song')
+        song.mtime = 0.0
+        session.add(song)
+        session.commit()
+        id = song.id
+        session.close()
+        return id
+
+    def _messages(self):
+        """Return a list that collects the messages logged from now on."""
+        messages = []
+        def _observe(event):
+            messages.append(log.textFromEventDict(event))
+        log.addObserver(_observe)
+        self.addCleanup(log.removeObserver, _observe)
+        return messages
+
+    @inlineCallbacks
+    def test_unreadable(self):
+        self._write('new.mp3', 'not audio')
+        result = yield self.scanner.scan([self.directory])
+        self.assertEqual(result, (0, 0, 0))
+        self.assertEqual(self._paths(), [])
+
+    @inlineCallbacks
+    def test_unreadableChange(self):
+        # A song whose file has changed into one that can't be read is
+        # removed, rather than being extracted again by every scan.  The
+        # library's writer removes it.
+        self._addSong(self._write('song.mp3', 'not audio'))
+        revision = self.library.revision
+
+        result = yield self.scanner.scan([self.directory])
+        self.assertEqual(result, (0, 0, 1))
+        self.assertEqual(self._paths(), [])
+        self.assertTrue(self.library.revision > revision)
+        result = yield self.scanner.scan([self.directory])
+        self.assertEqual(result, (0, 0, 0))
+
+    @inlineCallbacks
+    def test_undecodable(self):
+        # Files whose names can't be decoded are skipped, and say so.
+        messages = self._messages()
+        path = self._write('bad\xff.mp3', 'not audio')
+        result = yield self.scanner.scan([self.directory])
+        self.assertEqual(result, (0, 0, 0))
+        self.assertTrue([message for message in messages
+                         if message.startswith('Skipping %r' % (path,))])
+
+        del messages[:]
+        rows, ids, removed = self.scanner.prepare([path, self.directory])
+        self.assertEqual((rows, removed), ([], []))
+        self.assertEqual(len([message for message in messages
+                              if message.startswith('Skipping')]), 2)
+
+    def test_prepare(self):
+        id = self._addSong(self._write('song.mp3', 'not audio'))
+        rows, ids, removed = self.scanner.prepare([self.directory])
+        self.assertEqual(rows, [])
+        self.assertEqual(removed, [id])
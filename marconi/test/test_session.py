@@ -0,0 +1,47 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.trial import unittest
+
+from marconi.net.session import SessionTable
+
+class SessionTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = SessionTable(timeout=90, resolution=30)
+
+    def _sweep(self, count):
+        for i in xrange(count):
+            self.sessions.sweep()
+
+    def test_expire(self):
+        session = self.sessions.create()
+        self._sweep(2)
+        self.assertIdentical(self.sessions.get(session.id), session)
+        self._sweep(2)
+        self.assertIdentical(self.sessions.get(session.id), session)
+        self._sweep(3)
+        self.assertIdentical(self.sessions.get(session.id), None)
+        self.assertEqual(len(self.sessions), 0)
+
+    def test_heldUpdate(self):
+        # A session waiting on an update request isn't idle.
+        session = self.sessions.create()
+        d = Deferred()
+        session.addUpdate(d)
+        self._sweep(10)
+        self.assertIdentical(self.sessions.get(session.id), session)
+
+        d.callback(None)
+        self._sweep(3)
+        self.assertIdentical(self.sessions.get(session.id), None)
+
+    def test_remove(self):
+        session = self.sessions.create()
+        d = Deferred()
+        session.addUpdate(d)
+        self.sessions.remove(session.id)
+        self.assertIdentical(self.sessions.get(session.id), None)
+        self.assertFailure(d, CancelledError)
+        return d
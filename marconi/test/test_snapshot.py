@@ -0,0 +1,84 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+import os
+
+from marconi import snapshot
+from marconi.db import Song
+from marconi.snapshot import Snapshot, SnapshotService
+from marconi.test.test_base import FileLibraryTestCase
+
+class FakeMirror(object):
+    """A mirror whose contents are always current."""
+
+    def dump(self):
+        return [1, 2, 3]
+
+class SnapshotTests(FileLibraryTestCase):
+
+    def setUp(self):
+        d = FileLibraryTestCase.setUp(self)
+        self.snapshotPath = snapshot.snapshotPath(self.path)
+        return d
+
+    def _write(self):
+        snapshot.write(self.snapshotPath, self.library.revision,
+                       snapshot.fingerprint(self.engine), {}, [])
+
+    def _service(self, everyRevision=False):
+        return SnapshotService(self.library, self.snapshotPath,
+                               {'mirror': FakeMirror()}, None,
+                               everyRevision=everyRevision)
+
+    def _addSong(self, session):
+        session.add(Song(u'/music/new.mp3', u'New'))
+
+    def test_matches(self):
+        self._write()
+        self.assertTrue(Snapshot.open(self.snapshotPath).matches(self.engine))
+
+        # Songs added without going through the change log leave the
+        # revision unchanged, but not the rest of the fingerprint.
+        self.engine.execute(Song.__table__.insert(),
+                            path=u'/music/new.mp3', title=u'New')
+        opened = Snapshot.open(self.snapshotPath)
+        self.assertFalse(opened.matches(self.engine))
+        self.assertIdentical(self.open(snapshot=opened).snapshot, None)
+
+    def test_unfingerprinted(self):
+        # Snapshots written before they had fingerprints are never used.
+        self._write()
+        opened = Snapshot.open(self.snapshotPath)
+        opened.fingerprint = None
+        self.assertIdentical(self.open(snapshot=opened).snapshot, None)
+
+    def test_save(self):
+        service = self._service()
+        d = service.save()
+        def _check(_):
+            opened = Snapshot.open(self.snapshotPath)
+            self.assertEqual(opened.revision, self.library.revision)
+            self.assertEqual(opened.section('mirror'), [1, 2, 3])
+            self.assertIdentical(self.open(snapshot=opened).snapshot,
+                                 opened)
+        d.addCallback(_check)
+        return d
+
+    def _removedOnChange(self, everyRevision):
+        service = self._service(everyRevision)
+        d = service.save()
+        d.addCallback(lambda _: self.assertTrue(
+            os.path.exists(self.snapshotPath)))
+        d.addCallback(lambda _: self.library.write(self._addSong))
+        d.addCallback(lambda _: self.assertFalse(
+            os.path.exists(self.snapshotPath)))
+        return d
+
+    def test_removedOnChange(self):
+        return self._removedOnChange(False)
+
+    def test_removedOnChangeEveryRevision(self):
+        # Snapshots that are replaced after each revision are still removed
+        # as soon as the library moves past them, in case the server stops
+        # before a new one has been written.
+        return self._removedOnChange(True)
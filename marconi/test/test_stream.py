@@ -0,0 +1,42 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+from twisted.trial import unittest
+
+from marconi.net.stream import parseRange
+
+class ParseRangeTests(unittest.TestCase):
+
+    def test_missing(self):
+        self.assertEqual(parseRange(None, 100), None)
+        self.assertEqual(parseRange('', 100), None)
+
+    def test_unsupported(self):
+        self.assertEqual(parseRange('items=0-10', 100), None)
+        self.assertEqual(parseRange('bytes=0-10,20-30', 100), None)
+        self.assertEqual(parseRange('bytes=a-b', 100), None)
+
+    def test_range(self):
+        self.assertEqual(parseRange('bytes=10-19', 100), (10, 19))
+        self.assertEqual(parseRange('bytes=10-', 100), (10, 99))
+        self.assertEqual(parseRange('bytes=90-200', 100), (90, 99))
+
+    def test_firstByte(self):
+        self.assertEqual(parseRange('bytes=0-0', 100), (0, 0))
+        self.assertEqual(parseRange('bytes=99-99', 100), (99, 99))
+
+    def test_suffix(self):
+        self.assertEqual(parseRange('bytes=-10', 100), (90, 99))
+        self.assertEqual(parseRange('bytes=-200', 100), (0, 99))
+
+    def test_emptySuffix(self):
+        self.assertRaises(ValueError, parseRange, 'bytes=-0', 100)
+        self.assertRaises(ValueError, parseRange, 'bytes=-10', 0)
+
+    def test_backwards(self):
+        self.assertEqual(parseRange('bytes=5-0', 100), None)
+        self.assertEqual(parseRange('bytes=50-10', 100), None)
+
+    def test_unsatisfiable(self):
+        self.assertRaises(ValueError, parseRange, 'bytes=100-', 100)
+        self.assertRaises(ValueError, parseRange, 'bytes=150-200', 100)
@@ -0,0 +1,147 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+from twisted.internet import inotify
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+
+from marconi import watcher
+from marconi.watcher import Watcher
+
+class FakeLibrary(object):
+    """A library whose writes are completed by the test."""
+
+    def __init__(self):
+        self.reactor = Clock()
+        self.writes = []
+
+    def write(self, func, *args):
+        d = Deferred()
+        self.writes.append((args, d))
+        return d
+
+class FakeScanner(object):
+    """A scanner that reports every path it is given as changed."""
+
+    def __init__(self):
+        self.prepared = []
+
+    def prepare(self, paths):
+        self.prepared.append(paths)
+        return paths, {}, ()
+
+    def apply(self, session, rows, ids={}, removed=()):
+        pass
+
+class WatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        # Paths are prepared as soon as they are refreshed, rather than in a
+        # thread.
+        self.patch(watcher, 'deferToThread',
+                   lambda func, *args: succeed(func(*args)))
+        self.library = FakeLibrary()
+        self.clock = self.library.reactor
+        self.scanner = FakeScanner()
+        self.watcher = Watcher(self.library, self.scanner, ['/music'],
+                               delay=2.0, maxDelay=30.0)
+        self.watcher.running = True
+        self.watched = []
+        self.watcher._watch = self.watched.append
+
+    def _event(self, path, mask):
+        self.watcher._event(None, FilePath(path), mask)
+
+    def _refreshed(self):
+        """Return the batches of paths that have been refreshed."""
+        return self.scanner.prepared
+
+    def test_debounce(self):
+        # Events are collected until none has arrived for a while.
+        self._event('/music/a.mp3', inotify.IN_CLOSE_WRITE)
+        self.clock.advance(1.5)
+        self._event('/music/b.mp3', inotify.IN_CLOSE_WRITE)
+        self.clock.advance(1.5)
+        self._event('/music/a.mp3', inotify.IN_CLOSE_WRITE)
+        self.clock.advance(1.9)
+        self.assertEqual(self._refreshed(), [])
+        self.clock.advance(0.1)
+        self.assertEqual(self._refreshed(),
+                         [['/music/a.mp3', '/music/b.mp3']])
+        self.assertEqual(len(self.library.writes), 1)
+        self.assertEqual(self.library.writes[0][0][0],
+                         ['/music/a.mp3', '/music/b.mp3'])
+
+    def test_maxDelay(self):
+        # A steady stream of events doesn't postpone a batch indefinitely.
+        for i in xrange(40):
+            self._event('/music/%02d.mp3' % i, inotify.IN_CLOSE_WRITE)
+            self.clock.advance(1)
+        self.assertEqual(len(self._refreshed()), 1)
+        self.assertEqual(len(self._refreshed()[0]), 30)
+
+    def test_files(self):
+        # Audio files are refreshed when they are written, deleted or moved,
+        # but not while they are still being created.
+        self._event('/music/new.mp3', inotify.IN_CREATE)
+        self._event('/music/cover.jpg', inotify.IN_CLOSE_WRITE)
+        self.clock.advance(2)
+        self.assertEqual(self._refreshed(), [])
+
+        for name, mask in (('written.mp3', inotify.IN_CLOSE_WRITE),
+                           ('created.MP3', inotify.IN_CREATE |
+                                           inotify.IN_CLOSE_WRITE),
+                           ('deleted.mp3', inotify.IN_DELETE),
+                           ('from.mp3', inotify.IN_MOVED_FROM),
+                           ('to.m4a', inotify.IN_MOVED_TO)):
+            self._event('/music/' + name, mask)
+        self.clock.advance(2)
+        self.assertEqual(self._refreshed(), [[
+            '/music/created.MP3', '/music/deleted.mp3', '/music/from.mp3',
+            '/music/to.m4a', '/music/written.mp3']])
+
+    def test_directories(self):
+        # Directories moved into the tree are watched and refreshed as a
+        # whole, as are those moved out of it or deleted.  The contents of
+        # new directories are reported one file at a time.
+        self._event('/music/new', inotify.IN_CREATE | inotify.IN_ISDIR)
+        self.clock.advance(2)
+        self.assertEqual(self._refreshed(), [])
+
+        self._event('/music/in', inotify.IN_MOVED_TO | inotify.IN_ISDIR)
+        self._event('/music/out', inotify.IN_MOVED_FROM | inotify.IN_ISDIR)
+        self._event('/music/gone', inotify.IN_DELETE | inotify.IN_ISDIR)
+        self.clock.advance(2)
+        self.assertEqual(self._refreshed(),
+                         [['/music/gone', '/music/in', '/music/out']])
+        self.assertEqual([path.path for path in self.watched], ['/music/in'])
+
+    def test_overflow(self):
+        # Everything is refreshed once events have been lost.
+        self._event('/music/a.mp3', inotify.IN_CLOSE_WRITE)
+        self._event('/music', inotify.IN_Q_OVERFLOW)
+        self.clock.advance(2)
+        self.assertEqual(self._refreshed(), [['/music', '/music/a.mp3']])
+
+    def test_serial(self):
+        # Events that arrive while a batch is being written make up the
+        # next batch, which is only refreshed once the first is done.
+        self._event('/music/a.mp3', inotify.IN_CLOSE_WRITE)
+        self.clock.advance(2)
+        self._event('/music/b.mp3', inotify.IN_CLOSE_WRITE)
+        self.clock.advance(2)
+        self.assertEqual(self._refreshed(), [['/music/a.mp3']])
+
+        self.library.writes[0][1].callback((1, 0, 0))
+        self.clock.advance(2)
+        self.assertEqual(self._refreshed(),
+                         [['/music/a.mp3'], ['/music/b.mp3']])
+
+    def test_stopped(self):
+        self._event('/music/a.mp3', inotify.IN_CLOSE_WRITE)
+        self.watcher.stopService()
+        self.clock.advance(2)
+        self.assertEqual(self._refreshed(), [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,128 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+from twisted.trial import unittest
+from twisted.web import http
+from twisted.web.test.test_web import DummyRequest
+
+from marconi.net.daap import DatabasesResource
+from marconi.test.test_base import LibraryTestCase
+from marconi.workers import Control, SharedSessionTable, WorkerPool, \
+                            WorkerProtocol
+
+class FakeChannel(object):
+    """Records the lines sent over a control channel."""
+
+    def __init__(self):
+        self.lines = []
+
+    def sendLine(self, line):
+        self.lines.append(line)
+
+    send = sendLine
+
+class SharedSessionTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = SharedSessionTable(timeout=90, resolution=30)
+        self.parent = FakeChannel()
+        self.sessions.control = self.parent
+
+    def _preRender(self, id):
+        resource = DatabasesResource()
+        resource.sessions = self.sessions
+        request = DummyRequest([''])
+        request.args['session-id'] = [str(id)]
+        return resource.preRender(request), request.responseCode
+
+    def test_unknown(self):
+        # Session ids that the parent hasn't announced are refused.
+        self.assertEqual(self._preRender(42), (False, http.FORBIDDEN))
+        self.assertEqual(len(self.sessions), 0)
+
+    def test_admitted(self):
+        # Sessions created by other workers are accepted once the parent has
+        # announced them, until they are revoked.
+        self.sessions.admit(42)
+        self.assertEqual(self._preRender(42), (True, None))
+        self.assertEqual(self.sessions.seen, set([42]))
+        self.sessions.revoke(42)
+        self.assertEqual(self._preRender(42), (False, http.FORBIDDEN))
+
+    def test_idle(self):
+        # Sessions that have only been idle here may be active elsewhere.
+        self.sessions.admit(42)
+        self.sessions.get(42)
+        for i in xrange(4):
+            self.sessions.sweep()
+        self.assertEqual(len(self.sessions), 0)
+        self.assertEqual(self._preRender(42), (True, None))
+
+    def test_announced(self):
+        session = self.sessions.create()
+        self.assertEqual(self._preRender(session.id), (True, None))
+        self.sessions.remove(session.id)
+        self.assertEqual(self._preRender(session.id), (False, http.FORBIDDEN))
+        self.assertEqual(self.parent.lines, ['login %d' % session.id,
+                                             'logout %d' % session.id])
+
+class ControlTests(LibraryTestCase):
+
+    def setUp(self):
+        LibraryTestCase.setUp(self)
+        self.sessions = SharedSessionTable()
+        self.control = Control(self.library, self.sessions)
+        self.parent = FakeChannel()
+        self.control.sendLine = self.parent.sendLine
+
+    def test_sessions(self):
+        self.control.lineReceived('session 42')
+        self.assertIdentical(self.sessions.get(7), None)
+        self.assertEqual(self.sessions.get(42).id, 42)
+        self.control.report()
+        self.assertEqual(self.parent.lines, ['seen 42', 'oldest 0'])
+
+        self.control.lineReceived('logout 42')
+        self.assertIdentical(self.sessions.get(42), None)
+        self.control.report()
+        self.assertEqual(self.parent.lines[-1], 'oldest 0')
+        self.assertEqual(len(self.parent.lines), 3)
+
+class WorkerPoolTests(LibraryTestCase):
+
+    def setUp(self):
+        LibraryTestCase.setUp(self)
+        self.pool = WorkerPool(self.library, 'library.db', 2, 3689, 'Test')
+        self.channels = []
+        for index in xrange(2):
+            worker = WorkerProtocol(self.pool, index)
+            worker.transport = channel = FakeChannel()
+            channel.write = lambda data, channel=channel: \
+                channel.lines.extend(data.splitlines())
+            self.pool.workers[index] = worker
+            self.channels.append(channel)
+
+    def test_login(self):
+        # Sessions are shared with every worker, and expire once they have
+        # been idle in all of them.
+        self.pool.workers[0].outReceived('login 42\n')
+        for channel in self.channels:
+            self.assertEqual(channel.lines, ['session 42'])
+
+        for i in xrange(self.pool.sessions.timeout //
+                        self.pool.sessions.resolution):
+            self.pool.workers[1].outReceived('seen 42\n')
+            self.pool._sweep()
+        self.assertEqual(self.channels[0].lines, ['session 42'])
+
+        for i in xrange(self.pool.sessions.timeout //
+                        self.pool.sessions.resolution):
+            self.pool._sweep()
+        for channel in self.channels:
+            self.assertEqual(channel.lines, ['session 42', 'logout 42'])
+
+    def test_logout(self):
+        self.pool.workers[0].outReceived('login 42\nlogout 42\n')
+        for channel in self.channels:
+            self.assertEqual(channel.lines, ['session 42', 'logout 42'])
+        self.assertEqual(len(self.pool.sessions), 0)
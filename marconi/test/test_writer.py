@@ -0,0 +1,85 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+import threading
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
+from twisted.trial import unittest
+
+from marconi.writer import Writer
+
+class FakeSession(object):
+    """A session whose transactions don't touch a database."""
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def expunge_all(self):
+        pass
+
+    def close(self):
+        pass
+
+class WriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.writer = Writer(reactor, lambda: self.session, maxsize=2)
+        self.writer.start()
+        # Every write waits until the test lets the writer go.
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.writer.stop()
+
+    def _write(self, value):
+        def _func(session):
+            self.release.wait()
+            return value
+        return self.writer.write(_func, (), {})
+
+    def test_backpressure(self):
+        # Writes beyond the writer's room wait in the reactor thread, rather
+        # than blocking it until the writer catches up.
+        writes = [self._write(i) for i in xrange(10)]
+        self.assertEqual(self.writer.queued, 2)
+        self.assertEqual(len(self.writer.pending), 8)
+
+        self.release.set()
+        d = DeferredList(writes, fireOnOneErrback=True)
+        def _check(results):
+            self.assertEqual([result[0] for success, result in results],
+                             range(10))
+            self.assertEqual(self.writer.queued, 0)
+            self.assertEqual(len(self.writer.pending), 0)
+        d.addCallback(_check)
+        return d
+
+    def test_failed(self):
+        # Failed writes make room for pending ones too.
+        def _fail(session):
+            self.release.wait()
+            raise RuntimeError('write failed')
+        writes = [self.writer.write(_fail, (), {}) for i in xrange(3)]
+        writes.append(self._write('ok'))
+        for d in writes[:3]:
+            self.assertFailure(d, RuntimeError)
+
+        self.release.set()
+        d = DeferredList(writes, fireOnOneErrback=True)
+        d.addCallback(lambda results: self.assertEqual(results[-1][1][0],
+                                                       'ok'))
+        return d
+
+    def test_stop(self):
+        # Pending writes are still made when the writer is stopped.
+        writes = [self._write(i) for i in xrange(5)]
+        self.release.set()
+        self.writer.stop()
+        d = DeferredList(writes, fireOnOneErrback=True)
+        d.addCallback(lambda results: self.assertEqual(len(results), 5))
+        return d
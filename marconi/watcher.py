@@ -0,0 +1,147 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Live library updates.  The Watcher uses Linux's inotify to watch the scanned
+directories and brings the library up to date as their audio files are
+added, changed, moved or deleted, so new music shows up without a rescan.
+
+Events tend to arrive in bursts (copying an album produces a few events per
+file), so they are coalesced: the affected paths are collected until no
+event has arrived for a short while, and then the whole batch is refreshed
+in a single transaction.  That makes a single library revision per batch,
+which is what clients and the library's caches see.
+"""
+
+import os
+from twisted.application import service
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+from marconi.scanner import AUDIO_FORMATS
+
+class Watcher(service.Service):
+    """
+    Watches the given directories for changes to their audio files, which
+    are brought up to date in the library using ``scanner``.  Paths are
+    refreshed once ``delay`` seconds pass without an event, but no later
+    than ``maxDelay`` seconds after the first one in a batch.  Tags are read
+    in a thread, and the changes are then made by the library's writer.
+    """
+
+    def __init__(self, library, scanner, paths, delay=2.0, maxDelay=30.0):
+        self.library = library
+        self.scanner = scanner
+        self.paths = paths
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self.notifier = None
+        self.pending = set()
+        self.first = None
+        self.call = None
+        self.refreshing = False
+
+    def startService(self):
+        from twisted.internet import inotify
+        from twisted.python.filepath import FilePath
+
+        service.Service.startService(self)
+        self.mask = (inotify.IN_CLOSE_WRITE | inotify.IN_CREATE |
+                     inotify.IN_DELETE | inotify.IN_DELETE_SELF |
+                     inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO)
+        self.notifier = inotify.INotify()
+        self.notifier.startReading()
+        for path in self.paths:
+            self._watch(FilePath(path))
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+
+    def _watch(self, path):
+        # Directories created beneath a watched directory are watched
+        # automatically, but those moved into one are not.
+        from twisted.internet.inotify import INotifyError
+        try:
+            self.notifier.watch(path, mask=self.mask, autoAdd=True,
+                                callbacks=[self._event], recursive=True)
+        except (INotifyError, OSError) as e:
+            log.msg('Unable to watch %s: %s' % (path.path, e))
+
+    def _event(self, ignored, path, mask):
+        from twisted.internet import inotify
+
+        if mask & inotify.IN_Q_OVERFLOW:
+            # Some events were lost, so everything is refreshed.
+            self.pending.update(self.paths)
+        elif mask & inotify.IN_ISDIR:
+            # The contents of new directories are reported file by file, but
+            # directories moved into (or out of) the tree must be refreshed
+            # as a whole.
+            if mask & inotify.IN_MOVED_TO:
+                self._watch(path)
+            if mask & (inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM |
+                       inotify.IN_DELETE):
+                self.pending.add(path.path)
+            else:
+                return
+        elif os.path.splitext(path.path)[1].lower() in AUDIO_FORMATS:
+            # Files that were just created are still being written; they
+            # are refreshed once they have been closed.
+            if mask & inotify.IN_CREATE and not mask & inotify.IN_CLOSE_WRITE:
+                return
+            self.pending.add(path.path)
+        else:
+            return
+        self._schedule()
+
+    def _schedule(self):
+        reactor = self.library.reactor
+        now = reactor.seconds()
+        if self.first is None:
+            self.first = now
+        delay = max(0, min(self.delay, self.first + self.maxDelay - now))
+        if self.call is not None and self.call.active():
+            self.call.reset(delay)
+        else:
+            self.call = reactor.callLater(delay, self._refresh)
+
+    def _refresh(self):
+        self.call = None
+        # Only one batch is refreshed at a time.  Events that arrive in the
+        # meantime make up the next one.
+        if self.refreshing or not self.pending or not self.running:
+            return
+        paths = sorted(self.pending)
+        self.pending.clear()
+        self.first = None
+
+        def _refreshed(result):
+            added, updated, removed = result
+            if added or updated or removed:
+                log.msg('Refreshed %d paths: %d added, %d updated, '
+                        '%d removed' % (len(paths), added, updated, removed))
+
+        def _done(result):
+            self.refreshing = False
+            if self.pending and self.running:
+                self._schedule()
+
+        def _prepared(result):
+            rows, ids, removed = result
+            if not rows and not removed:
+                return 0, 0, 0
+            return self.library.write(self.scanner.apply, rows, ids, removed)
+
+        self.refreshing = True
+        d = deferToThread(self.scanner.prepare, paths)
+        d.addCallback(_prepared)
+        d.addCallbacks(_refreshed, log.err,
+                       errbackArgs=('Failed to refresh %d paths' %
+                                    len(paths),))
+        d.addBoth(_done)
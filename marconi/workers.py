@@ -0,0 +1,438 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+Multi-process serving.  A single Python process can only keep one core busy,
+so larger installations can serve requests from several worker processes
+instead.  Each worker binds the DAAP port with SO_REUSEPORT, which lets the
+kernel spread incoming connections across them, and keeps its own caches and
+in-memory mirrors of the library.
+
+Workers open the database read-only.  The parent process remains the
+library's only writer (it runs the scanner, for instance), and it forwards
+the changes made by each committed transaction to every worker once they
+have been recorded in the change log.  Workers apply them to their own
+libraries using the parent's revision numbers, so every process agrees on
+the library's revision.
+
+A client's requests may be served by any of the workers, so they share
+their client sessions through the parent, which keeps the table of every
+live session id.  Workers announce the sessions they create (at login) and
+remove (at logout), and the parent tells every worker about them.  Workers
+only accept the session ids they have been told about, and they report the
+sessions that have been active, so that the parent can expire those that
+have been idle in every worker.  A client whose first request after its
+login reaches another worker before the parent's announcement is refused,
+and logs in again.
+
+The parent and its workers exchange lines over the workers' standard input
+and output:
+
+    changes <revision> <change>...      parent to worker
+    floor <revision>                    parent to worker
+    session <id>                        parent to worker
+    logout <id>                         parent to worker, worker to parent
+    login <id>                          worker to parent
+    seen <id>...                        worker to parent
+    oldest <revision>                   worker to parent
+
+Changes are written as a kind (``s`` for songs, ``p`` for playlists)
+followed by an id, or ``*`` for changes that weren't identified.  Workers
+periodically report the oldest revision from which one of their sessions
+may still request a delta, and the parent compacts the change log
+accordingly, announcing the new floor to the workers.
+"""
+
+import os
+import socket
+import sys
+from twisted.application import service
+from twisted.internet import protocol, tcp
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from marconi.db import Playlist, Song
+from marconi.net.session import SessionTable
+
+"""Change kinds mapped to the classes they represent, and back."""
+KINDS = {
+    's':    Song,
+    'p':    Playlist,
+}
+CODES = dict([(cls, kind) for kind, cls in KINDS.iteritems()])
+
+# The interval (in seconds) at which workers report their oldest session
+# revision to the parent.
+REPORT_INTERVAL = 60
+
+# The delay (in seconds) before a worker that exited unexpectedly is
+# restarted.
+RESTART_DELAY = 1.0
+
+def encodeChanges(revision, changes):
+    """Encode a revision's (class, id) changes as a ``changes`` line."""
+    parts = ['changes', str(revision)]
+    for cls, id in changes:
+        kind = CODES.get(cls)
+        if kind is not None:
+            parts.append(kind + (id is None and '*' or str(id)))
+    return ' '.join(parts)
+
+def decodeChanges(words):
+    """Decode the words following ``changes`` into (revision, changes)."""
+    changes = set()
+    for word in words[1:]:
+        id = word[1:]
+        changes.add((KINDS[word[0]], id != '*' and int(id) or None))
+    return int(words[0]), changes
+
+#
+# Listening
+#
+
+class ReusePort(tcp.Port):
+    """A TCP port whose socket is bound with SO_REUSEPORT."""
+
+    def createInternetSocket(self):
+        skt = tcp.Port.createInternetSocket(self)
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return skt
+
+class ReusePortServer(service.Service):
+    """A service that listens on a port shared with other processes."""
+
+    def __init__(self, port, factory, interface=''):
+        self.port = port
+        self.factory = factory
+        self.interface = interface
+        self.listener = None
+
+    def startService(self):
+        from twisted.internet import reactor
+
+        service.Service.startService(self)
+        self.listener = ReusePort(self.port, self.factory,
+                                  interface=self.interface, reactor=reactor)
+        self.listener.startListening()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.listener is not None:
+            d = self.listener.stopListening()
+            self.listener = None
+            return d
+
+#
+# Parent
+#
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """The parent's end of its connection to a single worker."""
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.oldest = None
+        self.buffer = ''
+
+    def send(self, line):
+        self.transport.write(line + '\n')
+
+    def outReceived(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            words = line.split()
+            if len(words) == 2 and words[0] == 'oldest':
+                self.oldest = int(words[1]) or None
+            elif len(words) == 2 and words[0] == 'login':
+                self.pool.login(int(words[1]))
+            elif len(words) == 2 and words[0] == 'logout':
+                self.pool.logout(int(words[1]))
+            elif words and words[0] == 'seen':
+                self.pool.seen(map(int, words[1:]))
+
+    def errReceived(self, data):
+        # Workers log to their standard error, which ends up in our log.
+        for line in data.rstrip('\n').split('\n'):
+            log.msg('[worker %d] %s' % (self.index, line))
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self, reason)
+
+class WorkerPool(service.MultiService):
+    """
+    A service that runs ``count`` worker processes serving the library
+    (stored at ``path``) on the given port, forwards the library's changes
+    to them, and compacts the change log on their behalf.  Workers that exit
+    unexpectedly are restarted.  ``snapshots`` says when the first worker
+    saves a snapshot, as for daap.getService() (or 'never').
+    """
+
+    def __init__(self, library, path, count, port, name, catalog=True,
+                 snapshots='never'):
+        from twisted.application.internet import TimerService
+        from marconi.net.daap import COMPACT_INTERVAL
+
+        service.MultiService.__init__(self)
+        self.library = library
+        self.path = os.path.abspath(path)
+        self.count = count
+        self.port = port
+        self.name = name
+        self.catalog = catalog
+        self.snapshots = snapshots
+        self.workers = {}
+        self.sessions = SessionTable()
+
+        library.observe(self._changed)
+
+        timer = TimerService(COMPACT_INTERVAL, self._compact)
+        timer.setServiceParent(self)
+        timer = TimerService(self.sessions.resolution, self._sweep)
+        timer.setServiceParent(self)
+
+    def startService(self):
+        service.MultiService.startService(self)
+        for index in xrange(self.count):
+            self._spawn(index)
+
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        for worker in self.workers.values():
+            try:
+                worker.transport.signalProcess('TERM')
+            except Exception:
+                pass
+        return d
+
+    def workerEnded(self, worker, reason):
+        from twisted.internet import reactor
+
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+        if self.running:
+            log.msg('Worker %d exited (%s); restarting it' %
+                    (worker.index, reason.getErrorMessage()))
+            reactor.callLater(RESTART_DELAY, self._spawn, worker.index)
+
+    def login(self, id):
+        """Share a session that a worker has created with every worker."""
+        if self.sessions.get(id) is None:
+            self.sessions.add(id)
+        self._broadcast('session %d' % id)
+
+    def logout(self, id):
+        """End a session in every worker."""
+        self.sessions.remove(id)
+        self._broadcast('logout %d' % id)
+
+    def seen(self, ids):
+        """Keep the sessions that a worker has seen from expiring."""
+        for id in ids:
+            self.sessions.get(id)
+
+    def _sweep(self):
+        for session in self.sessions.sweep():
+            self._broadcast('logout %d' % session.id)
+
+    def _spawn(self, index):
+        from twisted.internet import reactor
+
+        if not self.running or index in self.workers:
+            return
+        args = [sys.executable, '-m', 'marconi.workers',
+                '--db', self.path, '--port', str(self.port),
+                '--name', self.name]
+        if not self.catalog:
+            args.append('--no-catalog')
+        # Every worker can start from the snapshot, but only the first one
+        # saves them.
+        snapshots = self.snapshots
+        if index and snapshots != 'never':
+            snapshots = 'read'
+        args.extend(['--snapshot', snapshots])
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([path for path in sys.path
+                                             if path])
+        worker = WorkerProtocol(self, index)
+        self.workers[index] = worker
+        reactor.spawnProcess(worker, sys.executable, args, env=env)
+        # New workers accept the sessions that are already live.
+        for id in self.sessions.sessions:
+            worker.send('session %d' % id)
+
+    def _broadcast(self, line):
+        for worker in self.workers.values():
+            if worker.transport is not None:
+                worker.send(line)
+
+    def _changed(self, changes):
+        # Workers read the change log themselves, so the changes are only
+        # forwarded once the revision has been logged.
+        line = encodeChanges(self.library.revision, changes)
+        d = self.library.changelog.wait(self.library.revision)
+        d.addCallback(lambda revision: self._broadcast(line))
+
+    def _compact(self):
+        revisions = [worker.oldest for worker in self.workers.values()
+                     if worker.oldest]
+        revision = revisions and min(revisions) or self.library.revision
+        self.library.changelog.compact(revision)
+        self._broadcast('floor %d' % self.library.changelog.floor)
+
+#
+# Worker
+#
+
+class SharedSessionTable(SessionTable):
+    """
+    A worker's session table.  Besides its own sessions, it accepts those
+    that the parent has announced (which may have been created by another
+    worker), and no others.  The sessions it creates and removes are
+    announced to the parent through its ``control`` channel.
+    """
+
+    def __init__(self, timeout=1800, resolution=30):
+        SessionTable.__init__(self, timeout, resolution)
+        self.control = None
+        self.known = set()
+        self.seen = set()
+
+    def create(self):
+        while True:
+            session = SessionTable.create(self)
+            if session.id not in self.known:
+                break
+            # The id belongs to another worker's session.
+            SessionTable.remove(self, session.id)
+        self.known.add(session.id)
+        self._send('login %d' % session.id)
+        return session
+
+    def get(self, id):
+        session = SessionTable.get(self, id)
+        if session is None and id in self.known:
+            # The session has been used elsewhere, or has been idle here.
+            session = self.add(id)
+        if session is not None:
+            self.seen.add(id)
+        return session
+
+    def remove(self, id):
+        self._send('logout %d' % id)
+        return self.revoke(id)
+
+    def admit(self, id):
+        """Accept a session that the parent has announced."""
+        self.known.add(id)
+
+    def revoke(self, id):
+        """End a session that has been removed (or has expired) everywhere."""
+        self.known.discard(id)
+        self.seen.discard(id)
+        return SessionTable.remove(self, id)
+
+    def _send(self, line):
+        if self.control is not None:
+            self.control.sendLine(line)
+
+class Control(LineReceiver):
+    """A worker's end of its connection to the parent process."""
+
+    delimiter = '\n'
+
+    def __init__(self, library, sessions):
+        self.library = library
+        self.sessions = sessions
+        sessions.control = self
+
+    def lineReceived(self, line):
+        words = line.split()
+        if not words:
+            return
+        if words[0] == 'changes':
+            revision, changes = decodeChanges(words[1:])
+            self.library.advance(revision, changes)
+        elif words[0] == 'floor':
+            changelog = self.library.changelog
+            changelog.floor = max(changelog.floor, int(words[1]))
+        elif words[0] == 'session':
+            self.sessions.admit(int(words[1]))
+        elif words[0] == 'logout':
+            self.sessions.revoke(int(words[1]))
+
+    def report(self):
+        """
+        Report the sessions that have been active since the last report, and
+        the oldest revision that our sessions may still need.
+        """
+        seen, self.sessions.seen = self.sessions.seen, set()
+        if seen:
+            self.sendLine('seen ' + ' '.join(map(str, sorted(seen))))
+        self.sendLine('oldest %d' % (self.sessions.oldestRevision() or 0))
+
+    def connectionLost(self, reason):
+        # Workers don't outlive their parent.
+        from twisted.internet import reactor
+        if reactor.running:
+            reactor.stop()
+
+def main(argv=None):
+    from optparse import OptionParser
+    from twisted.internet import reactor, stdio, task
+    from marconi import db
+    from marconi.base import Library
+    from marconi.net import daap
+
+    parser = OptionParser(usage='%prog --db PATH [options]')
+    parser.add_option('--db', help="the library database's path")
+    parser.add_option('--port', type='int', default=3689,
+                      help="the server's port")
+    parser.add_option('--name', default='Marconi',
+                      help="the server's public name")
+    parser.add_option('--no-catalog', action='store_true', default=False,
+                      help="don't keep an in-memory catalog of the songs")
+    parser.add_option('--snapshot', default='never',
+                      choices=['never', 'read', 'shutdown', 'revision'],
+                      help="when to save a warm-start snapshot ('read' uses "
+                           "an existing one without saving any)")
+    options, args = parser.parse_args(argv)
+    if not options.db:
+        parser.error('--db is required')
+
+    # Standard output belongs to the control channel.  Log messages are
+    # written to standard error without timestamps: the parent adds its own.
+    def emit(eventDict):
+        text = log.textFromEventDict(eventDict)
+        if text is not None:
+            sys.stderr.write(text.replace('\n', '\n\t') + '\n')
+            sys.stderr.flush()
+    log.startLoggingWithObserver(emit, setStdout=False)
+
+    snapshot = None
+    if options.snapshot != 'never':
+        from marconi.snapshot import Snapshot, snapshotPath
+        snapshot = Snapshot.open(snapshotPath(options.db))
+    snapshots = None
+    if options.snapshot in ('shutdown', 'revision'):
+        snapshots = options.snapshot
+
+    engine = db.create(options.db, readonly=True)
+    library = Library(engine, options.name, catalog=not options.no_catalog,
+                      readonly=True, snapshot=snapshot)
+    # A client's session may have been created by any of the workers.
+    sessions = SharedSessionTable()
+    root = daap.getService(library, port=options.port, reusePort=True,
+                           snapshots=snapshots, sessions=sessions)
+
+    control = Control(library, sessions)
+    stdio.StandardIO(control)
+    task.LoopingCall(control.report).start(REPORT_INTERVAL, now=False)
+
+    root.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', root.stopService)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# Marconi Media Server
+# Copyright 2009 Jon Parise <jon@indelible.org>
+
+"""
+The library's writer.  SQLite only allows a single writer at a time, so
+rather than having every database thread contend for the write lock, all
+of a library's modifications are made by one dedicated thread.
+
+Writes are queued for the writer thread, which commits whatever has been
+queued by the time it is ready in a single transaction: a burst of small
+writes costs one commit (and makes one library revision) rather than one
+each.  Should any of them fail, the batch is rolled back and each write is
+retried in a transaction of its own, so that only the failing write's
+caller sees an error.
+
+The writer only takes on a bounded number of writes at a time.  Any more
+wait in the reactor thread, without blocking it, until earlier writes have
+been committed.
+"""
+
+import threading
+import time
+from collections import deque
+from Queue import Empty, Queue
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+class Writer(object):
+    """
+    A thread that runs ``func(session, *args, **kwargs)`` writes using its
+    own session from ``sessions``, committing up to ``batchSize`` of them
+    per transaction.  At most ``maxsize`` writes are handed to the thread at
+    once: later writes are held in ``pending`` until earlier ones finish,
+    which keeps the writer from falling too far behind without ever making
+    the reactor wait for it.
+    """
+
+    def __init__(self, reactor, sessions, maxsize=1024, batchSize=100):
+        self.reactor = reactor
+        self.sessions = sessions
+        self.maxsize = maxsize
+        self.batchSize = batchSize
+        self.queue = Queue()
+        self.queued = 0
+        self.pending = deque()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop,
+                                           name='marconi-writer')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def stop(self):
+        """Stop the thread once the writes queued so far have been made."""
+        if self.thread is not None:
+            while self.pending:
+                self.queue.put(self.pending.popleft())
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def write(self, func, args, kwargs):
+        """
+        Queue a write.  Returns a Deferred that fires (in the reactor
+        thread) with its result and the time taken by its transaction, once
+        that has been committed.
+        """
+        d = Deferred()
+        self.pending.append((func, args, kwargs, d))
+        self._feed()
+        return d
+
+    def _feed(self):
+        # Hand pending writes to the thread while it has room for them.
+        while self.pending and self.queued < self.maxsize:
+            self.queued += 1
+            self.queue.put(self.pending.popleft())
+
+    def _finished(self, fire, result):
+        # Called in the reactor thread as each write finishes, which makes
+        # room for a pending one.
+        self.queued -= 1
+        self._feed()
+        fire(result)
+
+    def _loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if len(batch) > 1:
+                try:
+                    self._commit(batch)
+                except Exception:
+                    for write in batch:
+                        self._retry(write)
+            elif batch:
+                self._retry(batch[0])
+            if stopping:
+                return
+
+    def _retry(self, write):
+        try:
+            self._commit([write])
+        except Exception:
+            self.reactor.callFromThread(self._finished, write[3].errback,
+                                        Failure())
+
+    def _commit(self, batch):
+        # Every write in the batch shares a single transaction.  Results are
+        # only delivered once it has been committed.
+        session = self.sessions()
+        start = time.time()
+        try:
+            results = [func(session, *args, **kwargs)
+                       for func, args, kwargs, d in batch]
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            # Detach the results so they can be used from the reactor
+            # thread.  Their loaded attributes remain available.
+            session.expunge_all()
+            session.close()
+        elapsed = time.time() - start
+        for write, result in zip(batch, results):
+            self.reactor.callFromThread(self._finished, write[3].callback,
+                                        (result, elapsed))
@@ -17,7 +17,7 @@ setup(
     author = 'Jon Parise',
     author_email = 'jon@indelible.org',
     url = 'http://www.indelible.org/projects/marconi/',
-    packages = ['marconi', 'marconi.net', 'twisted.plugins'],
+    packages = ['marconi', 'marconi.net', 'marconi.test', 'twisted.plugins'],
     classifiers = ['Development Status :: 2 - Pre-Alpha',
                    'Environment :: No Input/Output (Daemon)',
                    'Framework :: Twisted',
@@ -7,13 +7,51 @@ from twisted.application.service import IServiceMaker, MultiService
 from zope.interface import implements
 
 class Options(usage.Options):
+    optFlags = [
+        ['no-catalog', '', "Don't keep an in-memory catalog of the songs"],
+        ['watch', '', "Watch the scanned directories for changes"],
+    ]
     optParameters = [
         ['debug', '', False, "Enables debug output", bool],
         ['db', 'd', ':memory:', "The service database's path", str],
         ['name', 'n', 'Marconi', "The server's public name", str],
         ['port', 'p', 3689, "The server's port", int],
+        ['workers', 'w', 0, "Serve requests from this many worker processes",
+         int],
+        ['snapshot', '', 'shutdown',
+         "When to save a warm-start snapshot: never, shutdown or revision",
+         str],
     ]
 
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['scan'] = []
+
+    def opt_scan(self, path):
+        """Scan a directory into the library before serving"""
+        self['scan'].append(path)
+
+    opt_s = opt_scan
+
+    def postOptions(self):
+        if self['snapshot'] not in ('never', 'shutdown', 'revision'):
+            raise usage.UsageError('--snapshot must be never, shutdown or '
+                                   'revision')
+        if self['workers'] < 0:
+            raise usage.UsageError('--workers must not be negative')
+        if self['workers']:
+            import socket
+            if self['db'] == ':memory:':
+                raise usage.UsageError('--workers requires a --db path')
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise usage.UsageError('--workers requires SO_REUSEPORT')
+        if self['watch']:
+            from twisted.python.runtime import platform
+            if not self['scan']:
+                raise usage.UsageError('--watch requires --scan directories')
+            if not platform.supportsINotify():
+                raise usage.UsageError('--watch requires inotify')
+
 class ServiceMaker(object):
     implements(IServiceMaker, IPlugin)
     tapname = 'marconi'
@@ -36,11 +74,24 @@ class ServiceMaker(object):
         # as sibling services under a common root.
         root = MultiService()
 
-        # DAAP Protocol
-        service = daap.getService(library, port=port)
+        # DAAP Protocol.  With workers, requests are served by the worker
+        # processes, while this process remains the library's writer.
+        if options['workers']:
+            from marconi.workers import WorkerPool
+            service = WorkerPool(library, options['db'], options['workers'],
+                                 port, name,
+                                 catalog=not options['no-catalog'],
+                                 snapshots=options['snapshot'])
+        else:
+            snapshots = options['snapshot']
+            if snapshots == 'never':
+                snapshots = None
+            service = daap.getService(library, port=port,
+                                      snapshots=snapshots)
         service.setServiceParent(root)
 
-        # Bonjour Service Discovery Protocol
+        # Bonjour Service Discovery Protocol.  This is only registered once,
+        # by this process, however many workers share the port.
         service = bonjour.Service(reactor, "_daap._tcp", port, name)
         service.setServiceParent(root)
 
@@ -51,7 +102,33 @@ class ServiceMaker(object):
 
         # Create the server's database and library instances.
         db = self._createDatabase(options)
-        library = Library(db, options['name'])
+        # With workers, this process doesn't serve any requests itself, so
+        # it has no use for a catalog.
+        catalog = not options['no-catalog'] and not options['workers']
+
+        # Pick up where the last server left off if it saved a snapshot of
+        # its state.  With workers, the workers do that themselves.
+        snapshot = None
+        if options['snapshot'] != 'never' and not options['workers'] and \
+           options['db'] != ':memory:':
+            from marconi.snapshot import Snapshot, snapshotPath
+            snapshot = Snapshot.open(snapshotPath(options['db']))
+
+        library = Library(db, options['name'], catalog=catalog,
+                          snapshot=snapshot)
+
+        # Scan any requested directories into the library once the reactor
+        # (and with it the library's writer, which makes the scan's changes)
+        # has started.
+        if options['scan']:
+            from twisted.internet import reactor
+            from twisted.python import log
+            from marconi.scanner import Scanner
+            scanner = Scanner(library)
+            def _scan():
+                d = scanner.scan(options['scan'])
+                d.addErrback(log.err, 'Failed to scan the library')
+            reactor.callWhenRunning(_scan)
 
         # Create the root of our application's service hierarchy.
         root = MultiService()
@@ -60,6 +137,14 @@ class ServiceMaker(object):
         service = self._getDaapService(library, options)
         service.setServiceParent(root)
 
+        # Library Watcher.  This keeps the library up to date as the scanned
+        # directories change, and it always runs in this process, which is
+        # the library's writer.
+        if options['watch']:
+            from marconi.watcher import Watcher
+            service = Watcher(library, scanner, options['scan'])
+            service.setServiceParent(root)
+
         return root
 
 # Create our public service maker instance.  Twisted's plugin infrastructure